@@ -0,0 +1,95 @@
+"""
+admission.py
+Per-user rate limits, checked before any handler runs.
+
+An Admission keeps a token bucket per user and, for the commands given a
+limit, one per (user, command). An update is admitted only if every bucket
+it falls under has a token. Buckets are (tokens, stamp, full_at) tuples in
+an OrderedDict ordered by last use; one that has refilled completely is the
+same as a new one, so those are dropped from the front as we go and memory
+follows the users active in the last minute or so, not every user seen.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class Admission:
+    def __init__(self, user_burst=10, user_rate=1.0, command_limits=None, notice_interval=10,
+                 exempt=None, max_buckets=200000):
+        self.user_limit = (user_burst, user_rate)
+        self.command_limits = dict(command_limits or {})    # command -> (burst, rate)
+        self.notice_interval = notice_interval
+        self.exempt = exempt                # uid -> True to skip the checks (admins)
+        self.max_buckets = max_buckets
+        self.stats = {"admitted": 0, "shed_user": 0, "shed_command": 0, "notices": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()       # uid or (uid, command) -> (tokens, stamp, full_at)
+        self._notices = OrderedDict()       # uid -> last "slow down" reply, oldest first
+
+    def admit(self, uid, command=None, now=None):
+        """None if the update may run, else the limit it hit ("user" or "command")."""
+        if self.exempt and self.exempt(uid):
+            return None
+        now = time.monotonic() if now is None else now
+        limit = self.command_limits.get(command)
+        with self._lock:
+            self._evict(now)
+            user_tokens = self._tokens(uid, self.user_limit, now)
+            if user_tokens < 1:
+                self.stats["shed_user"] += 1
+                return "user"
+            if limit:
+                key = (uid, command)
+                command_tokens = self._tokens(key, limit, now)
+                if command_tokens < 1:
+                    self.stats["shed_command"] += 1
+                    return "command"
+                self._spend(key, command_tokens, limit, now)
+            self._spend(uid, user_tokens, self.user_limit, now)
+            self.stats["admitted"] += 1
+            return None
+
+    def should_notify(self, uid, now=None):
+        """True (at most once per notice_interval per user) if a rejected
+        update should get a "slow down" reply."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._notices:
+                oldest, at = next(iter(self._notices.items()))
+                if now - at < self.notice_interval:
+                    break
+                del self._notices[oldest]
+            if uid in self._notices:
+                return False
+            self._notices[uid] = now
+            self.stats["notices"] += 1
+            return True
+
+    def shed(self):
+        return self.stats["shed_user"] + self.stats["shed_command"]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    # ---- buckets ----
+
+    def _tokens(self, key, limit, now):
+        entry = self._buckets.get(key)
+        if entry is None:
+            return limit[0]
+        return min(limit[0], entry[0] + (now - entry[1]) * limit[1])
+
+    def _spend(self, key, tokens, limit, now):
+        tokens -= 1
+        self._buckets[key] = (tokens, now, now + (limit[0] - tokens) / limit[1])
+        self._buckets.move_to_end(key)
+
+    def _evict(self, now):
+        while self._buckets:
+            key, entry = next(iter(self._buckets.items()))
+            if entry[2] > now and len(self._buckets) <= self.max_buckets:
+                break
+            del self._buckets[key]
+            self.stats["evicted"] += 1
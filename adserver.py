@@ -0,0 +1,216 @@
+"""
+adserver.py
+Shows published ads as impressions attached to ordinary replies.
+
+An AdServer indexes every published ad with budget left (cost minus
+displays, 1 pt per display) in a Fenwick tree weighted by that remaining
+budget. pick() is a weighted random choice in O(log n), a few microseconds
+under one lock, and charging the impression is another O(log n) update. An
+ad whose budget runs out drops to weight 0, so it is never picked again, and
+it is marked exhausted in the database.
+
+The ads come from a listener on ads/published: after the first snapshot
+only changes arrive (new ads, displays counted elsewhere by broadcasts or
+other processes). Exhausted ads are dropped from the local copy and changes
+to them are ignored. The index is rebuilt from that copy, without any read,
+when it has changed.
+
+Impressions are counted in memory and flushed every flush_interval seconds
+as one multi-path update of ads/published/<id>/displays increments.
+"""
+
+import time
+import random
+import logging
+import threading
+
+from storage import increment
+
+logger = logging.getLogger(__name__)
+
+
+class Fenwick:
+    """Prefix sums over integer weights with O(log n) updates and search."""
+
+    def __init__(self, weights):
+        n = len(weights)
+        self.tree = [0] * (n + 1)
+        for i, w in enumerate(weights, start=1):
+            self.tree[i] += w
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(weights)
+        self._top = 1 << (n.bit_length() - 1) if n else 0
+
+    def add(self, i, delta):
+        self.total += delta
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, r):
+        """Index i with sum(weights[:i]) <= r < sum(weights[:i + 1]), for 0 <= r < total."""
+        pos, step = 0, self._top
+        while step:
+            nxt = pos + step
+            if nxt < len(self.tree) and self.tree[nxt] <= r:
+                pos = nxt
+                r -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+
+def _budget_left(ad):
+    return int(ad.get("cost", 0) or 0) - int(ad.get("displays", 0) or 0)
+
+def _live(ad):
+    return isinstance(ad, dict) and not ad.get("exhausted") and _budget_left(ad) > 0
+
+
+class AdServer:
+    def __init__(self, store, render, flush_interval=5.0, rng=random.random):
+        self.store = store
+        self.render = render                # ad -> text attached to replies
+        self.flush_interval = flush_interval
+        self.rng = rng
+        self.stats = {"served": 0, "flushed": 0, "exhausted": 0}
+        self._lock = threading.Lock()
+        self._ads = {}                      # ad_id -> ad, live ads only, kept current by the listener
+        self._changed = False               # _ads changed since the last rebuild
+        self._slots = []                    # [(ad_id, owner, rendered text)]
+        self._remaining = []                # budget left per slot
+        self._tree = Fenwick([])
+        self._pending = {}                  # ad_id -> impressions not in the database yet
+        self._exhausted = set()             # ad ids to mark exhausted in the next flush
+        self._listener = None
+        self._thread = None
+
+    # ---- published ads ----
+
+    def _on_event(self, event):
+        parts = [p for p in (event.path or "/").split("/") if p]
+        with self._lock:
+            if event.event_type == "patch":
+                for k, v in (event.data or {}).items():
+                    self._put(parts + [p for p in k.split("/") if p], v)
+            else:
+                self._put(parts, event.data)
+            self._changed = True
+
+    def _put(self, parts, data):
+        if not parts:
+            self._ads = {ad_id: ad for ad_id, ad in (data or {}).items() if _live(ad)}
+            return
+        ad_id, rest = parts[0], parts[1:]
+        if not rest:
+            if _live(data):
+                self._ads[ad_id] = data
+            else:
+                self._ads.pop(ad_id, None)
+            return
+        ad = self._ads.get(ad_id)
+        if ad is None:
+            return          # a field of an exhausted ad
+        node = ad
+        for k in rest[:-1]:
+            node = node.setdefault(k, {})
+        if data is None:
+            node.pop(rest[-1], None)
+        else:
+            node[rest[-1]] = data
+        if not _live(ad):
+            del self._ads[ad_id]
+
+    def rebuild(self):
+        """Re-index the live ads if they changed; returns how many are served.
+
+        The budget left of an ad already indexed never goes up: an update
+        echoed late by the listener must not undo impressions counted here."""
+        with self._lock:
+            if self._changed:
+                self._changed = False
+                indexed = {slot[0]: (slot, left) for slot, left in zip(self._slots, self._remaining)}
+                slots, remaining = [], []
+                for ad_id in sorted(self._ads):
+                    ad = self._ads[ad_id]
+                    left = max(0, _budget_left(ad) - self._pending.get(ad_id, 0))
+                    if ad_id in indexed:
+                        slot, known = indexed[ad_id]
+                        left = min(left, known)
+                    else:
+                        slot = (ad_id, str(ad.get("owner", "")), self.render(ad))
+                    slots.append(slot)
+                    remaining.append(left)
+                self._slots, self._remaining, self._tree = slots, remaining, Fenwick(remaining)
+            return sum(1 for r in self._remaining if r)
+
+    def pick(self, viewer=None):
+        """Text of an ad to show viewer, charged as one impression, or None."""
+        with self._lock:
+            total = self._tree.total
+            if total <= 0:
+                return None
+            i = self._tree.find(self.rng() * total)
+            if i >= len(self._slots) or self._remaining[i] <= 0:
+                return None
+            ad_id, owner, text = self._slots[i]
+            if owner == str(viewer):
+                return None             # nobody pays to see their own ad
+            self._tree.add(i, -1)
+            self._remaining[i] -= 1
+            self._pending[ad_id] = self._pending.get(ad_id, 0) + 1
+            self.stats["served"] += 1
+            if not self._remaining[i]:
+                self._exhausted.add(ad_id)
+                self.stats["exhausted"] += 1
+            return text
+
+    def serving(self):
+        with self._lock:
+            return sum(1 for r in self._remaining if r)
+
+    def pending(self):
+        with self._lock:
+            return sum(self._pending.values())
+
+    # ---- flushing ----
+
+    def flush(self):
+        """Write the counted impressions in one update; returns how many."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            exhausted, self._exhausted = self._exhausted, set()
+        if not pending and not exhausted:
+            return 0
+        changes = {f"ads/published/{ad_id}/displays": increment(n) for ad_id, n in pending.items()}
+        changes.update({f"ads/published/{ad_id}/exhausted": int(time.time()) for ad_id in exhausted})
+        try:
+            self.store.update(changes)
+        except Exception:
+            with self._lock:
+                for ad_id, n in pending.items():
+                    self._pending[ad_id] = self._pending.get(ad_id, 0) + n
+                self._exhausted |= exhausted
+            raise
+        n = sum(pending.values())
+        self.stats["flushed"] += n
+        return n
+
+    def start(self):
+        if self._thread is None:
+            self._listener = self.store.listen("ads/published", self._on_event)
+            self.rebuild()
+            self._thread = threading.Thread(target=self._run, name="adserver", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Ad impression flush failed, will retry: %s", e)
+            self.rebuild()
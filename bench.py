@@ -0,0 +1,345 @@
+"""
+bench.py
+Offline benchmark: replays a synthetic update stream through every handler.
+
+Updates (/start with and without a referral payload, keyboard presses,
+commands, task_open / task_done / page callbacks, complete advertise flows)
+go through bot.process_new_updates against the in-process memory storage
+(or a throwaway SQLite file) and fake_telegram answering the Bot API in
+process. Reported per handler: calls, p50/p95/p99 latency, storage round
+trips and queued sends per call; plus overall throughput.
+
+    python bench.py                           # 20000 updates, memory storage
+    python bench.py --save baseline.json      # keep the numbers
+    python bench.py --compare baseline.json   # exit 1 on a regression
+    python bench.py --storage sqlite --dispatcher
+
+Storage round trips are counted at the Storage method level (outermost call
+only), which is what a network round trip costs against Firebase.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+# The numbers a regression check looks at, and how much worse they may get
+LATENCY_TOLERANCE = 0.25      # relative p95 increase
+LATENCY_FLOOR_MS = 0.2        # ignore p95 moves smaller than this
+DB_TOLERANCE = 0.05           # absolute increase in storage calls per handler call
+
+KEYBOARD = ["💰 Balance", "🙌 Referrals", "ℹ️ Info", "💻 Visit Sites", "📣 Join Channels",
+            "🤖 Join Bots", "😄 More", "hello"]
+
+# update kind -> share of the stream
+MIX = {
+    "start_ref": 10, "start": 4, "keyboard": 30, "tasks": 6, "leaderboard": 4, "balance": 4,
+    "task_open": 14, "task_done": 14, "tasks_page": 6, "ad_flow": 3,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay synthetic updates through the bot's handlers")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=2000, help="distinct users in the stream")
+    parser.add_argument("--tasks", type=int, default=40, help="extra tasks added to the catalog")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--dispatcher", action="store_true",
+                        help="feed updates through the lane dispatcher instead of one by one")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a saved baseline")
+    parser.add_argument("--output", metavar="FILE", help="also write the report to FILE")
+    return parser.parse_args(argv)
+
+
+# ------------------ Synthetic updates ------------------
+
+class Stream:
+    def __init__(self, rng, users, task_ids):
+        self.rng = rng
+        self.users = users
+        self.task_ids = task_ids
+        self.known = []             # users that already sent /start
+        self.ids = iter(range(1, 10 ** 9))
+
+    def _from(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def message(self, uid, text):
+        msg = {"message_id": next(self.ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self._from(uid), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self.ids), "message": msg}
+
+    def callback(self, uid, data):
+        return {"update_id": next(self.ids), "callback_query": {
+            "id": str(next(self.ids)), "chat_instance": "bench", "data": data, "from": self._from(uid),
+            "message": {"message_id": next(self.ids), "date": int(time.time()),
+                        "chat": {"id": uid, "type": "private"}, "text": "tasks"}}}
+
+    def _new_user(self):
+        if len(self.known) >= self.users:
+            return self.rng.choice(self.known)
+        uid = 100000 + len(self.known)
+        self.known.append(uid)
+        return uid
+
+    def _user(self):
+        return self.rng.choice(self.known) if self.known else self._new_user()
+
+    def make(self, kind):
+        """Updates for one event of kind (a list: ad flows are three messages)."""
+        rng = self.rng
+        if kind == "start_ref" and self.known:
+            referrer = rng.choice(self.known)
+            return [self.message(self._new_user(), f"/start {referrer}")]
+        if kind in ("start", "start_ref"):
+            return [self.message(self._new_user(), "/start")]
+        uid = self._user()
+        if kind == "keyboard":
+            return [self.message(uid, rng.choice(KEYBOARD))]
+        if kind == "tasks":
+            return [self.message(uid, "/tasks")]
+        if kind == "leaderboard":
+            return [self.message(uid, "/leaderboard")]
+        if kind == "balance":
+            return [self.message(uid, "/balance")]
+        if kind == "task_open":
+            return [self.callback(uid, f"task_open:{rng.choice(self.task_ids)}")]
+        if kind == "task_done":
+            return [self.callback(uid, f"task_done:{rng.choice(self.task_ids)}")]
+        if kind == "tasks_page":
+            return [self.callback(uid, f"tasks_page:all:{rng.randrange(3)}")]
+        if kind == "ad_flow":
+            return [self.message(uid, "📊 Advertise"),
+                    self.message(uid, f"Bench ad {next(self.ids)}: visit our channel"),
+                    self.message(uid, rng.choice(["confirm", "confirm", "cancel"]))]
+        raise ValueError(kind)
+
+
+def generate(n, users, task_ids, seed):
+    rng = random.Random(seed)
+    stream = Stream(rng, users, task_ids)
+    kinds = list(MIX)
+    weights = [MIX[k] for k in kinds]
+    out = []
+    while len(out) < n:
+        out.extend(stream.make(rng.choices(kinds, weights)[0]))
+    return out[:n]
+
+
+# ------------------ Instrumentation ------------------
+
+class Recorder:
+    """Per-handler latencies plus storage calls and sends made inside them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latency = defaultdict(list)
+        self.db = defaultdict(int)
+        self.sends = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def current(self):
+        return getattr(self.local, "handler", None) or "(background)"
+
+    def wrap_handler(self, fn):
+        name = fn.__name__
+
+        def timed(*args, **kwargs):
+            self.local.handler = name
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.errors[name] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self.local.handler = None
+                with self.lock:
+                    self.latency[name].append(elapsed)
+        timed.__name__ = name
+        return timed
+
+    def wrap_counted(self, fn, counter):
+        def counted(*args, **kwargs):
+            depth = getattr(self.local, "depth", 0)
+            if depth == 0:
+                with self.lock:
+                    counter[self.current()] += 1
+            self.local.depth = depth + 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.depth = depth
+        return counted
+
+
+STORAGE_METHODS = ("get", "set", "update", "page", "transaction", "count", "get_user", "top_users",
+                   "get_tasks", "get_ad")
+
+def instrument(core, recorder):
+    for handlers in (core.bot.message_handlers, core.bot.callback_query_handlers):
+        for handler in handlers:
+            handler["function"] = recorder.wrap_handler(handler["function"])
+    for name in STORAGE_METHODS:
+        setattr(core.store, name, recorder.wrap_counted(getattr(core.store, name), recorder.db))
+    core.outbox.submit = recorder.wrap_counted(core.outbox.submit, recorder.sends)
+
+
+# ------------------ Report ------------------
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+def summarize(recorder, n_updates, elapsed):
+    handlers = {}
+    for name, values in recorder.latency.items():
+        values = sorted(values)
+        calls = len(values)
+        handlers[name] = {
+            "calls": calls,
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "db_per_call": round(recorder.db.get(name, 0) / calls, 3),
+            "sends_per_call": round(recorder.sends.get(name, 0) / calls, 3),
+            "errors": recorder.errors.get(name, 0),
+        }
+    return {"updates": n_updates, "seconds": round(elapsed, 3),
+            "updates_per_sec": round(n_updates / elapsed, 1) if elapsed else 0.0,
+            "background_db_calls": recorder.db.get("(background)", 0),
+            "handlers": handlers}
+
+def format_report(result):
+    lines = [f"{result['updates']} updates in {result['seconds']}s: "
+             f"{result['updates_per_sec']} updates/s "
+             f"({result['background_db_calls']} background storage calls)", "",
+             f"{'handler':<24}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db/call':>9}{'sends':>7}{'err':>5}"]
+    for name, h in sorted(result["handlers"].items(), key=lambda kv: -kv[1]["calls"]):
+        lines.append(f"{name:<24}{h['calls']:>7}{h['p50_ms']:>9.3f}{h['p95_ms']:>9.3f}{h['p99_ms']:>9.3f}"
+                     f"{h['db_per_call']:>9.2f}{h['sends_per_call']:>7.2f}{h['errors']:>5}")
+    return "\n".join(lines)
+
+def compare(result, baseline):
+    """Regressions of result against baseline, as printable lines."""
+    problems = []
+    for name, base in baseline.get("handlers", {}).items():
+        now = result["handlers"].get(name)
+        if not now:
+            continue
+        if (now["p95_ms"] > base["p95_ms"] * (1 + LATENCY_TOLERANCE)
+                and now["p95_ms"] - base["p95_ms"] > LATENCY_FLOOR_MS):
+            problems.append(f"{name}: p95 {base['p95_ms']:.3f} -> {now['p95_ms']:.3f} ms")
+        if now["db_per_call"] > base["db_per_call"] + DB_TOLERANCE:
+            problems.append(f"{name}: storage calls/call {base['db_per_call']:.2f} -> {now['db_per_call']:.2f}")
+        if now["errors"] > base.get("errors", 0):
+            problems.append(f"{name}: {now['errors']} errors (baseline {base.get('errors', 0)})")
+    base_ups = baseline.get("updates_per_sec") or 0
+    if base_ups and result["updates_per_sec"] < base_ups * (1 - LATENCY_TOLERANCE):
+        problems.append(f"throughput {base_ups} -> {result['updates_per_sec']} updates/s")
+    return problems
+
+
+# ------------------ Run ------------------
+
+def setup_environment(args):
+    """Point the bot at local storage and the in-process fake Bot API; returns the bot module."""
+    os.environ["STORAGE_BACKEND"] = args.storage
+    if args.storage == "sqlite":
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+    os.environ.pop("CONVERSATION_FILE", None)
+    os.environ["LEDGER_JOURNAL"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "ledger.journal")
+    # synthetic users tap far faster than real ones; measure the handlers, not the limiter
+    os.environ["ADMISSION_ENABLED"] = "0"
+
+    from telebot import apihelper
+    import fake_telegram
+    fake = fake_telegram.FakeTelegram()
+    apihelper.CUSTOM_REQUEST_SENDER = fake_telegram.request_sender(fake)
+
+    import referral_tasks_bot as core
+    from outbox import Outbox, bot_transport
+    # the fake answers instantly; do not hold sends back at Telegram's rates
+    core.outbox = core.broadcaster.outbox = Outbox(bot_transport(core.bot), global_rate=1e6,
+                                                   chat_rate=1e6, chat_burst=1e6)
+    core.logger.setLevel("WARNING")
+    return core, fake
+
+def seed_tasks(core, n):
+    types_ = [("visit", core.POINTS_VISIT), ("join_channel", core.POINTS_JOIN_CHANNEL),
+              ("join_bot", core.POINTS_JOIN_BOT), ("other", core.POINTS_OTHER)]
+    changes = {}
+    for i in range(n):
+        kind, points = types_[i % len(types_)]
+        changes[f"tasks/bench{i:03d}"] = {
+            "type": kind, "title": f"Bench task {i}", "description": "Synthetic task for the benchmark.",
+            "url": "https://example.com", "channel_username": f"@bench_channel_{i % 5}",
+            "bot_username": "@SomeOtherBot", "points": points, "available": True}
+    core.store.update(changes)
+
+def run(args):
+    core, fake = setup_environment(args)
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    core.seed_sample_tasks()
+    seed_tasks(core, args.tasks)
+    core.startup()
+    from telebot import types
+    task_ids = list(core.available_tasks())
+    updates = [types.Update.de_json(u) for u in generate(args.updates, args.users, task_ids, args.seed)]
+
+    recorder = Recorder()
+    instrument(core, recorder)
+    start = time.perf_counter()
+    if args.dispatcher:
+        core.dispatcher.start()
+        for update in updates:
+            while not core.dispatcher.submit(update):
+                time.sleep(0.001)
+        while core.dispatcher.queued():
+            time.sleep(0.001)
+        core.dispatcher.stop()
+    else:
+        for update in updates:
+            core.bot.process_new_updates([update])
+    elapsed = time.perf_counter() - start
+    core.outbox.flush(30)
+    return summarize(recorder, len(updates), elapsed)
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(args)
+    result["config"] = {k: getattr(args, k) for k in ("updates", "users", "tasks", "seed", "storage", "dispatcher")}
+    report = format_report(result)
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        problems = compare(result, baseline)
+        report += "\n\n" + ("Regressions against " + args.compare + ":\n  " + "\n  ".join(problems)
+                            if problems else f"No regressions against {args.compare}.")
+        status = 1 if problems else 0
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
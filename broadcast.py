@@ -0,0 +1,199 @@
+"""
+broadcast.py
+Delivers published ads to users.
+
+A Broadcaster walks the users tree in key order, one page at a time, and
+sends the ad to each user through the outbox at bulk priority, so it runs as
+fast as Telegram's limits allow while interactive replies still go first.
+After every page it checkpoints broadcasts/<ad_id> (cursor and counters) in
+the same write that flags users who blocked the bot (users/<uid>/blocked) and
+adds the page's deliveries to ads/published/<ad_id>/displays (on_blocked
+then lets the bot drop the flagged users from its caches). A restart
+resumes from the last checkpoint; at most one page is sent twice. Sends
+whose result has not come back page_timeout seconds after the page was
+queued count as failed.
+
+Each ad is paid for ad["cost"] displays (1 pt each), of which a broadcast
+sends at most budget_share. Impressions served by the AdServer (adserver.py)
+draw on the same budget, so what is left (cost minus displays) is read again
+before every page.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+from outbox import BULK
+from storage import increment
+
+logger = logging.getLogger(__name__)
+
+
+def _blocked_error(ex):
+    # 403: "bot was blocked by the user", "user is deactivated", ...
+    return getattr(ex, "error_code", None) == 403
+
+
+class Broadcaster:
+    def __init__(self, store, outbox, render, page_size=100, budget_share=1.0, on_finished=None,
+                 on_blocked=None, page_timeout=300):
+        self.store = store
+        self.outbox = outbox
+        self.render = render                # ad -> message text
+        self.page_size = page_size
+        self.page_timeout = page_timeout    # seconds a page may wait for its send results
+        self.budget_share = budget_share    # part of ad["cost"] a broadcast may spend
+        self.on_finished = on_finished      # (ad_id, ad, state) once an ad is done
+        self.on_blocked = on_blocked        # (uids) after they were flagged as blocked
+        self.progress = {}                  # ad_id -> live numbers of the current run
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, ad_id):
+        with self._lock:
+            if ad_id in self._queued:
+                return False
+            self._queued.add(ad_id)
+        self._queue.put(ad_id)
+        return True
+
+    def resume(self):
+        """Queue every broadcast that has not finished; returns how many."""
+        n = 0
+        for ad_id, state in (self.store.get("broadcasts") or {}).items():
+            if isinstance(state, dict) and not state.get("finished"):
+                n += self.enqueue(ad_id)
+        return n
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            ad_id = self._queue.get()
+            try:
+                self.run(ad_id)
+            except Exception:
+                logger.exception("Broadcast of %s failed; it resumes on the next start", ad_id)
+            finally:
+                self.progress.pop(ad_id, None)
+                with self._lock:
+                    self._queued.discard(ad_id)
+
+    # ---- one ad ----
+
+    def run(self, ad_id):
+        ad = self.store.get_ad("published", ad_id)
+        if not ad:
+            logger.info("Ad %s is not published; nothing to send", ad_id)
+            return
+        state = self.store.get(f"broadcasts/{ad_id}") or {}
+        if state.get("finished"):
+            return
+        if not state:
+            state = {"cursor": None, "scanned": 0, "sent": 0, "blocked": 0, "failed": 0,
+                     "budget": int((ad.get("cost", 0) or 0) * self.budget_share), "started": int(time.time())}
+            self.store.set(f"broadcasts/{ad_id}", state)
+        live = self.progress[ad_id] = {"since": time.monotonic(), "sent": 0,
+                                       "users": self.store.count("users")}
+        text = self.render(ad)
+        owner = str(ad.get("owner", ""))
+        while state["sent"] < state["budget"]:
+            left = min(state["budget"] - state["sent"], self._budget_left(ad_id))
+            if left <= 0:
+                break
+            page = self.store.page("users", start_after=state.get("cursor"), limit=self.page_size)
+            if not page:
+                break
+            targets = []
+            for uid, user in page:
+                if len(targets) >= left:
+                    break
+                state["scanned"] += 1
+                state["cursor"] = uid
+                if uid == owner or not isinstance(user, dict) or user.get("blocked"):
+                    continue
+                targets.append(uid)
+            results = self._send_page(targets, text)
+            blocked = [uid for uid, ex in results.items() if ex is not None and _blocked_error(ex)]
+            sent = sum(1 for ex in results.values() if ex is None)
+            state["sent"] += sent
+            state["blocked"] += len(blocked)
+            state["failed"] += len(results) - sent - len(blocked)
+            live["sent"] += sent
+            changes = {f"broadcasts/{ad_id}/{k}": state[k] for k in ("cursor", "scanned", "sent", "blocked", "failed")}
+            changes.update({f"users/{uid}/blocked": True for uid in blocked})
+            if sent:
+                changes[f"ads/published/{ad_id}/displays"] = increment(sent)
+            self.store.update(changes)
+            if blocked and self.on_blocked:
+                self.on_blocked(blocked)
+            if len(page) < self.page_size:
+                break
+        state["finished"] = int(time.time())
+        self.store.set(f"broadcasts/{ad_id}/finished", state["finished"])
+        logger.info("Broadcast of %s finished: %s sent, %s blocked", ad_id, state["sent"], state["blocked"])
+        if self.on_finished:
+            self.on_finished(ad_id, ad, state)
+
+    def _budget_left(self, ad_id):
+        ad = self.store.get_ad("published", ad_id) or {}
+        return int(ad.get("cost", 0) or 0) - int(ad.get("displays", 0) or 0)
+
+    def _send_page(self, targets, text):
+        """Send text to every uid in targets; returns {uid: exception or None}."""
+        results = {}
+        done = threading.Event()
+        lock = threading.Lock()
+        if not targets:
+            return results
+
+        def finished(uid):
+            def callback(result, ex):
+                with lock:
+                    results[uid] = ex
+                    if len(results) == len(targets):
+                        done.set()
+            return callback
+
+        for uid in targets:
+            while not self.outbox.submit("send_message", int(uid), {"chat_id": int(uid), "text": text},
+                                         BULK, callback=finished(uid)):
+                time.sleep(1)       # outbox full; wait for it to drain
+        if not done.wait(self.page_timeout):
+            logger.warning("Broadcast page timed out waiting for send results")
+        with lock:
+            return {uid: results.get(uid, TimeoutError("no send result")) for uid in targets}
+
+    # ---- reporting ----
+
+    def report(self):
+        """One line per broadcast: progress, and throughput/ETA for running ones."""
+        lines = []
+        for ad_id, state in sorted((self.store.get("broadcasts") or {}).items()):
+            if not isinstance(state, dict):
+                continue
+            line = (f"{ad_id}: {state.get('sent', 0)}/{state.get('budget', 0)} sent, "
+                    f"{state.get('blocked', 0)} blocked, {state.get('failed', 0)} failed")
+            live = self.progress.get(ad_id)
+            if state.get("finished"):
+                line += " — done"
+            elif live:
+                elapsed = time.monotonic() - live["since"]
+                rate = live["sent"] / elapsed if elapsed > 0 else 0.0
+                left = min(state.get("budget", 0) - state.get("sent", 0),
+                           max(live["users"] - state.get("scanned", 0), 0))
+                eta = f"{left / rate / 60:.1f} min" if rate else "?"
+                line += f" — {rate:.1f} msg/s, ETA {eta}"
+            elif ad_id in self._queued:
+                line += " — queued"
+            else:
+                line += " — paused"
+            lines.append(line)
+        return "\n".join(lines)
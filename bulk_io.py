@@ -0,0 +1,213 @@
+"""
+bulk_io.py
+Bulk task import and streaming export.
+
+Import: a JSON or CSV file of tasks is validated as a whole and applied as
+one multi-path update (all or nothing). JSON is either {task_id: task} or a
+list of tasks with an "id"; CSV has a header row with the columns
+id,type,title,points,description,link (link is the url, channel or bot
+username, as in /addtask), optionally available.
+
+Export: walks users/, completions/ (or any node) in key order one page at a
+time and writes gzip'd JSON lines {"key": ..., "value": ...}, so memory is
+bounded by the page size. After every page the file is closed as a complete
+gzip member and <output>.cursor records the last key and the file size; an
+interrupted export started again with --resume cuts the file back to that
+size and carries on after that key.
+
+    python bulk_io.py import-tasks tasks.csv [--dry-run]
+    python bulk_io.py export users users.jsonl.gz [--resume] [--page-size 500]
+"""
+
+import io
+import os
+import csv
+import sys
+import json
+import gzip
+import argparse
+
+TASK_TYPES = ("visit", "join_channel", "join_bot", "other")
+LINK_FIELDS = {"visit": "url", "other": "url", "join_channel": "channel_username", "join_bot": "bot_username"}
+MAX_TASKS = 5000
+MAX_ERRORS = 10
+FORBIDDEN_KEY_CHARS = set(".$#[]/:")
+# task ids end up in the listing buttons' callback_data, which Telegram caps
+# at 64 bytes
+CALLBACK_PREFIXES = ("task_open:", "task_done:")
+CALLBACK_DATA_MAX = 64
+TASK_ID_MAX = CALLBACK_DATA_MAX - max(len(p.encode()) for p in CALLBACK_PREFIXES)
+
+
+# ------------------ Import ------------------
+
+def _rows(data, filename):
+    """Raw task rows as [(id, dict)] from JSON or CSV bytes."""
+    text = data.decode("utf-8-sig") if isinstance(data, bytes) else data
+    if filename.lower().endswith(".csv"):
+        return [(row.get("id"), row) for row in csv.DictReader(io.StringIO(text))]
+    try:
+        doc = json.loads(text)
+    except ValueError as e:
+        raise ValueError(f"Not valid JSON: {e}")
+    if isinstance(doc, dict):
+        return list(doc.items())
+    if isinstance(doc, list):
+        return [(row.get("id") if isinstance(row, dict) else None, row) for row in doc]
+    raise ValueError("JSON must be an object {task_id: task} or a list of tasks")
+
+def _task(row):
+    """A task dict in the catalog's shape, or raises ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError("not an object")
+    ttype = str(row.get("type") or "").strip()
+    if ttype not in TASK_TYPES:
+        raise ValueError(f"type must be one of {', '.join(TASK_TYPES)}")
+    title = str(row.get("title") or "").strip()
+    if not title:
+        raise ValueError("title is missing")
+    try:
+        points = int(str(row.get("points")).strip())
+    except ValueError:
+        raise ValueError(f"points must be a whole number, not {row.get('points')!r}")
+    if points < 0:
+        raise ValueError("points must not be negative")
+    link_field = LINK_FIELDS[ttype]
+    link = str(row.get("link") or row.get(link_field) or "").strip()
+    if not link:
+        raise ValueError(f"{ttype} tasks need a link ({link_field})")
+    available = row.get("available", True)
+    if isinstance(available, str):
+        available = available.strip().lower() not in ("0", "false", "no", "")
+    return {
+        "type": ttype,
+        "title": title,
+        "description": str(row.get("description") or "").strip(),
+        "points": points,
+        "available": bool(available),
+        link_field: link,
+    }
+
+def parse_tasks(data, filename):
+    """{task_id: task} from a JSON or CSV document. Raises ValueError listing
+    the problems if any row is invalid, so nothing is half imported."""
+    tasks, errors = {}, []
+    rows = _rows(data, filename)
+    if len(rows) > MAX_TASKS:
+        raise ValueError(f"{len(rows)} tasks; at most {MAX_TASKS} per import")
+    for n, (tid, row) in enumerate(rows, start=1):
+        tid = str(tid or "").strip()
+        where = f"row {n}" + (f" ({tid})" if tid else "")
+        if not tid or FORBIDDEN_KEY_CHARS & set(tid):
+            errors.append(f"{where}: id is missing or contains one of . $ # [ ] / :")
+            continue
+        if len(tid.encode()) > TASK_ID_MAX:
+            errors.append(f"{where}: id is longer than {TASK_ID_MAX} bytes")
+            continue
+        if tid in tasks:
+            errors.append(f"{where}: duplicate id")
+            continue
+        try:
+            tasks[tid] = _task(row)
+        except ValueError as e:
+            errors.append(f"{where}: {e}")
+    if errors:
+        more = f"\n... and {len(errors) - MAX_ERRORS} more" if len(errors) > MAX_ERRORS else ""
+        raise ValueError("\n".join(errors[:MAX_ERRORS]) + more)
+    if not tasks:
+        raise ValueError("no tasks in the file")
+    return tasks
+
+def import_tasks(store, tasks):
+    """Write every task in one multi-path update."""
+    store.update({f"tasks/{tid}": task for tid, task in tasks.items()})
+    return len(tasks)
+
+
+# ------------------ Export ------------------
+
+def _load_cursor(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _save_cursor(path, cursor):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cursor, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def export(store, node, output, page_size=500, resume=False, progress=None):
+    """Stream node's children to output as gzip'd JSONL; returns the number
+    of records written (in total, across resumed runs)."""
+    cursor_path = output + ".cursor"
+    cursor = _load_cursor(cursor_path) if resume else None
+    if cursor and cursor.get("node") != node:
+        raise ValueError(f"{cursor_path} belongs to an export of {cursor.get('node')}")
+    if cursor:
+        with open(output, "r+b") as f:
+            f.truncate(cursor["size"])      # drop a page written after the last checkpoint
+    else:
+        cursor = {"node": node, "last_key": None, "count": 0, "size": 0, "done": False}
+        open(output, "wb").close()
+    while not cursor["done"]:
+        page = store.page(node, start_after=cursor["last_key"], limit=page_size)
+        if page:
+            with open(output, "ab") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                    for key, value in page:
+                        gz.write((json.dumps({"key": key, "value": value}, separators=(",", ":")) + "\n").encode())
+                raw.flush()
+                os.fsync(raw.fileno())
+                cursor["size"] = raw.tell()
+            cursor["last_key"] = page[-1][0]
+            cursor["count"] += len(page)
+        cursor["done"] = len(page) < page_size
+        _save_cursor(cursor_path, cursor)
+        if progress:
+            progress(cursor)
+    return cursor["count"]
+
+
+# ------------------ CLI ------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import-tasks", help="validate a JSON/CSV file of tasks and write them in one update")
+    imp.add_argument("file")
+    imp.add_argument("--dry-run", action="store_true", help="only validate")
+    exp = sub.add_parser("export", help="stream a node (users, completions, ...) to gzip'd JSONL")
+    exp.add_argument("node")
+    exp.add_argument("output")
+    exp.add_argument("--page-size", type=int, default=500)
+    exp.add_argument("--resume", action="store_true", help="continue an interrupted export of the same file")
+    args = parser.parse_args(argv)
+
+    if args.command == "import-tasks":
+        with open(args.file, "rb") as f:
+            try:
+                tasks = parse_tasks(f.read(), args.file)
+            except ValueError as e:
+                print(f"Invalid task file:\n{e}", file=sys.stderr)
+                return 1
+        if args.dry_run:
+            print(f"{len(tasks)} tasks are valid")
+            return 0
+    # storage settings (backend, paths, credentials) come from the bot's config
+    from referral_tasks_bot import store
+    if args.command == "import-tasks":
+        print(f"Imported {import_tasks(store, tasks)} tasks")
+    else:
+        n = export(store, args.node, args.output, args.page_size, args.resume,
+                   progress=lambda c: print(f"\r{c['count']} records", end="", file=sys.stderr))
+        print(f"\nExported {n} records of {args.node} to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+conversations.py
+Per-user state of multi-step flows (the advertise flow), kept in process.
+
+A ConversationStore maps a user id to (step, data). Entries expire ttl
+seconds after they were last set and the store holds at most max_size of
+them, dropping the oldest first, so abandoned flows cannot pile up. With a
+path, the states are also snapshotted to a local JSON file (at most every
+flush_interval seconds, and at exit) and read back on start, so a restart
+does not lose flows in progress.
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore:
+    def __init__(self, ttl=900, max_size=10000, path=None, flush_interval=1.0):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.flush_interval = flush_interval
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._states = OrderedDict()    # uid -> (expires_at, step, data), oldest first
+        self._dirty = False
+        if path:
+            self._load()
+            threading.Thread(target=self._run, name="conversations", daemon=True).start()
+            atexit.register(self.flush)
+
+    def get(self, uid):
+        """(step, data) of uid's flow, or None."""
+        uid = str(uid)
+        with self._lock:
+            entry = self._states.get(uid)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._states[uid]
+                self._dirty = True
+                return None
+            return entry[1], entry[2]
+
+    def set(self, uid, step, data=None):
+        uid = str(uid)
+        now = time.time()
+        with self._lock:
+            self._states.pop(uid, None)
+            self._states[uid] = (now + self.ttl, step, data or {})
+            # entries are ordered by expiry, so expired ones sit at the front
+            while self._states:
+                oldest = next(iter(self._states.values()))
+                if oldest[0] > now and len(self._states) <= self.max_size:
+                    break
+                if oldest[0] > now:
+                    self.evictions += 1
+                self._states.popitem(last=False)
+            self._dirty = True
+
+    def pop(self, uid):
+        """Remove and return uid's (step, data), or None."""
+        state = self.get(uid)
+        if state is not None:
+            with self._lock:
+                self._states.pop(str(uid), None)
+                self._dirty = True
+        return state
+
+    def __len__(self):
+        return len(self._states)
+
+    # ---- file snapshot ----
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring conversation file %s: %s", self.path, e)
+            return
+        now = time.time()
+        for uid, (expires, step, data) in sorted(saved.items(), key=lambda kv: kv[1][0]):
+            if expires > now:
+                self._states[uid] = (expires, step, data)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = dict(self._states)
+            self._dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning("Could not save conversations: %s", e)
@@ -0,0 +1,200 @@
+"""
+fake_telegram.py
+A local stand-in for the Telegram Bot API, for running the bot offline.
+
+It answers the Bot API methods the bot uses (getMe, sendMessage,
+answerCallbackQuery, getChatMember, ...), records every call, and feeds
+updates to the bot either through getUpdates (polling mode) or by POSTing
+them to the registered webhook (webhook mode).
+
+    python fake_telegram.py --port 8081
+    TELEGRAM_API_URL=http://127.0.0.1:8081 STORAGE_BACKEND=memory python webhook_bot.py
+
+In-process use: apihelper.CUSTOM_REQUEST_SENDER = request_sender(FakeTelegram())
+
+Control endpoints:
+    POST /fake/update   queue one update (JSON body) for the bot
+    POST /fake/block    {"chat_id": ...}: that chat blocked the bot (sends get 403)
+    GET  /fake/calls    recorded Bot API calls as JSON
+"""
+
+import json
+import time
+import queue
+import argparse
+import itertools
+import threading
+import urllib.request
+from urllib.parse import parse_qs, urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeTelegram:
+    """Bot API state shared by the HTTP server (and usable in-process)."""
+
+    def __init__(self, bot_username="FakeClickStarBot"):
+        self.bot_username = bot_username
+        self.lock = threading.Lock()
+        self.calls = []                 # [(method, params)]
+        self.member_status = {}         # channel -> status returned by getChatMember
+        self.blocked = set()            # chat ids (str) that blocked the bot: sends get 403
+        self.updates = queue.Queue()    # for getUpdates
+        self.webhook_url = None
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+
+    def call(self, method, params):
+        """Handle one Bot API call; returns the response payload."""
+        with self.lock:
+            self.calls.append((method, params))
+        handler = getattr(self, "_" + method, None)
+        if handler is None:
+            return {"ok": True, "result": True}
+        return handler(params)
+
+    def _ok(self, result):
+        return {"ok": True, "result": result}
+
+    def _getMe(self, params):
+        return self._ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": self.bot_username})
+
+    def _message(self, params):
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        return self._ok({"message_id": next(self._message_ids), "date": int(time.time()),
+                         "chat": {"id": chat_id, "type": "private"},
+                         "text": params.get("text", "")})
+
+    def _sendMessage(self, params):
+        if str(params.get("chat_id", "")) in self.blocked:
+            return {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        return self._message(params)
+
+    _editMessageText = _message
+
+    def block(self, chat_id):
+        self.blocked.add(str(chat_id))
+
+    def _getChatMember(self, params):
+        status = self.member_status.get(str(params.get("chat_id", "")).lstrip("@"), "member")
+        return self._ok({"status": status,
+                         "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"}})
+
+    def _setWebhook(self, params):
+        self.webhook_url = params.get("url") or None
+        return self._ok(True)
+
+    def _deleteWebhook(self, params):
+        self.webhook_url = None
+        return self._ok(True)
+
+    def _getUpdates(self, params):
+        timeout = min(float(params.get("timeout", 0) or 0), 1.0)
+        limit = int(params.get("limit", 100) or 100)
+        out = []
+        try:
+            out.append(self.updates.get(timeout=timeout) if timeout else self.updates.get_nowait())
+            while len(out) < limit:
+                out.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return self._ok(out)
+
+    def push_update(self, update):
+        """Deliver an update: POST it to the webhook if one is set, else queue it."""
+        update = dict(update)
+        update.setdefault("update_id", next(self._update_ids))
+        if self.webhook_url:
+            req = urllib.request.Request(self.webhook_url, data=json.dumps(update).encode(),
+                                         headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(req, timeout=10).read()
+        else:
+            self.updates.put(update)
+        return update["update_id"]
+
+    def counts(self):
+        with self.lock:
+            out = {}
+            for method, _ in self.calls:
+                out[method] = out.get(method, 0) + 1
+            return out
+
+
+class _Response:
+    def __init__(self, payload):
+        self._payload = payload
+        self.status_code = 200 if payload.get("ok") else payload.get("error_code", 400)
+        self.reason = "OK" if payload.get("ok") else payload.get("description", "")
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+
+def request_sender(fake):
+    """A telebot apihelper.CUSTOM_REQUEST_SENDER answering from fake in-process,
+    without HTTP (used by bench.py)."""
+    def send(method, url, params=None, **kwargs):
+        return _Response(fake.call(url.rsplit("/", 1)[1], dict(params or {})))
+    return send
+
+
+def _parse_params(handler):
+    params = {k: v[-1] for k, v in parse_qs(urlparse(handler.path).query).items()}
+    length = int(handler.headers.get("Content-Length") or 0)
+    body = handler.rfile.read(length) if length else b""
+    ctype = handler.headers.get("Content-Type", "")
+    if body and "json" in ctype:
+        params.update(json.loads(body))
+    elif body and "x-www-form-urlencoded" in ctype:
+        params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+    return params, body
+
+
+def make_server(fake, host="127.0.0.1", port=8081):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, payload, status=200):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self):
+            path = urlparse(self.path).path
+            params, body = _parse_params(self)
+            if path == "/fake/update":
+                self._reply({"update_id": fake.push_update(json.loads(body))})
+            elif path == "/fake/block":
+                fake.block(json.loads(body)["chat_id"])
+                self._reply({"ok": True})
+            elif path == "/fake/calls":
+                with fake.lock:
+                    self._reply(fake.calls)
+            elif path.startswith("/bot") and path.count("/") == 2:
+                payload = fake.call(path.rsplit("/", 1)[1], params)
+                self._reply(payload, 200 if payload.get("ok") else payload.get("error_code", 400))
+            else:
+                self._reply({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    server = make_server(FakeTelegram(), args.host, args.port)
+    print(f"Fake Telegram Bot API on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,226 @@
+"""
+ledger.py
+Write-behind journal for counter deltas (points, referrals, /stats).
+
+record() appends the deltas to a local append-only journal and returns once
+they are fsync'd; concurrent callers share one fsync (group commit). The
+deltas are summed in memory and flush() sends them to the database as one
+multi-path update of server-side increments, together with the journal's
+last applied sequence number (ledger/applied/<writer>). On start the journal
+is replayed: records newer than that number are flushed again, older ones
+were already applied, so balances stay exact across crashes.
+
+Journal lines are JSON: {"seq": n, "changes": {path: delta}}.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from storage import increment
+
+logger = logging.getLogger(__name__)
+
+
+class PointLedger:
+    def __init__(self, store, path, writer="main", flush_interval=1.0, compact_bytes=1 << 20):
+        self.store = store
+        self.path = path
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self.on_flush = None                # (paths) after they reached the database
+        self.stats = {"records": 0, "fsyncs": 0, "flushes": 0, "flushed_paths": 0, "errors": 0}
+        self._lock = threading.Lock()       # seq, buffer, pending
+        self._io_lock = threading.Lock()    # the journal file
+        self._flush_lock = threading.Lock()
+        self._seq = 0
+        self._synced = 0
+        self._flushed = 0
+        self._buffer = []                   # journal lines not yet written
+        self._pending = {}                  # path -> summed delta not yet in the database
+        self._unconfirmed = None            # (batch, seq) of a flush whose outcome is unknown
+        self._file = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._file is not None
+
+    @property
+    def marker(self):
+        return f"ledger/applied/{self.writer}"
+
+    # ---- journal ----
+
+    def open(self):
+        """Replay the journal; deltas the database has not seen become pending again."""
+        applied = int(self.store.get(self.marker) or 0)
+        replayed = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break           # torn last line from a crash mid-write
+                    self._seq = max(self._seq, rec["seq"])
+                    if rec["seq"] > applied:
+                        self._merge(self._pending, rec["changes"])
+                        replayed += 1
+        self._seq = max(self._seq, applied)
+        self._synced = self._flushed = self._seq
+        self._file = open(self.path, "a")
+        if replayed:
+            logger.info("Ledger: replaying %d journal records after seq %d", replayed, applied)
+        return replayed
+
+    def record(self, deltas):
+        """Journal {path: delta}; returns its sequence number once it is on disk."""
+        deltas = {p: d for p, d in deltas.items() if d}
+        if not deltas:
+            return self._seq
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._buffer.append(json.dumps({"seq": seq, "changes": deltas}, separators=(",", ":")) + "\n")
+            self._merge(self._pending, deltas)
+            self.stats["records"] += 1
+        with self._io_lock:
+            if self._synced >= seq:
+                return seq          # an earlier caller's fsync covered this record
+            with self._lock:
+                lines, upto = self._buffer, self._seq
+                self._buffer = []
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._synced = upto
+            self.stats["fsyncs"] += 1
+        return seq
+
+    @staticmethod
+    def _merge(into, deltas):
+        for path, delta in deltas.items():
+            total = into.get(path, 0) + delta
+            if total:
+                into[path] = total
+            else:
+                into.pop(path, None)
+
+    def pending(self, prefix):
+        """Deltas under prefix/ the database does not have yet, as {subpath: delta}."""
+        prefix = prefix.rstrip("/") + "/"
+        out = {}
+        with self._lock:
+            sources = [self._pending] + ([self._unconfirmed[0]] if self._unconfirmed else [])
+            for source in sources:
+                for path, delta in source.items():
+                    if path.startswith(prefix):
+                        key = path[len(prefix):]
+                        out[key] = out.get(key, 0) + delta
+        return out
+
+    def read(self, prefix, fetch):
+        """fetch() (a record under prefix) with the pending deltas added to its
+        fields; no flush can land in between."""
+        with self._flush_lock:
+            record = fetch()
+            if record:
+                for field, delta in self.pending(prefix).items():
+                    record[field] = (record.get(field, 0) or 0) + delta
+        return record
+
+    def backlog(self):
+        with self._lock:
+            return len(self._pending)
+
+    # ---- flushing ----
+
+    def flush(self):
+        """Send pending deltas as one multi-path update; returns the paths written."""
+        with self._flush_lock:
+            if self._unconfirmed and not self._confirm():
+                return 0
+            with self._lock:
+                batch, upto = self._pending, self._seq
+                self._pending = {}
+            if not batch:
+                return 0
+            changes = {path: increment(delta) for path, delta in batch.items()}
+            changes[self.marker] = upto
+            try:
+                self.store.update(changes)
+            except Exception:
+                # it may or may not have been applied; the marker tells on the next flush
+                self.stats["errors"] += 1
+                with self._lock:
+                    self._unconfirmed = (batch, upto)
+                raise
+            self._flushed = upto
+            self.stats["flushes"] += 1
+            self.stats["flushed_paths"] += len(batch)
+            self._maybe_compact()
+            if self.on_flush:
+                try:
+                    self.on_flush(list(batch))
+                except Exception:
+                    logger.exception("Ledger flush hook failed")
+            return len(batch)
+
+    def _confirm(self):
+        batch, upto = self._unconfirmed
+        try:
+            applied = int(self.store.get(self.marker) or 0)
+        except Exception:
+            return False
+        with self._lock:
+            if applied < upto:
+                self._merge(self._pending, batch)
+            else:
+                self._flushed = max(self._flushed, upto)
+            self._unconfirmed = None
+        return True
+
+    def _maybe_compact(self):
+        """Rewrite the journal as one record of what is still pending once it grows."""
+        if self._file is None or self._file.tell() < self.compact_bytes:
+            return
+        with self._io_lock, self._lock:
+            lines = []
+            if self._pending:
+                lines.append(json.dumps({"seq": self._seq, "changes": self._pending}, separators=(",", ":")) + "\n")
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp, self.path)
+            self._file = open(self.path, "a")
+            self._buffer = []
+            self._synced = self._seq
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ledger-flush", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Ledger flush failed, will retry: %s", e)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,210 @@
+"""
+membership.py
+Channel membership checks for join_channel task claims.
+
+getChatMember is rate limited by Telegram, so instead of calling it inside
+the claim handler the bot asks a MembershipVerifier:
+
+  - answers are cached per (channel, user) for a while, members longer than
+    non-members;
+  - channels the bot cannot read (private, bot not admin, chat not found)
+    land in a negative cache and are not asked again until it expires;
+  - uncached claims are queued and checked by a background thread that
+    merges duplicate (channel, user) claims and spaces out the calls to
+    each channel; on_result is called once per queued claim with the outcome.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of a check
+MEMBER = "member"
+NOT_MEMBER = "not_member"
+UNVERIFIABLE = "unverifiable"   # channel inaccessible or checks kept failing
+
+
+def is_member_status(status):
+    # if status is not 'left' then member
+    return bool(status) and status not in ("left", "kicked")
+
+def _retry_after(ex):
+    params = (getattr(ex, "result_json", None) or {}).get("parameters") or {}
+    return params.get("retry_after")
+
+
+class MembershipVerifier:
+    def __init__(self, get_status, on_result, member_ttl=600, non_member_ttl=60,
+                 channel_ttl=3600, per_channel_interval=0.2, max_attempts=3, cache_size=100000):
+        self.get_status = get_status        # (channel, user_id) -> chat member status
+        self.on_result = on_result          # (channel, user_id, outcome, claim) after a queued check
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.channel_ttl = channel_ttl
+        self.per_channel_interval = per_channel_interval
+        self.max_attempts = max_attempts
+        self.cache_size = cache_size
+        self.stats = {"hits": 0, "misses": 0, "checks": 0, "errors": 0, "throttled": 0}
+        self._lock = threading.Condition()
+        self._cache = OrderedDict()         # (channel, uid) -> (expires, is_member)
+        self._blocked = {}                  # channel -> negative cache expiry
+        self._queues = OrderedDict()        # channel -> deque of uids waiting for a check
+        self._claims = {}                   # (channel, uid) -> [claim, ...]
+        self._attempts = {}                 # (channel, uid) -> failed attempts
+        self._next_call = {}                # channel -> earliest time of its next call
+        self._thread = None
+        self._running = False
+
+    # ---- cache ----
+
+    def cached(self, channel, uid):
+        """MEMBER / NOT_MEMBER / UNVERIFIABLE if known without a call, else None."""
+        with self._lock:
+            outcome = self._lookup(channel, str(uid))
+            self.stats["misses" if outcome is None else "hits"] += 1
+            return outcome
+
+    def _lookup(self, channel, uid):
+        now = time.monotonic()
+        if self._blocked.get(channel, 0) > now:
+            return UNVERIFIABLE
+        entry = self._cache.get((channel, uid))
+        if entry and entry[0] > now:
+            self._cache.move_to_end((channel, uid))
+            return MEMBER if entry[1] else NOT_MEMBER
+        return None
+
+    def _remember(self, channel, uid, is_member):
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        self._cache[(channel, uid)] = (time.monotonic() + ttl, is_member)
+        self._cache.move_to_end((channel, uid))
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def pending(self):
+        with self._lock:
+            return len(self._claims)
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    # ---- queue ----
+
+    def submit(self, channel, uid, claim=None):
+        """Queue a check; on_result(channel, uid, outcome, claim) follows later."""
+        key = (channel, str(uid))
+        with self._lock:
+            if key in self._claims:
+                self._claims[key].append(claim)
+                return
+            self._claims[key] = [claim]
+            self._queues.setdefault(channel, deque()).append(key[1])
+            self._lock.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="membership", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+
+    def _next(self):
+        """Wait for a channel whose rate limit allows a call; pop its next user."""
+        with self._lock:
+            while self._running:
+                now = time.monotonic()
+                wait = None
+                for channel in list(self._queues):
+                    q = self._queues[channel]
+                    if not q:
+                        del self._queues[channel]
+                        continue
+                    ready = self._next_call.get(channel, 0)
+                    if ready <= now:
+                        self._next_call[channel] = now + self.per_channel_interval
+                        # round robin: the channel goes to the back of the line
+                        self._queues.move_to_end(channel)
+                        return channel, q.popleft()
+                    wait = ready - now if wait is None else min(wait, ready - now)
+                self._lock.wait(wait)
+            return None
+
+    def _settle(self, channel, uid, outcome):
+        with self._lock:
+            claims = self._claims.pop((channel, uid), [])
+            self._attempts.pop((channel, uid), None)
+        for claim in claims:
+            try:
+                self.on_result(channel, uid, outcome, claim)
+            except Exception:
+                logger.exception("Membership result handler failed for %s in %s", uid, channel)
+
+    def _retry(self, channel, uid, delay):
+        with self._lock:
+            attempts = self._attempts.get((channel, uid), 0) + 1
+            self._attempts[(channel, uid)] = attempts
+            if attempts < self.max_attempts:
+                self._next_call[channel] = max(self._next_call.get(channel, 0), time.monotonic() + delay)
+                self._queues.setdefault(channel, deque()).append(uid)
+                return
+        self._settle(channel, uid, UNVERIFIABLE)
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            channel, uid = item
+            with self._lock:
+                known = self._lookup(channel, uid)
+            if known is not None:
+                # answered meanwhile (e.g. by an earlier claim for the same channel)
+                self._settle(channel, uid, known)
+                continue
+            self.stats["checks"] += 1
+            try:
+                status = self.get_status(channel, int(uid))
+            except ApiTelegramException as ex:
+                retry_after = _retry_after(ex)
+                if ex.error_code == 429 or retry_after:
+                    self.stats["throttled"] += 1
+                    self._retry(channel, uid, retry_after or 1)
+                elif ex.error_code == 400 and "user" in (ex.description or "").lower():
+                    # user never joined / unknown to this chat
+                    with self._lock:
+                        self._remember(channel, uid, False)
+                    self._settle(channel, uid, NOT_MEMBER)
+                else:
+                    # chat not found, member list inaccessible, bot not in channel
+                    logger.info("Cannot check members of %s: %s", channel, ex.description)
+                    self._block(channel)
+                continue
+            except Exception as ex:
+                self.stats["errors"] += 1
+                logger.info("Membership check for %s in %s failed: %s", uid, channel, ex)
+                self._retry(channel, uid, self.per_channel_interval * 10)
+                continue
+            is_member = is_member_status(status)
+            with self._lock:
+                self._remember(channel, uid, is_member)
+            self._settle(channel, uid, MEMBER if is_member else NOT_MEMBER)
+
+    def _block(self, channel):
+        """Negative-cache channel and settle everything queued for it."""
+        with self._lock:
+            self._blocked[channel] = time.monotonic() + self.channel_ttl
+            waiting = list(self._queues.pop(channel, ()))
+            waiting += [uid for (ch, uid) in self._claims if ch == channel and uid not in waiting]
+        for uid in waiting:
+            self._settle(channel, uid, UNVERIFIABLE)
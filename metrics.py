@@ -0,0 +1,310 @@
+"""
+metrics.py
+Latency histograms, counters and gauges for the bot, in Prometheus text format.
+
+    instrument_handlers(bot)            every message / callback handler
+    instrument_methods(store, ...)      storage calls
+    instrument_telegram()               every Bot API request (sync and async)
+    gauge(name, fn)                     values read when scraped (cache hit rates, queues)
+    serve(port)                         GET /metrics (and /profile) on a small HTTP server
+
+The SamplingProfiler snapshots every thread's stack at a fixed interval while
+it is switched on (the /profile admin command) and reports where the time
+goes, also as collapsed stacks for flame graphs.
+"""
+
+import sys
+import time
+import asyncio
+import functools
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Histogram buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_histograms = {}    # (name, labels) -> [bucket counts..., +Inf count, sum]
+_counters = {}      # (name, labels) -> value
+_gauges = {}        # name -> (fn, help)
+_help = {}          # metric name -> help text
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, seconds, help="", **labels):
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 2)
+            _help.setdefault(name, help)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+                break
+        else:
+            h[len(BUCKETS)] += 1
+        h[-1] += seconds
+
+def inc(name, n=1, help="", **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+        _help.setdefault(name, help)
+
+def gauge(name, fn, help=""):
+    """Register a gauge whose value is fn() at scrape time."""
+    _gauges[name] = (fn, help)
+
+
+# ------------------ Instrumentation ------------------
+
+def timed(fn, metric, help="", **labels):
+    """fn wrapped to record its latency in metric and its exceptions in
+    metric_errors_total; coroutine functions stay coroutine functions."""
+    errors = metric.replace("_seconds", "") + "_errors_total"
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                inc(errors, **labels)
+                raise
+            finally:
+                observe(metric, time.perf_counter() - start, help, **labels)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            inc(errors, **labels)
+            raise
+        finally:
+            observe(metric, time.perf_counter() - start, help, **labels)
+    return wrapper
+
+def instrument_handlers(bot):
+    """Time every registered message and callback handler (call after the
+    last handler is registered)."""
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            fn = handler["function"]
+            if not getattr(fn, "_metered", False):
+                handler["function"] = timed(fn, "bot_handler_seconds", "Handler latency",
+                                            handler=fn.__name__)
+                handler["function"]._metered = True
+
+def instrument_methods(obj, names, metric, help=""):
+    for name in names:
+        setattr(obj, name, timed(getattr(obj, name), metric, help, op=name))
+
+def instrument_telegram():
+    """Time every Bot API request by method, for TeleBot and AsyncTeleBot."""
+    from telebot import apihelper, asyncio_helper
+    if getattr(apihelper._make_request, "_metered", False):
+        return
+
+    def wrap(fn, method_arg):
+        is_async = asyncio.iscoroutinefunction(fn)
+
+        def labels(args, kwargs):
+            return {"method": str(kwargs.get(method_arg, args[1] if len(args) > 1 else "?"))}
+
+        def failed(ex, lbl):
+            inc("telegram_request_errors_total", help="Failed Bot API requests",
+                code=str(getattr(ex, "error_code", "") or type(ex).__name__), **lbl)
+
+        if is_async:
+            async def call(*args, **kwargs):
+                lbl = labels(args, kwargs)
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as ex:
+                    failed(ex, lbl)
+                    raise
+                finally:
+                    observe("telegram_request_seconds", time.perf_counter() - start, "Bot API latency", **lbl)
+        else:
+            def call(*args, **kwargs):
+                lbl = labels(args, kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as ex:
+                    failed(ex, lbl)
+                    raise
+                finally:
+                    observe("telegram_request_seconds", time.perf_counter() - start, "Bot API latency", **lbl)
+        call._metered = True
+        return call
+
+    apihelper._make_request = wrap(apihelper._make_request, "method_name")
+    asyncio_helper._process_request = wrap(asyncio_helper._process_request, "url")
+
+
+# ------------------ Exposition ------------------
+
+def _fmt_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        counters = dict(_counters)
+    out = []
+    seen = set()
+
+    def header(name, kind):
+        if name not in seen:
+            seen.add(name)
+            if _help.get(name):
+                out.append(f"# HELP {name} {_help[name]}")
+            out.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), h in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(BUCKETS, h):
+            cumulative += n
+            out.append(f"{name}_bucket{_fmt_labels(labels, [('le', bound)])} {cumulative}")
+        cumulative += h[len(BUCKETS)]
+        out.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {cumulative}")
+        out.append(f"{name}_sum{_fmt_labels(labels)} {h[-1]:.6f}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {cumulative}")
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        out.append(f"{name}{_fmt_labels(labels)} {value}")
+    for name, (fn, help) in sorted(_gauges.items()):
+        try:
+            value = float(fn())
+        except Exception:
+            continue
+        _help.setdefault(name, help)
+        header(name, "gauge")
+        out.append(f"{name} {value}")
+    return "\n".join(out) + "\n"
+
+def serve(port, host="0.0.0.0"):
+    """Serve /metrics (and /profile) from a daemon thread; returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics"):
+                body, ctype = render(), "text/plain; version=0.0.4"
+            elif self.path.startswith("/profile"):
+                body, ctype = profiler.collapsed(), "text/plain"
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# ------------------ Sampling profiler ------------------
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, depth=30):
+        self.interval = interval
+        self.depth = depth
+        self.samples = Counter()    # collapsed stack -> samples
+        self.total = 0
+        self._lock = threading.Lock()   # samples and total, shared with the sampler thread
+        self._thread = None
+        self._running = False
+        self._started = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return False
+        with self._lock:
+            self.samples.clear()
+            self.total = 0
+        self._running = True
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self._running:
+            return False
+        self._running = False
+        self._thread.join()
+        return True
+
+    def _run(self):
+        me = threading.get_ident()
+        while self._running:
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self.samples.update(stacks)
+                self.total += 1
+            time.sleep(self.interval)
+
+    def _snapshot(self):
+        with self._lock:
+            return Counter(self.samples), self.total
+
+    def collapsed(self):
+        """Samples as collapsed stacks ("a;b;c count" lines) for flame graph tools."""
+        samples, _ = self._snapshot()
+        return "".join(f"{stack} {n}\n" for stack, n in samples.most_common())
+
+    def top(self, n=15, skip_idle=True):
+        """The functions most often on top of a stack, as text."""
+        samples, total = self._snapshot()
+        leaf = Counter()
+        for stack, count in samples.items():
+            fn = stack.rsplit(";", 1)[-1]
+            if skip_idle and fn.rsplit(":", 1)[-1] in _IDLE:
+                continue
+            leaf[fn] += count
+        busy = sum(leaf.values()) or 1
+        elapsed = time.monotonic() - self._started if self._started else 0
+        lines = [f"{total} samples over {elapsed:.0f}s, {busy} non-idle thread stacks"]
+        lines += [f"{100 * c / busy:5.1f}%  {fn}" for fn, c in leaf.most_common(n)]
+        return "\n".join(lines)
+
+# Frames that mean a thread is waiting, not working
+_IDLE = {"wait", "select", "poll", "sleep", "_wait_for_tstate_lock", "accept", "readinto",
+         "recv_into", "get", "serve_forever", "_worker", "epoll"}
+
+profiler = SamplingProfiler()
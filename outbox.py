@@ -0,0 +1,299 @@
+"""
+outbox.py
+Rate-limited outbound queue for Bot API sends.
+
+Handlers hand their replies to an Outbox instead of calling the API inline;
+sender threads deliver them while keeping under Telegram's limits:
+
+  - a global token bucket (about 30 messages per second) and one bucket per
+    chat (about one message per second, small bursts allowed);
+  - a 429 answer pauses that chat (or everything, for chat-less calls) for
+    the retry_after Telegram asks for, then the send is retried;
+  - lower priority numbers go first, so callback answers overtake replies
+    and replies overtake notifications;
+  - notifications queued for the same chat are merged into one message.
+
+Sends are fire-and-forget. The transport is any callable (method, params);
+by default it calls the TeleBot method of that name.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+# Priorities, most urgent first
+CALLBACK = 0      # answerCallbackQuery: the user is looking at a spinner
+REPLY = 1         # direct answers to what the user just did
+NOTIFY = 2        # side notifications (referral notices, revoked claims)
+BULK = 3          # broadcasts
+
+MAX_TEXT = 4096
+
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is)."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+def bot_transport(bot):
+    return lambda method, params: getattr(bot, method)(**params)
+
+
+class _Item:
+    __slots__ = ("method", "chat", "params", "priority", "coalesce", "callback", "attempts")
+
+    def __init__(self, method, chat, params, priority, coalesce, callback):
+        self.method = method
+        self.chat = chat
+        self.params = params
+        self.priority = priority
+        self.coalesce = coalesce
+        self.callback = callback
+        self.attempts = 0
+
+
+class Outbox:
+    def __init__(self, transport, global_rate=30, chat_rate=1, chat_burst=3, senders=4,
+                 max_queued=100000, max_attempts=3, on_error=None):
+        self.transport = transport
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.senders = senders
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.on_error = on_error            # (method, params, exception) for failed sends
+        self.stats = {"sent": 0, "coalesced": 0, "throttled": 0, "errors": 0, "shed": 0}
+        self._cond = threading.Condition()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._queues = [OrderedDict() for _ in range(BULK + 1)]   # priority -> chat -> deque
+        self._buckets = {}                  # chat -> TokenBucket
+        self._paused = {}                   # chat (None: everything) -> paused until
+        self._busy = set()                  # chats with a send in flight (keeps their order)
+        self._merge = {}                    # chat -> queued notification still open for merging
+        self._queued = 0
+        self._running = False
+        self._threads = []
+
+    # ---- API ----
+
+    def submit(self, method, chat, params, priority=REPLY, coalesce=False, callback=None):
+        """Queue one API call. chat=None skips the per-chat limit. callback,
+        if given, gets (result, exception) once the call succeeded or finally
+        failed. Returns False if the queue is full and the call was dropped."""
+        with self._cond:
+            if coalesce and self._coalesce(chat, params):
+                return True
+            if self._queued >= self.max_queued:
+                self.stats["shed"] += 1
+                return False
+            item = _Item(method, chat, params, priority, coalesce, callback)
+            self._queues[priority].setdefault(chat, deque()).append(item)
+            if coalesce:
+                self._merge[chat] = item
+            self._queued += 1
+            self._cond.notify()
+            return True
+
+    def send_message(self, chat_id, text, priority=REPLY, **kwargs):
+        return self.submit("send_message", chat_id, dict(kwargs, chat_id=chat_id, text=text), priority)
+
+    def reply_to(self, message, text, priority=REPLY, **kwargs):
+        kwargs.setdefault("reply_parameters", types.ReplyParameters(
+            message.message_id, allow_sending_without_reply=True))
+        return self.send_message(message.chat.id, text, priority, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id, priority=REPLY, **kwargs):
+        return self.submit("edit_message_text", chat_id,
+                           dict(kwargs, text=text, chat_id=chat_id, message_id=message_id), priority)
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        return self.submit("answer_callback_query", None,
+                           dict(kwargs, callback_query_id=callback_query_id, text=text), CALLBACK)
+
+    def notify(self, chat_id, text, priority=NOTIFY):
+        """Non-critical message; merged with other notifications still queued for chat_id."""
+        return self.submit("send_message", chat_id, {"chat_id": chat_id, "text": text}, priority, coalesce=True)
+
+    def queued(self):
+        with self._cond:
+            return self._queued
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been sent; True if it was."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queued or self._busy:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+            return True
+
+    def start(self):
+        if not self._threads:
+            self._running = True
+            for n in range(max(1, self.senders)):
+                t = threading.Thread(target=self._run, name=f"outbox-{n}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        return self
+
+    def stop(self, timeout=10):
+        self.flush(timeout)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    # ---- scheduling ----
+
+    def _coalesce(self, chat, params):
+        item = self._merge.get(chat)
+        if item is None:
+            return False
+        text = item.params["text"] + "\n\n" + params["text"]
+        if len(text) > MAX_TEXT:
+            del self._merge[chat]
+            return False
+        item.params["text"] = text
+        self.stats["coalesced"] += 1
+        return True
+
+    def _bucket(self, chat):
+        bucket = self._buckets.get(chat)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                # forget idle chats; a full bucket is the same as a new one
+                now = time.monotonic()
+                for c in [c for c, b in self._buckets.items() if c not in self._busy and b.full(now)]:
+                    del self._buckets[c]
+            bucket = self._buckets[chat] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now):
+        """Next sendable item, or (None, seconds to wait)."""
+        wait = self._paused.get(None, 0) - now
+        if wait > 0:
+            return None, wait
+        wait = self._global.delay(now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        for chats in self._queues:
+            for chat in list(chats):
+                q = chats[chat]
+                if chat in self._busy:
+                    continue
+                delay = self._paused.get(chat, 0) - now
+                if delay <= 0 and chat is not None:
+                    self._paused.pop(chat, None)
+                    delay = self._bucket(chat).delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                item = q.popleft()
+                if q:
+                    chats.move_to_end(chat)     # round robin between chats
+                else:
+                    del chats[chat]
+                if self._merge.get(chat) is item:
+                    del self._merge[chat]
+                if chat is not None:
+                    self._bucket(chat).take(now)
+                    self._busy.add(chat)
+                self._global.take(now)
+                self._queued -= 1
+                return item, 0
+        return None, wait
+
+    def _requeue(self, item, pause):
+        with self._cond:
+            if pause:
+                self._paused[item.chat] = time.monotonic() + pause
+            chats = self._queues[item.priority]
+            chats.setdefault(item.chat, deque()).appendleft(item)
+            self._queued += 1
+            self._busy.discard(item.chat)
+            self._cond.notify_all()
+
+    def _done(self, item):
+        with self._cond:
+            self._busy.discard(item.chat)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    item, wait = self._pick(time.monotonic())
+                    if item is not None:
+                        break
+                    self._cond.wait(wait)
+            try:
+                result = self.transport(item.method, item.params)
+                self.stats["sent"] += 1
+                self._report(item, result, None)
+            except ApiTelegramException as ex:
+                params = (ex.result_json or {}).get("parameters") or {}
+                if ex.error_code == 429:
+                    self.stats["throttled"] += 1
+                    self._requeue(item, params.get("retry_after") or 1)
+                    continue
+                self._fail(item, ex)
+            except Exception as ex:
+                item.attempts += 1
+                if item.attempts < self.max_attempts:
+                    # back off this chat only; chat-less calls retry right away
+                    self._requeue(item, item.attempts if item.chat is not None else 0)
+                    continue
+                self._fail(item, ex)
+            self._done(item)
+
+    def _fail(self, item, ex):
+        self.stats["errors"] += 1
+        logger.info("%s to %s failed: %s", item.method, item.chat, ex)
+        if self.on_error:
+            try:
+                self.on_error(item.method, item.params, ex)
+            except Exception:
+                logger.exception("Outbox error handler failed")
+        self._report(item, None, ex)
+
+    def _report(self, item, result, ex):
+        if item.callback:
+            try:
+                item.callback(result, ex)
+            except Exception:
+                logger.exception("Outbox callback failed")
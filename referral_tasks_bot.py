@@ -1,24 +1,48 @@
 """
 referral_tasks_bot.py
-TeleBot (pyTelegramBotAPI) referral + tasks bot with Firebase Realtime DB.
+TeleBot (pyTelegramBotAPI) referral + tasks bot with Firebase Realtime DB
+(or a local SQLite / in-memory store, see storage.py).
 No daily bonus. Tasks: Visit Sites, Join Channels, Join Bots, More, Advertise.
 """
 
+import os
+import html
+import atexit
 import time
+import queue
+import random
 import logging
+import threading
+from collections import OrderedDict
 from functools import wraps
 
 import telebot
 from telebot import types
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 
-import firebase_admin
-from firebase_admin import credentials, db
+import metrics
+from storage import open_storage, increment
+from outbox import Outbox, bot_transport
+from broadcast import Broadcaster
+from adserver import AdServer
+from ledger import PointLedger
+from admission import Admission
+import bulk_io
+from conversations import ConversationStore
+from membership import MembershipVerifier, MEMBER, NOT_MEMBER, UNVERIFIABLE
 
 # ------------------ CONFIG ------------------
-BOT_TOKEN = "7699582484:AAF6te7oE49CgaIzOskZdQRyXMjXpoluqX4"  # <-- replace with your bot token
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "7699582484:AAF6te7oE49CgaIzOskZdQRyXMjXpoluqX4")  # <-- replace with your bot token
 FIREBASE_DB_URL ="https://clickstar-btc-bot-default-rtdb.firebaseio.com/"  # <-- replace (no trailing slash)
 SERVICE_ACCOUNT_FILE = "clickstar-btc-bot-firebase-adminsdk-fbsvc-e3232306d4.json"
 
+# Bot API base URL override, e.g. a local fake server (see fake_telegram.py)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+# Storage backend: "firebase", "sqlite" (local file at SQLITE_PATH) or "memory"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firebase")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "bot.db")
+
 # Points for different task types (customize)
 POINTS_VISIT = 3
 POINTS_JOIN_CHANNEL = 8
@@ -27,6 +51,116 @@ POINTS_OTHER = 4
 
 # Referral points
 POINTS_FOR_REFERRAL = 10
+POINTS_FOR_REFERRAL_L2 = 0      # to the referrer's own referrer (second level); 0 = off
+
+# /referrals: users listed per page, and how many levels of the referral
+# tree are counted (level 1 is "referrals"; deeper levels are kept on each
+# profile as referrals_l2, referrals_l3, ...)
+REFERRALS_PER_PAGE = 10
+REFERRAL_TREE_DEPTH = 3
+
+# Leaderboard: rows shown by /leaderboard and rows kept warm in the index
+LEADERBOARD_SIZE = 10
+LEADERBOARD_KEEP = 50
+
+# Task listings: tasks per message page (pages also stay under Telegram's size limit)
+TASKS_PER_PAGE = 10
+TASK_PAGE_MAX_CHARS = 3500
+
+# Per-process user profile cache (LRU bounded, entries expire after TTL seconds)
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# Page size used when walking the whole users tree (rebuilds, jobs)
+USERS_PAGE_SIZE = 500
+
+# How often the global /stats counters are recomputed from scratch (seconds)
+STATS_RECONCILE_INTERVAL = 6 * 3600
+
+# Several processes on one database (sharded_worker.py): /stats and
+# /leaderboard are reloaded from it this often (seconds), so every process
+# answers the same. 0 (one process): the in-memory copies are authoritative
+SHARED_STATE_REFRESH = float(os.environ.get("SHARED_STATE_REFRESH", "0"))
+
+# Processes that do not run the completion index backfill check this often
+# (seconds) whether it has finished
+DONE_INDEX_POLL_INTERVAL = 30
+
+# Polling mode: updates are spread over worker lanes by user id; each lane
+# handles its users in order and sheds updates once its queue is full
+DISPATCH_LANES = int(os.environ.get("DISPATCH_LANES", "8"))
+DISPATCH_QUEUE_DEPTH = int(os.environ.get("DISPATCH_QUEUE_DEPTH", "200"))
+
+# join_channel claims: membership answers are cached (seconds), channels the
+# bot cannot read are not asked again for CHANNEL_BLOCK_TTL, and calls to one
+# channel are at least MEMBER_CHECK_INTERVAL apart
+MEMBER_CACHE_TTL = 600
+NON_MEMBER_CACHE_TTL = 60
+CHANNEL_BLOCK_TTL = 3600
+MEMBER_CHECK_INTERVAL = 0.2
+
+# Outbound sends: Telegram allows about 30 messages/s overall and about one
+# per second to a chat (short bursts tolerated)
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 3
+OUTBOX_SENDERS = 4
+
+# Ad broadcasts: users per page; progress is checkpointed after every page.
+# A broadcast spends at most AD_BROADCAST_SHARE of an ad's budget, the rest
+# is left to impressions (see below); 0 = no broadcasts, impressions only
+BROADCAST_PAGE_SIZE = 100
+BROADCAST_PAGE_TIMEOUT = 300    # seconds to wait for a page's send results
+AD_BROADCAST_SHARE = 0.5
+
+# Multi-step flows (advertise): state lives in process, expires after
+# CONVERSATION_TTL seconds; set CONVERSATION_FILE to keep it across restarts
+CONVERSATION_TTL = 900
+CONVERSATION_MAX = 10000
+CONVERSATION_FILE = os.environ.get("CONVERSATION_FILE")
+
+# Prometheus metrics: port of the /metrics endpoint in polling mode (0 = off;
+# webhook mode serves /metrics on its own port)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Point ledger: when set, counter deltas (points, referrals, stats) are
+# journaled to this local file (fsync'd) and flushed to the database every
+# LEDGER_FLUSH_INTERVAL seconds as one update. Empty (default): write them
+# directly. The journal must be on a disk that survives a restart: on an
+# ephemeral filesystem (a Heroku dyno) the deltas not flushed yet are lost
+# with it.
+LEDGER_JOURNAL = os.environ.get("LEDGER_JOURNAL", "")
+LEDGER_WRITER = os.environ.get("LEDGER_WRITER", "main")  # one per process sharing the database
+LEDGER_FLUSH_INTERVAL = 1.0
+
+# Admission control: per-user token buckets (burst, refill per second),
+# plus per-command buckets for the commands / buttons / callbacks below
+# ("text" covers keyboard buttons and other plain text). Updates over a limit
+# are dropped before any handler runs; the user hears about it at most every
+# ADMISSION_NOTICE_INTERVAL seconds.
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") != "0"
+ADMISSION_USER_BURST = 10
+ADMISSION_USER_RATE = 1.0
+ADMISSION_COMMAND_LIMITS = {
+    "task_done": (3, 0.2),      # "I Visited ✅" and friends
+    "task_open": (5, 0.5),
+    "tasks_page": (6, 1.0),
+    "refs_page": (6, 1.0),
+    "referrals": (3, 0.2),
+    "text": (6, 0.5),
+    "start": (3, 0.1),
+}
+ADMISSION_NOTICE_INTERVAL = 10
+
+# Ad impressions: published ads ride along on task listings and menu
+# replies (AD_SERVE_RATE of them), picked at random weighted by budget left;
+# impressions are written every AD_FLUSH_INTERVAL seconds
+AD_SERVE_RATE = 0.5
+AD_FLUSH_INTERVAL = 5.0
+AD_SNIPPET_MAX = 300
+
+# /importtasks: largest task file accepted (bytes)
+IMPORT_MAX_BYTES = 1 << 20
 
 # Admin Telegram user ids
 ADMINS = {123456789}  # <-- replace with your Telegram numeric id(s)
@@ -36,81 +170,870 @@ ADMINS = {123456789}  # <-- replace with your Telegram numeric id(s)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Firebase
-cred = credentials.Certificate(SERVICE_ACCOUNT_FILE)
-firebase_admin.initialize_app(cred, {"databaseURL": FIREBASE_DB_URL})
-root_ref = db.reference("/")
-users_ref = root_ref.child("users")
-tasks_ref = root_ref.child("tasks")          # task catalog (available tasks)
-completions_ref = root_ref.child("completions")  # which user completed which task
-ads_ref = root_ref.child("ads")              # advertise entries
+# Initialize storage. Top-level nodes:
+#   users/        profiles (points, referrals, referred_by, ...)
+#   tasks/        task catalog (available tasks)
+#   completions/  which user completed which task
+#   done/         lean completion index (done/<uid>/<tid> = 1)
+#   referrals/    who referred whom (referrals/<referrer>/<uid> = {name, time})
+#   ads/          published advertisements (published/)
+#   broadcasts/   ad delivery progress
+#   leaderboard/  persisted top referrers
+#   stats/        global aggregate counters
+#   claims/       join_channel claims waiting for a membership check (pending/<uid>/<tid>)
+store = open_storage(STORAGE_BACKEND,
+                     service_account_file=SERVICE_ACCOUNT_FILE,
+                     database_url=FIREBASE_DB_URL,
+                     sqlite_path=SQLITE_PATH)
 
 # Initialize bot
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+# threaded=False: handlers run on the dispatcher lanes (see run_polling)
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False, use_class_middlewares=ADMISSION_ENABLED)
+ledger = PointLedger(store, LEDGER_JOURNAL, writer=LEDGER_WRITER,
+                     flush_interval=LEDGER_FLUSH_INTERVAL) if LEDGER_JOURNAL else None
+conversations = ConversationStore(ttl=CONVERSATION_TTL, max_size=CONVERSATION_MAX, path=CONVERSATION_FILE)
+# Handlers queue their sends here; sender threads deliver them within Telegram's limits
+outbox = Outbox(bot_transport(bot), global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                chat_burst=OUTBOX_CHAT_BURST, senders=OUTBOX_SENDERS)
 
 
 # ------------------ Helpers ------------------
 
+def is_admin(user_id):
+    return user_id in ADMINS
+
 def require_admin(func):
     @wraps(func)
     def wrapper(message, *args, **kwargs):
-        if message.from_user.id not in ADMINS:
-            bot.reply_to(message, "❌ You are not an admin.")
+        if not is_admin(message.from_user.id):
+            outbox.reply_to(message, "❌ You are not an admin.")
             return
         return func(message, *args, **kwargs)
     return wrapper
 
+# Profiles are cached per process. Every write goes through ledger_write,
+# which refreshes the cached copy (write-through); the TTL bounds staleness
+# from writers in other processes.
+_user_cache_lock = threading.Lock()
+_user_cache = OrderedDict()  # uid -> (expires_at, user dict)
+user_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _user_cache_get(uid_s):
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(uid_s)
+        if entry and entry[0] > now:
+            _user_cache.move_to_end(uid_s)
+            user_cache_stats["hits"] += 1
+            return dict(entry[1])
+        if entry:
+            del _user_cache[uid_s]
+        user_cache_stats["misses"] += 1
+        return None
+
+def _user_cache_store_locked(uid_s, user):
+    _user_cache[uid_s] = (time.monotonic() + USER_CACHE_TTL, user)
+    _user_cache.move_to_end(uid_s)
+    while len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+        user_cache_stats["evictions"] += 1
+
+def user_cache_put(uid, user):
+    with _user_cache_lock:
+        _user_cache_store_locked(str(uid), dict(user))
+
+def user_cache_drop(uid):
+    with _user_cache_lock:
+        _user_cache.pop(str(uid), None)
+
+def user_cache_hit_rate():
+    total = user_cache_stats["hits"] + user_cache_stats["misses"]
+    return user_cache_stats["hits"] / total if total else 0.0
+
 def get_user(uid):
-    return users_ref.child(str(uid)).get()
+    uid_s = str(uid)
+    user = _user_cache_get(uid_s)
+    if user is not None:
+        return user
+    if ledger is not None and ledger.ready:
+        # deltas still waiting in the ledger are part of the balance
+        user = ledger.read(f"users/{uid_s}", lambda: store.get_user(uid_s))
+    else:
+        user = store.get_user(uid_s)
+    if user:
+        user_cache_put(uid_s, user)
+    return user
+
+# Completion index: done/<uid> holds just {task id: 1} per user; the task ids
+# are cached here as frozensets (same size and TTL as the user cache) so the
+# duplicate-claim check and listings never read completions/.
+_done_lock = threading.Lock()
+_done_cache = OrderedDict()  # uid -> (expires_at, frozenset of task ids)
+_done_backfilled = False     # done/ covers every old completion (see backfill_done_index)
+
+def completed_tasks(uid):
+    uid_s = str(uid)
+    now = time.monotonic()
+    with _done_lock:
+        entry = _done_cache.get(uid_s)
+        if entry and entry[0] > now:
+            _done_cache.move_to_end(uid_s)
+            return entry[1]
+    done = set(store.get(f"done/{uid_s}", shallow=True) or {})
+    if not _done_backfilled:
+        done |= set(store.get(f"completions/{uid_s}", shallow=True) or {})
+    done = frozenset(done)
+    _done_store(uid_s, done)
+    return done
+
+def _done_store(uid_s, done):
+    with _done_lock:
+        _done_cache[uid_s] = (time.monotonic() + USER_CACHE_TTL, done)
+        _done_cache.move_to_end(uid_s)
+        while len(_done_cache) > USER_CACHE_SIZE:
+            _done_cache.popitem(last=False)
+
+def _done_mark(uid_s, tid, done):
+    with _done_lock:
+        entry = _done_cache.get(uid_s)
+    if entry:
+        _done_store(uid_s, entry[1] | {tid} if done else entry[1] - {tid})
+
+def backfill_done_index(chunk=USERS_PAGE_SIZE):
+    """One-off: write done/<uid> for completions recorded before the index existed."""
+    global _done_backfilled
+    if store.get("meta/done_index"):
+        _done_backfilled = True
+        return 0
+    n = 0
+    for uid, comps in iter_children("completions", chunk):
+        store.update({f"done/{uid}/{tid}": 1 for tid in comps})
+        n += 1
+    store.set("meta/done_index", int(time.time()))
+    _done_backfilled = True
+    logger.info("Completion index backfilled for %s users", n)
+    return n
+
+def wait_for_done_index(interval=DONE_INDEX_POLL_INTERVAL):
+    """Where another process runs backfill_done_index: stop reading
+    completions/ on cache misses once it has finished."""
+    global _done_backfilled
+    while True:
+        try:
+            if store.get("meta/done_index"):
+                _done_backfilled = True
+                return
+        except Exception as e:
+            logger.warning("Could not check the completion index marker: %s", e)
+        time.sleep(interval)
+
+def backfill_referral_index(chunk=USERS_PAGE_SIZE):
+    """One-off: write referrals/<referrer>/<uid> for users referred before
+    the index existed, one update per page of users."""
+    if store.get("meta/referral_index"):
+        return 0
+    n = 0
+    for page in _pages(iter_users(chunk), chunk):
+        entries = {f"referrals/{u['referred_by']}/{uid}": _referral_entry(uid, u)
+                   for uid, u in page if u.get("referred_by")}
+        if entries:
+            store.update(entries)
+            n += len(entries)
+    store.set("meta/referral_index", int(time.time()))
+    logger.info("Referral index backfilled with %s entries", n)
+    return n
+
+def backfill_referral_levels(chunk=USERS_PAGE_SIZE):
+    """One-off: count referrals made before credit_referral kept referrals_l2,
+    referrals_l3, ... Walks the users once, holding one referred_by link per
+    referred user. For each referral credit_referral did not count (no
+    levels_counted flag) the deeper levels are added as increments, flagged
+    in the same update, so credits made meanwhile and a rerun after a crash
+    are not counted twice."""
+    if REFERRAL_TREE_DEPTH < 2 or store.get("meta/referral_levels"):
+        return 0
+    parent, todo = {}, []
+    for uid, u in iter_users(chunk):
+        if u.get("referred_by"):
+            parent[uid] = str(u["referred_by"])
+            if not u.get("levels_counted"):
+                todo.append(uid)
+    counted = set()
+    for page in _pages(todo, chunk):
+        counts = {}
+        for uid in page:
+            up = parent[uid]
+            seen = {uid, up}
+            for level in range(2, REFERRAL_TREE_DEPTH + 1):
+                up = parent.get(up)
+                if not up or up in seen:
+                    break
+                seen.add(up)
+                path = f"users/{up}/referrals_l{level}"
+                counts[path] = counts.get(path, 0) + 1
+        changes = {path: increment(n) for path, n in counts.items()}
+        changes.update({f"users/{uid}/levels_counted": True for uid in page})
+        store.update(changes)
+        for path in counts:
+            counted.add(path.split("/")[1])
+            user_cache_drop(path.split("/")[1])
+    store.set("meta/referral_levels", int(time.time()))
+    logger.info("Referral tree counts backfilled for %s users", len(counted))
+    return len(counted)
+
+def _pages(items, size):
+    page = []
+    for item in items:
+        page.append(item)
+        if len(page) >= size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+def _apply_user_changes(uid, user, changes):
+    """user with the users/<uid>... entries of a ledger update applied."""
+    prefix = f"users/{uid}"
+    out = dict(user)
+    for path, value in changes.items():
+        if path == prefix:
+            out = dict(value or {})
+        elif path.startswith(prefix + "/"):
+            field = path[len(prefix) + 1:]
+            if isinstance(value, dict) and ".sv" in value:
+                out[field] = (out.get(field, 0) or 0) + value[".sv"]["increment"]
+            elif value is None:
+                out.pop(field, None)
+            else:
+                out[field] = value
+    return out
+
+def _points_stats(amount):
+    if amount > 0:
+        return {"points_issued": amount}
+    if amount < 0:
+        return {"points_spent": -amount}
+    return {}
+
+def _is_increment(value):
+    return isinstance(value, dict) and ".sv" in value
+
+def ledger_write(changes, stats_deltas=None, touched=()):
+    """Apply changes (root-relative path -> value) and the matching /stats
+    deltas. Without a journal this is one atomic multi-path update; with one,
+    the increments are journaled (durable locally once this returns) and
+    reach the database with the next ledger flush, while the other values
+    are written right away.
+
+    touched lists (uid, user) pairs whose profiles the changes modify. Their
+    cached copies are advanced by the same changes, increments included, so
+    concurrent writers in this process never overwrite each other's cached
+    totals; leaderboard moves ride along in the same update. Returns
+    {uid: user after the write}."""
+    stats_deltas = {k: v for k, v in (stats_deltas or {}).items() if v}
+    update = dict(changes)
+    for path, delta in stats_deltas.items():
+        update[f"stats/{path}"] = increment(delta)
+    after = {}
+    now = time.monotonic()
+    with _user_cache_lock:
+        for uid, user in touched:
+            entry = _user_cache.get(uid)
+            base = entry[1] if entry and entry[0] > now else user
+            after[uid] = _apply_user_changes(uid, base, changes)
+            _user_cache_store_locked(uid, after[uid])
+    for uid, user in after.items():
+        for k, v in leaderboard_update(uid, user, persist=False).items():
+            update[f"leaderboard/{k}"] = v
+    deltas = {}
+    if ledger is not None and ledger.ready:
+        deltas = {p: v[".sv"]["increment"] for p, v in update.items() if _is_increment(v)}
+        update = {p: v for p, v in update.items() if not _is_increment(v)}
+    try:
+        if deltas:
+            ledger.record(deltas)
+        try:
+            if update:
+                store.update(update)
+        except Exception:
+            if deltas:
+                # the rest of the change did not happen: cancel the journaled part
+                ledger.record({p: -d for p, d in deltas.items()})
+            raise
+    except Exception:
+        for uid in after:
+            user_cache_drop(uid)
+        raise
+    stats_add_local(stats_deltas)
+    return after
 
 def create_user_if_missing(uid, username=None, first_name=None):
+    """Return the user, creating the profile first if needed."""
     uid_s = str(uid)
-    if not users_ref.child(uid_s).get():
-        users_ref.child(uid_s).set({
-            "points": 0,
-            "referrals": 0,
-            "referred_by": None,
-            "username": username or "",
-            "first_name": first_name or "",
-            "created_at": int(time.time()),
-        })
+    user = get_user(uid_s)
+    if user:
+        return user
+    user = {
+        "points": 0,
+        "referrals": 0,
+        "username": username or "",
+        "first_name": first_name or "",
+        "created_at": int(time.time()),
+    }
+    return ledger_write({f"users/{uid_s}": user}, {"users": 1}, touched=[(uid_s, {})])[uid_s]
 
 def add_points(uid, amount):
     uid_s = str(uid)
-    user = get_user(uid_s)
-    if not user:
-        create_user_if_missing(uid_s)
-        user = get_user(uid_s)
-    new_points = (user.get("points", 0) or 0) + amount
-    users_ref.child(uid_s).update({"points": new_points})
-    return new_points
+    user = create_user_if_missing(uid_s)
+    after = ledger_write({f"users/{uid_s}/points": increment(amount)}, _points_stats(amount),
+                         touched=[(uid_s, user)])
+    return after[uid_s].get("points", 0)
 
 def incr_referrals(uid, by=1):
     uid_s = str(uid)
-    user = get_user(uid_s)
-    if not user:
-        create_user_if_missing(uid_s)
-        user = get_user(uid_s)
-    new_count = (user.get("referrals", 0) or 0) + by
-    users_ref.child(uid_s).update({"referrals": new_count})
-    return new_count
+    user = create_user_if_missing(uid_s)
+    after = ledger_write({f"users/{uid_s}/referrals": increment(by)}, {"referrals": by},
+                         touched=[(uid_s, user)])
+    return after[uid_s].get("referrals", 0)
+
+def _referral_entry(uid, user):
+    return {"name": _lb_row(uid, user)[2], "time": user.get("created_at") or int(time.time())}
+
+def credit_referral(referrer_id, referrer, uid, me, points=POINTS_FOR_REFERRAL):
+    """Credit referrer for uid in one write: points, referral count,
+    referred_by, the referrals/ index entry, and referrals_l2, referrals_l3,
+    ... of the referrer's own referrers up to REFERRAL_TREE_DEPTH (plus the
+    second-level bonus, if enabled). Returns the new user's profile."""
+    changes = {
+        f"users/{referrer_id}/points": increment(points),
+        f"users/{referrer_id}/referrals": increment(1),
+        f"users/{uid}/referred_by": referrer_id,
+        f"users/{uid}/levels_counted": True,    # see backfill_referral_levels
+        f"referrals/{referrer_id}/{uid}": _referral_entry(uid, me),
+    }
+    issued = points
+    touched = [(referrer_id, referrer), (uid, me)]
+    seen = {uid, referrer_id}
+    ancestor = referrer
+    for level in range(2, REFERRAL_TREE_DEPTH + 1):
+        up = str(ancestor.get("referred_by") or "")
+        if not up or up in seen:
+            break
+        ancestor = get_user(up)
+        if not ancestor:
+            break
+        seen.add(up)
+        changes[f"users/{up}/referrals_l{level}"] = increment(1)
+        if level == 2 and POINTS_FOR_REFERRAL_L2:
+            changes[f"users/{up}/points"] = increment(POINTS_FOR_REFERRAL_L2)
+            issued += POINTS_FOR_REFERRAL_L2
+        touched.append((up, ancestor))
+    after = ledger_write(changes, dict(_points_stats(issued), referrals=1), touched=touched)
+    return after[uid]
+
+def complete_task(uid, user, tid, t, verified=False, pending=None):
+    """Record a task completion and pay its reward in one write; returns new balance.
+    pending ({"channel", "chat_id"}) marks a claim whose membership check has
+    not finished yet; it is kept under claims/pending/ until settled."""
+    pts = int(t.get("points", 0) or 0)
+    completion = {
+        "task_id": tid,
+        "title": t.get("title"),
+        "points": t.get("points"),
+        "time": int(time.time()),
+        "verified": bool(verified)
+    }
+    changes = {
+        f"completions/{uid}/{tid}": completion,
+        f"done/{uid}/{tid}": 1,
+        f"users/{uid}/points": increment(pts),
+    }
+    if pending:
+        completion["pending"] = True
+        changes[f"claims/pending/{uid}/{tid}"] = dict(pending, points=pts, time=completion["time"])
+    after = ledger_write(changes, dict(_points_stats(pts), **{f"task_completions/{tid}": 1}),
+                         touched=[(uid, user)])
+    _done_mark(uid, tid, True)
+    return after[uid].get("points", 0)
+
+def settle_claim(uid, tid, verified):
+    """Close a pending claim, keeping its points."""
+    store.update({f"completions/{uid}/{tid}/verified": bool(verified),
+                  f"completions/{uid}/{tid}/pending": None,
+                  f"claims/pending/{uid}/{tid}": None})
+
+def revoke_claim(uid, tid, points):
+    """Undo a claim that failed its membership check: drop the completion and
+    take its points back in one write; returns the new balance."""
+    after = ledger_write({
+        f"completions/{uid}/{tid}": None,
+        f"done/{uid}/{tid}": None,
+        f"claims/pending/{uid}/{tid}": None,
+        f"users/{uid}/points": increment(-points),
+    }, {"points_issued": -points, f"task_completions/{tid}": -1},
+        touched=[(uid, get_user(uid) or {})])
+    _done_mark(uid, tid, False)
+    return after[uid].get("points", 0)
+
+def held_points(uid):
+    """Points of uid's claims still waiting for a membership check."""
+    claims = store.get(f"claims/pending/{uid}") or {}
+    return sum(int(c.get("points", 0) or 0) for c in claims.values() if isinstance(c, dict))
+
+def resubmit_pending_claims(owns=None):
+    """Queue the membership checks of claims left pending by an earlier run
+    (the verifier's queue is in memory only). owns(uid) picks this process's
+    users when several share the database. Returns the number queued."""
+    n = 0
+    for uid, claims in iter_children("claims/pending"):
+        if owns is not None and not owns(uid):
+            continue
+        for tid, c in claims.items():
+            if isinstance(c, dict) and c.get("channel"):
+                verifier.submit(c["channel"], uid, (tid, int(c.get("points", 0) or 0), c.get("chat_id")))
+                n += 1
+    if n:
+        logger.info("Resubmitted %d pending membership checks", n)
+    return n
+
+def debit_for_ad(uid, user, ad_id, ad):
+    """Charge the ad cost and publish it in one write; returns the new balance."""
+    cost = ad["cost"]
+    after = ledger_write({
+        f"users/{uid}/points": increment(-cost),
+        f"ads/published/{ad_id}": ad,
+    }, dict(_points_stats(-cost), ads_published=1), touched=[(uid, user)])
+    return after[uid].get("points", 0)
+
+def iter_children(path, chunk=USERS_PAGE_SIZE):
+    """Yield (key, value) pairs under path, paging through it in key order."""
+    for k, v in store.iter_children(path, chunk):
+        if isinstance(v, dict):
+            yield k, v
+
+def iter_users(chunk=USERS_PAGE_SIZE):
+    return iter_children("users", chunk)
+
+_bot_username = None
 
 def build_referral_link(uid):
-    # uses bot username (fetched lazily)
-    try:
-        username = bot.get_me().username
-    except Exception:
-        username = "YourBotUsername"
-    return f"https://t.me/{username}?start={uid}"
+    # uses bot username (fetched lazily, once)
+    global _bot_username
+    if _bot_username is None:
+        try:
+            _bot_username = bot.get_me().username
+        except Exception:
+            return f"https://t.me/YourBotUsername?start={uid}"
+    return f"https://t.me/{_bot_username}?start={uid}"
 
 def format_points_info(user_dict):
     points = user_dict.get("points", 0) or 0
     referrals = user_dict.get("referrals", 0) or 0
     return f"Points: <b>{points}</b>\nReferrals: <b>{referrals}</b>"
 
+# ------------------ Leaderboard index ------------------
+# The top LEADERBOARD_KEEP referrers live in memory (mirrored to /leaderboard)
+# and are updated whenever a user's points or referrals change, so
+# /leaderboard never downloads the users tree.
+
+_lb_lock = threading.Lock()
+_lb_rows = {}      # uid -> (referrals, points, name)
+_lb_text = None    # rendered /leaderboard reply, dropped on every change
+_lb_evicts = True  # persist rows dropped from the index (primary process only)
+
+def _lb_row(uid, user):
+    name = user.get("username") or user.get("first_name") or f"ID:{uid}"
+    return (user.get("referrals", 0) or 0, user.get("points", 0) or 0, name)
+
+def _lb_persist_row(row):
+    return {"referrals": row[0], "points": row[1], "name": row[2]}
+
+def leaderboard_update(uid, user, persist=True):
+    """Fold a user's new totals into the index. Returns the /leaderboard
+    changes; with persist=False the caller is expected to write them."""
+    global _lb_text
+    uid_s = str(uid)
+    row = _lb_row(uid_s, user)
+    changes = {}
+    with _lb_lock:
+        old = _lb_rows.get(uid_s)
+        if old == row:
+            return changes
+        if old is None and len(_lb_rows) >= LEADERBOARD_KEEP:
+            if row[:2] <= min(r[:2] for r in _lb_rows.values()):
+                return changes
+        _lb_rows[uid_s] = row
+        changes[uid_s] = _lb_persist_row(row)
+        if len(_lb_rows) > LEADERBOARD_KEEP:
+            drop = min(_lb_rows, key=lambda k: _lb_rows[k][:2])
+            del _lb_rows[drop]
+            if _lb_evicts:
+                changes[drop] = None
+        _lb_text = None
+    if persist:
+        try:
+            store.update({f"leaderboard/{k}": v for k, v in changes.items()})
+        except Exception as e:
+            logger.warning("Could not persist leaderboard: %s", e)
+    return changes
+
+def _lb_set_rows(rows):
+    global _lb_text
+    with _lb_lock:
+        _lb_rows.clear()
+        _lb_rows.update(rows)
+        _lb_text = None
+
+def rebuild_leaderboard():
+    """Recompute the index from scratch (pages through users, or uses an
+    index where the backend has one)."""
+    if ledger is not None and ledger.ready:
+        ledger.flush()
+    rows = {uid: _lb_row(uid, u) for uid, u in store.top_users(LEADERBOARD_KEEP)}
+    _lb_set_rows(rows)
+    store.set("leaderboard", {uid: _lb_persist_row(row) for uid, row in rows.items()} or None)
+    logger.info("Leaderboard rebuilt with %d rows.", len(rows))
+    return len(rows)
+
+def load_leaderboard():
+    saved = store.get("leaderboard") or {}
+    if not saved:
+        rebuild_leaderboard()
+        return
+    _lb_load(saved)
+
+def _lb_load(saved):
+    """Index the persisted rows, keeping the top LEADERBOARD_KEEP. Other
+    processes add rows without evicting any, so the primary one deletes
+    the surplus."""
+    rows = {
+        uid: (r.get("referrals", 0) or 0, r.get("points", 0) or 0, r.get("name") or f"ID:{uid}")
+        for uid, r in saved.items() if isinstance(r, dict)
+    }
+    keep = dict(sorted(rows.items(), key=lambda kv: kv[1][:2], reverse=True)[:LEADERBOARD_KEEP])
+    _lb_set_rows(keep)
+    stale = set(rows) - set(keep)
+    if stale and _lb_evicts:
+        store.update({f"leaderboard/{uid}": None for uid in stale})
+
+def leaderboard_text():
+    global _lb_text
+    with _lb_lock:
+        if _lb_text is not None:
+            return _lb_text
+        top = sorted(_lb_rows.items(), key=lambda kv: kv[1][:2], reverse=True)[:LEADERBOARD_SIZE]
+        if not top:
+            return None
+        text = "<b>🏆 Top Referrers</b>\n\n"
+        for i, (uid, (refs, pts, name)) in enumerate(top, start=1):
+            display = f"@{name}" if not name.startswith("ID:") and not name.isdigit() else name
+            text += f"{i}. {display} — {refs} refs — {pts} pts\n"
+        _lb_text = text
+        return text
+
+# ------------------ Global stats counters ------------------
+# Running totals kept in memory and under /stats. Writers send deltas as
+# server-side increments; reconcile_stats() periodically recomputes them.
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+def _stats_apply(node, path, delta):
+    keys = path.split("/")
+    for k in keys[:-1]:
+        node = node.setdefault(k, {})
+    node[keys[-1]] = (node.get(keys[-1], 0) or 0) + delta
+
+def stats_add_local(deltas):
+    with _stats_lock:
+        for path, delta in deltas.items():
+            _stats_apply(_stats, path, delta)
+
+def stats_snapshot():
+    with _stats_lock:
+        snap = dict(_stats)
+        snap["task_completions"] = dict(_stats.get("task_completions") or {})
+    return snap
+
+def _stats_paths(node, prefix=""):
+    """{"a/b": n} for the counters in a /stats tree."""
+    out = {}
+    for k, v in (node or {}).items():
+        if isinstance(v, dict):
+            out.update(_stats_paths(v, f"{prefix}{k}/"))
+        elif isinstance(v, (int, float)):
+            out[prefix + k] = v
+    return out
+
+def reconcile_stats():
+    """Recompute the counters by paging through users and completions. The
+    correction is written as increments against the totals read before the
+    scan, so counts that arrive while it runs (from any process) are kept."""
+    if ledger is not None and ledger.ready:
+        ledger.flush()
+    before = _stats_paths(store.get("stats"))
+    users = referrals = held = 0
+    for _, u in iter_users():
+        users += 1
+        referrals += u.get("referrals", 0) or 0
+        held += u.get("points", 0) or 0
+    per_task = {}
+    for _, done in iter_children("completions"):
+        for tid in done:
+            per_task[tid] = per_task.get(tid, 0) + 1
+    ads = store.count("ads/published")
+    # spent points cannot be recovered from balances, so keep the running
+    # total and derive issued from what users actually hold
+    spent = before.get("points_spent", 0)
+    after = {
+        "users": users,
+        "referrals": referrals,
+        "points_issued": held + spent,
+        "points_spent": spent,
+        "ads_published": ads,
+    }
+    after.update({f"task_completions/{tid}": n for tid, n in per_task.items()})
+    deltas = {path: after.get(path, 0) - before.get(path, 0) for path in set(after) | set(before)}
+    ledger_write({}, deltas)
+    logger.info("Stats reconciled: %d users, %d points held.", users, held)
+
+def load_stats():
+    saved = store.get("stats")
+    if not saved:
+        reconcile_stats()
+        return
+    with _stats_lock:
+        _stats.clear()
+        _stats.update(saved)
+
+def refresh_shared_state():
+    """Reload /stats and /leaderboard as every process has written them."""
+    saved = store.get("stats")
+    if saved:
+        with _stats_lock:
+            _stats.clear()
+            _stats.update(saved)
+    saved = store.get("leaderboard")
+    if saved:
+        _lb_load(saved)
+
+def run_every(interval, fn, name):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                fn()
+            except Exception:
+                logger.exception("Background job %s failed", name)
+    t = threading.Thread(target=loop, name=name, daemon=True)
+    t.start()
+    return t
+
+# ------------------ Referral index ------------------
+# referrals/<referrer>/<uid> answers "whom did I refer?" by key-ordered
+# pages, and the referral tree is summed up by counters on each profile, so
+# neither ever scans the users tree.
+
+def referral_page(uid, start_after=None, limit=REFERRALS_PER_PAGE):
+    """[(uid, entry)] of users uid referred, in key order after start_after."""
+    return [(k, v) for k, v in store.page(f"referrals/{uid}", start_after=start_after, limit=limit)
+            if isinstance(v, dict)]
+
+def referral_levels(u):
+    """Users per level below u (level 1: direct referrals), as counted by
+    credit_referral; empty levels at the bottom are left out."""
+    counts = [u.get("referrals", 0) or 0]
+    counts += [u.get(f"referrals_l{n}", 0) or 0 for n in range(2, REFERRAL_TREE_DEPTH + 1)]
+    while counts and not counts[-1]:
+        counts.pop()
+    return counts
+
+# ------------------ Task catalog ------------------
+# Process-local copy of /tasks, loaded at startup and kept current by a
+# streaming listener. Available tasks are indexed by type so listings never
+# touch the network. catalog_version bumps on every change.
+
+_catalog_lock = threading.Lock()
+_catalog = {}            # tid -> task dict (all tasks, available or not)
+_catalog_by_type = {}    # type -> {tid: task}, available tasks only, tid order
+_catalog_available = {}  # tid -> task, available tasks only, tid order
+_catalog_listener = None
+catalog_version = 0
+
+def _catalog_reindex():
+    # indexes are swapped, never mutated, so readers can iterate them unlocked
+    global catalog_version, _catalog_by_type, _catalog_available
+    by_type = {}
+    available = {}
+    for tid in sorted(_catalog):
+        t = _catalog[tid]
+        if not isinstance(t, dict) or not t.get("available", True):
+            continue
+        t = dict(t)
+        available[tid] = t
+        by_type.setdefault(t.get("type"), {})[tid] = t
+    _catalog_by_type = by_type
+    _catalog_available = available
+    catalog_version += 1
+
+def _catalog_put(parts, data):
+    if not parts:
+        _catalog.clear()
+        _catalog.update(data or {})
+        return
+    tid, rest = parts[0], parts[1:]
+    if not rest:
+        if data is None:
+            _catalog.pop(tid, None)
+        else:
+            _catalog[tid] = data
+        return
+    node = _catalog.setdefault(tid, {})
+    for k in rest[:-1]:
+        node = node.setdefault(k, {})
+    if data is None:
+        node.pop(rest[-1], None)
+    else:
+        node[rest[-1]] = data
+
+def _on_tasks_event(event):
+    parts = [p for p in (event.path or "/").split("/") if p]
+    with _catalog_lock:
+        if event.event_type == "patch":
+            for k, v in (event.data or {}).items():
+                _catalog_put(parts + [p for p in k.split("/") if p], v)
+        else:
+            _catalog_put(parts, event.data)
+        _catalog_reindex()
+
+def catalog_set_task(tid, task):
+    """Apply a local write right away; the listener echo is idempotent."""
+    catalog_set_tasks({tid: task})
+
+def catalog_set_tasks(tasks):
+    with _catalog_lock:
+        for tid, task in tasks.items():
+            _catalog_put([tid], task)
+        _catalog_reindex()
+
+def load_task_catalog():
+    global _catalog_listener
+    with _catalog_lock:
+        _catalog_put([], store.get_tasks())
+        _catalog_reindex()
+    if _catalog_listener is None:
+        _catalog_listener = store.listen("tasks", _on_tasks_event)
+
+def get_task(tid):
+    return _catalog_available.get(tid) or _catalog.get(tid)
+
+def available_tasks(task_type=None):
+    """Available tasks as {tid: task}; do not mutate the result."""
+    if task_type is None:
+        return _catalog_available
+    return _catalog_by_type.get(task_type, {})
+
+# ------------------ Render cache ------------------
+# Finished task list pages (text + serialized inline keyboard) per view,
+# rebuilt only when catalog_version changes. The main menu never changes.
+
+_render_lock = threading.Lock()
+_render_cache = {}  # view -> (catalog_version, [(text, markup_json), ...])
+# Listings without the tasks a user already did; users who finished the same
+# tasks share an entry
+_user_render_cache = OrderedDict()  # (view, catalog_version, hidden ids) -> pages
+USER_RENDER_CACHE_SIZE = 1000
+
+def build_main_menu():
+    # Build keyboard like the screenshot
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
+    markup.add(
+        types.KeyboardButton("💻 Visit Sites"),
+        types.KeyboardButton("📣 Join Channels"),
+        types.KeyboardButton("🤖 Join Bots")
+    )
+    markup.add(
+        types.KeyboardButton("😄 More"),
+        types.KeyboardButton("💰 Balance"),
+        types.KeyboardButton("🙌 Referrals")
+    )
+    markup.add(
+        types.KeyboardButton("ℹ️ Info"),
+    )
+    # big advertise button (single)
+    markup.add(types.KeyboardButton("📊 Advertise"))
+    return markup
+
+MAIN_MENU_MARKUP = build_main_menu().to_json()
+
+def _task_line(t):
+    return f"• <b>{t.get('title')}</b> — {t.get('points')} pts\n  {t.get('description')}\n\n"
+
+def _render_task_pages(view, tasks):
+    """view is "all" (the /tasks listing) or a task type."""
+    if view == "all":
+        header, footer = "<b>Available Tasks</b>\n\n", "Tap a task button below to start one."
+    else:
+        header, footer = f"<b>Tasks — {view}</b>\n\n", ""
+    chunks, current, size = [], [], 0
+    for tid, t in tasks.items():
+        line = _task_line(t)
+        if current and (len(current) >= TASKS_PER_PAGE or size + len(line) > TASK_PAGE_MAX_CHARS):
+            chunks.append(current)
+            current, size = [], 0
+        current.append((tid, t, line))
+        size += len(line)
+    if current:
+        chunks.append(current)
+
+    pages = []
+    for n, chunk in enumerate(chunks):
+        text = header + "".join(line for _, _, line in chunk) + footer
+        markup = types.InlineKeyboardMarkup()
+        for tid, t, _ in chunk:
+            markup.add(types.InlineKeyboardButton(f"{t.get('title')} — {t.get('points')} pts", callback_data=f"task_open:{tid}"))
+        if len(chunks) > 1:
+            nav = []
+            if n > 0:
+                nav.append(types.InlineKeyboardButton("« Prev", callback_data=f"tasks_page:{view}:{n - 1}"))
+            nav.append(types.InlineKeyboardButton(f"{n + 1}/{len(chunks)}", callback_data=f"tasks_page:{view}:{n}"))
+            if n + 1 < len(chunks):
+                nav.append(types.InlineKeyboardButton("Next »", callback_data=f"tasks_page:{view}:{n + 1}"))
+            markup.row(*nav)
+        pages.append((text, markup.to_json()))
+    return pages
+
+def task_pages(view, uid=None):
+    """Rendered pages of a listing; with uid, tasks that user completed are left out."""
+    version = catalog_version
+    tasks = available_tasks(None if view == "all" else view)
+    hidden = completed_tasks(uid).intersection(tasks) if uid is not None else None
+    if hidden:
+        key = (view, version, frozenset(hidden))
+        with _render_lock:
+            pages = _user_render_cache.get(key)
+            if pages is not None:
+                _user_render_cache.move_to_end(key)
+                return pages
+        pages = _render_task_pages(view, {tid: t for tid, t in tasks.items() if tid not in hidden})
+        with _render_lock:
+            _user_render_cache[key] = pages
+            while len(_user_render_cache) > USER_RENDER_CACHE_SIZE:
+                _user_render_cache.popitem(last=False)
+        return pages
+    cached = _render_cache.get(view)
+    if cached and cached[0] == version:
+        return cached[1]
+    pages = _render_task_pages(view, tasks)
+    with _render_lock:
+        _render_cache[view] = (version, pages)
+    return pages
+
 def seed_sample_tasks():
     """Create sample tasks if tasks list is empty. Id keys are strings."""
-    existing = tasks_ref.get()
+    existing = store.get("tasks", shallow=True)
     if existing:
         return
     sample = {
@@ -147,180 +1070,156 @@ def seed_sample_tasks():
             "available": True
         }
     }
-    tasks_ref.set(sample)
+    store.set("tasks", sample)
+    with _catalog_lock:
+        _catalog_put([], sample)
+        _catalog_reindex()
     logger.info("Seeded sample tasks.")
 
 
-# ------------------ Bot Handlers ------------------
+# ------------------ Membership checks ------------------
 
-@bot.message_handler(commands=['start'])
-def handle_start(message):
-    args = message.text.split()
-    user = message.from_user
-    uid = str(user.id)
-    username = user.username or ""
-    first_name = user.first_name or ""
-    create_user_if_missing(uid, username=username, first_name=first_name)
+def _chat_member_status(channel, user_id):
+    chat = channel if channel.lstrip("-").isdigit() else "@" + channel
+    return bot.get_chat_member(chat, user_id).status
+
+def on_membership_result(channel, uid, outcome, claim):
+    """Confirm or revoke a pending join_channel claim once its check is done."""
+    tid, points, chat_id = claim
+    if store.get(f"claims/pending/{uid}/{tid}") is None:
+        return      # settled already (queued twice across a restart)
+    if outcome == NOT_MEMBER:
+        balance = revoke_claim(uid, tid, points)
+        outbox.notify(chat_id, f"❌ You are not in @{channel}, so the {points} pts for that task "
+                                  f"were taken back.\nJoin the channel and claim the task again.\n"
+                                  f"Points: <b>{balance}</b>")
+    else:
+        settle_claim(uid, tid, outcome == MEMBER)
+
+verifier = MembershipVerifier(_chat_member_status, on_membership_result,
+                              member_ttl=MEMBER_CACHE_TTL, non_member_ttl=NON_MEMBER_CACHE_TTL,
+                              channel_ttl=CHANNEL_BLOCK_TTL, per_channel_interval=MEMBER_CHECK_INTERVAL)
+
+
+# ------------------ Ad broadcasts ------------------
+
+def ad_broadcast_text(ad):
+    return f"📢 <b>Sponsored</b>\n\n{html.escape(ad.get('text') or '')}"
+
+def on_broadcast_finished(ad_id, ad, state):
+    if ad.get("owner"):
+        outbox.notify(int(ad["owner"]), f"📢 Your ad was delivered to <b>{state['sent']}</b> users.")
+
+def on_users_blocked(uids):
+    # the broadcaster flags them in the database directly; register_start
+    # must see the flag to clear it when they come back
+    for uid in uids:
+        user_cache_drop(uid)
+
+broadcaster = Broadcaster(store, outbox, ad_broadcast_text, page_size=BROADCAST_PAGE_SIZE,
+                          budget_share=AD_BROADCAST_SHARE, on_finished=on_broadcast_finished,
+                          on_blocked=on_users_blocked, page_timeout=BROADCAST_PAGE_TIMEOUT)
+
+# ------------------ Ad impressions ------------------
+# Broadcasts and impressions draw on the same budget: ad["cost"] displays,
+# of which broadcasts may use AD_BROADCAST_SHARE.
 
-    # Referral logic
-    if len(args) > 1:
-        referrer_id = args[1]
+def ad_snippet(ad):
+    text = ad.get("text") or ""
+    if len(text) > AD_SNIPPET_MAX:
+        text = text[:AD_SNIPPET_MAX - 1] + "…"
+    return f"\n\n📢 <b>Sponsored:</b> {html.escape(text)}"
+
+adserver = AdServer(store, ad_snippet, flush_interval=AD_FLUSH_INTERVAL)
+
+def with_ad(text, uid):
+    """text, with an ad impression for uid appended AD_SERVE_RATE of the time."""
+    if random.random() >= AD_SERVE_RATE:
+        return text
+    snippet = adserver.pick(uid)
+    return text + snippet if snippet else text
+
+
+# ------------------ Views ------------------
+# Handler logic shared by the polling bot below and the async webhook bot
+# (webhook_bot.py): these do the storage work and return what to send.
+
+HELP_TEXT = ("Commands:\n/tasks - list tasks\n/points or press Balance - see balance\n/referrals - see referral info\n"
+             "/advertise - create an ad\n/leaderboard - top referrers\n\n"
+             "Admins can use /addtask /removetask /addpoints /stats /rebuildleaderboard /broadcasts /broadcast /profile /importtasks")
+INFO_TEXT = "This bot gives points for completing tasks. Use /tasks to list everything. Advertise to spend points."
+FALLBACK_TEXT = "Use the keyboard or /tasks /balance /referrals /advertise"
+AD_PROMPT_TEXT = "📣 Create an advertisement.\nSend the ad text you want to publish (plain text)."
+
+def register_start(uid, username, first_name, referrer_id=None):
+    """Create the user and apply a referral credit. Returns (user, referrer id
+    if a credit was made)."""
+    me = create_user_if_missing(uid, username=username, first_name=first_name)
+    if me.get("blocked"):
+        # back after blocking the bot: include them in broadcasts again
+        me = ledger_write({f"users/{uid}/blocked": None}, touched=[(uid, me)])[uid]
+    credited = None
+    if referrer_id:
         try:
             if referrer_id != uid:
                 referrer = get_user(referrer_id)
-                me = get_user(uid)
                 # only credit if referrer exists and user has not been referred before
                 if referrer and not me.get("referred_by"):
-                    add_points(referrer_id, POINTS_FOR_REFERRAL)
-                    incr_referrals(referrer_id, 1)
-                    users_ref.child(uid).update({"referred_by": referrer_id})
-                    # notify referrer
-                    try:
-                        bot.send_message(int(referrer_id),
-                                         f"🎉 You got <b>{POINTS_FOR_REFERRAL}</b> points! @{username or first_name} joined with your link.")
-                    except Exception:
-                        logger.info("Could not notify referrer (dm may be blocked).")
+                    me = credit_referral(referrer_id, referrer, uid, me)
+                    credited = referrer_id
         except Exception as e:
             logger.exception("Referral error: %s", e)
+    return me, credited
 
-    # Build keyboard like the screenshot
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
-    markup.add(
-        types.KeyboardButton("💻 Visit Sites"),
-        types.KeyboardButton("📣 Join Channels"),
-        types.KeyboardButton("🤖 Join Bots")
-    )
-    markup.add(
-        types.KeyboardButton("😄 More"),
-        types.KeyboardButton("💰 Balance"),
-        types.KeyboardButton("🙌 Referrals")
-    )
-    markup.add(
-        types.KeyboardButton("ℹ️ Info"),
-    )
-    # big advertise button (single)
-    markup.add(types.KeyboardButton("📊 Advertise"))
-
-    bot.send_message(message.chat.id,
-                     f"Hi {first_name} 👋\n{format_points_info(get_user(uid))}\n\n"
-                     f"Your referral link:\n{build_referral_link(uid)}\n\n"
-                     "Share it and earn points!",
-                     reply_markup=markup)
+def welcome_text(uid, first_name, me):
+    return (f"Hi {first_name} 👋\n{format_points_info(me)}\n\n"
+            f"Your referral link:\n{build_referral_link(uid)}\n\n"
+            "Share it and earn points!")
 
-@bot.message_handler(commands=['help'])
-def handle_help(message):
-    bot.reply_to(message,
-                 "Commands:\n/tasks - list tasks\n/points or press Balance - see balance\n/referrals - see referral info\n/advertise - create an ad\n/leaderboard - top referrers\n\nAdmins can use /addtask /removetask /addpoints /stats")
+def referral_notice_text(username, first_name):
+    return f"🎉 You got <b>{POINTS_FOR_REFERRAL}</b> points! @{username or first_name} joined with your link."
 
-@bot.message_handler(commands=['tasks'])
-def handle_tasks_cmd(message):
-    show_tasks_to_user(message.chat.id, message.from_user.id)
-
-@bot.message_handler(commands=['balance'])
-def cmd_balance(message):
-    uid = str(message.from_user.id)
-    create_user_if_missing(uid)
-    bot.reply_to(message, format_points_info(get_user(uid)))
-
-@bot.message_handler(commands=['referrals'])
-def cmd_referrals(message):
-    uid = str(message.from_user.id)
-    create_user_if_missing(uid)
-    u = get_user(uid)
+def referrals_text(u):
     ref_by = u.get("referred_by") or "—"
-    bot.reply_to(message, f"{format_points_info(u)}\nReferred by: {ref_by}")
+    return f"{format_points_info(u)}\nReferred by: {ref_by}"
 
-@bot.message_handler(commands=['leaderboard'])
-def cmd_leaderboard(message):
-    all_users = users_ref.get() or {}
-    items = []
-    for k,v in all_users.items():
-        pts = v.get("points",0) or 0
-        refs = v.get("referrals",0) or 0
-        name = v.get("username") or v.get("first_name") or f"ID:{k}"
-        items.append((k, refs, pts, name))
-    items.sort(key=lambda x: (x[1], x[2]), reverse=True)
-    top = items[:10]
-    if not top:
-        bot.reply_to(message, "No users yet.")
-        return
-    text = "<b>🏆 Top Referrers</b>\n\n"
-    for i,(uid,refs,pts,name) in enumerate(top, start=1):
-        display = f"@{name}" if not name.startswith("ID:") and not name.isdigit() else name
-        text += f"{i}. {display} — {refs} refs — {pts} pts\n"
-    bot.reply_to(message, text)
-
-# Quick UI button handler (keyboard presses)
-@bot.message_handler(func=lambda m: True, content_types=['text'])
-def ui_buttons(message):
-    txt = message.text.strip().lower()
-    if txt in ("💻 visit sites", "visit sites", "visit"):
-        show_tasks_filtered(message.chat.id, message.from_user.id, task_type="visit")
-    elif txt in ("📣 join channels", "join channels", "channels"):
-        show_tasks_filtered(message.chat.id, message.from_user.id, task_type="join_channel")
-    elif txt in ("🤖 join bots", "join bots", "bots"):
-        show_tasks_filtered(message.chat.id, message.from_user.id, task_type="join_bot")
-    elif txt in ("😄 more", "more"):
-        show_tasks_filtered(message.chat.id, message.from_user.id, task_type="other")
-    elif txt in ("💰 balance", "balance", "/points", "/balance"):
-        create_user_if_missing(str(message.from_user.id))
-        bot.reply_to(message, format_points_info(get_user(str(message.from_user.id))))
-    elif txt in ("🙌 referrals", "referrals", "/referrals"):
-        cmd_referrals(message)
-    elif txt in ("ℹ️ info", "info"):
-        bot.reply_to(message, "This bot gives points for completing tasks. Use /tasks to list everything. Advertise to spend points.")
-    elif txt in ("📊 advertise", "advertise"):
-        start_ad_flow(message)
-    else:
-        bot.reply_to(message, "Use the keyboard or /tasks /balance /referrals /advertise")
+def referral_list_view(uid, page=0, start_after=None, header=""):
+    """(text, markup) of one page of uid's referrals; start_after is the
+    last uid of the previous page."""
+    rows = referral_page(uid, start_after, REFERRALS_PER_PAGE + 1)
+    more = len(rows) > REFERRALS_PER_PAGE
+    rows = rows[:REFERRALS_PER_PAGE]
+    if not rows:
+        return header + "Nobody joined with your link yet.", None
+    text = header + f"<b>Your referrals</b> (page {page + 1})\n"
+    for i, (ref_uid, entry) in enumerate(rows, start=page * REFERRALS_PER_PAGE + 1):
+        joined = time.strftime("%Y-%m-%d", time.gmtime(entry.get("time") or 0))
+        text += f"{i}. {html.escape(str(entry.get('name') or ref_uid))} — {joined}\n"
+    markup = None
+    if page or more:
+        markup = types.InlineKeyboardMarkup()
+        nav = []
+        if page:
+            nav.append(types.InlineKeyboardButton("« First", callback_data="refs_page:0:"))
+        if more:
+            nav.append(types.InlineKeyboardButton("Next »", callback_data=f"refs_page:{page + 1}:{rows[-1][0]}"))
+        markup.row(*nav)
+    return text, markup
 
-# ---------------- Task listing & claiming ----------------
+def referrals_view(uid, u):
+    """/referrals: balance, referral tree summary and the first page of referrals."""
+    counts = referral_levels(u)
+    header = referrals_text(u) + "\n"
+    if counts:
+        levels = " · ".join(f"L{n}: {c}" for n, c in enumerate(counts, start=1))
+        header += f"Referral tree: {levels}\n"
+    return referral_list_view(uid, header=header + "\n")
 
-def show_tasks_to_user(chat_id, user_id):
-    all_tasks = tasks_ref.get() or {}
-    if not all_tasks:
-        bot.send_message(chat_id, "No tasks available right now.")
-        return
-    text = "<b>Available Tasks</b>\n\n"
-    for tid, t in all_tasks.items():
-        if not t.get("available", True):
-            continue
-        text += f"• <b>{t.get('title')}</b> — {t.get('points')} pts\n  {t.get('description')}\n\n"
-    text += "Tap a task button below to start one."
-    # Provide inline keyboard with task buttons
-    markup = types.InlineKeyboardMarkup()
-    for tid,t in all_tasks.items():
-        if not t.get("available", True):
-            continue
-        btn = types.InlineKeyboardButton(f"{t.get('title')} — {t.get('points')} pts", callback_data=f"task_open:{tid}")
-        markup.add(btn)
-    bot.send_message(chat_id, text, reply_markup=markup)
-
-def show_tasks_filtered(chat_id, user_id, task_type=None):
-    all_tasks = tasks_ref.get() or {}
-    found = False
-    markup = types.InlineKeyboardMarkup()
-    text = f"<b>Tasks — {task_type or 'All'}</b>\n\n"
-    for tid, t in all_tasks.items():
-        if not t.get("available", True):
-            continue
-        if task_type and t.get("type") != task_type:
-            continue
-        found = True
-        text += f"• <b>{t.get('title')}</b> — {t.get('points')} pts\n  {t.get('description')}\n\n"
-        markup.add(types.InlineKeyboardButton(f"{t.get('title')} — {t.get('points')} pts", callback_data=f"task_open:{tid}"))
-    if not found:
-        bot.send_message(chat_id, "No tasks of this type are available right now.")
-        return
-    bot.send_message(chat_id, text, reply_markup=markup)
-
-@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("task_open:"))
-def callback_task_open(call):
-    task_id = call.data.split(":",1)[1]
-    t = tasks_ref.child(task_id).get()
+def task_open_view(task_id):
+    """(text, markup) for a single task, or None if it does not exist."""
+    t = get_task(task_id)
     if not t:
-        bot.answer_callback_query(call.id, "Task not found.")
-        return
+        return None
     # Build specific UI depending on type
     ttype = t.get("type")
     text = f"<b>{t.get('title')}</b>\n\n{t.get('description')}\n\nReward: <b>{t.get('points')}</b> pts"
@@ -347,151 +1246,118 @@ def callback_task_open(call):
         # fallback
         markup.add(types.InlineKeyboardButton("Open Link", url=t.get("url","https://example.com")))
         markup.add(types.InlineKeyboardButton("Done ✅", callback_data=f"task_done:{task_id}"))
+    return text, markup
 
-    bot.send_message(call.message.chat.id, text, reply_markup=markup)
-    bot.answer_callback_query(call.id)
-
-@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("task_done:"))
-def callback_task_done(call):
-    data = call.data.split(":",1)[1]
-    tid = data
-    user = call.from_user
-    uid = str(user.id)
-
-    t = tasks_ref.child(tid).get()
+def prepare_claim(uid, username, first_name, tid):
+    """Look up the task and user for a claim. Returns (task, user, error text)."""
+    t = get_task(tid)
     if not t:
-        bot.answer_callback_query(call.id, "Task not found.")
-        return
-
+        return None, None, "Task not found."
     # Ensure user and completion structure
-    create_user_if_missing(uid, username=user.username or "", first_name=user.first_name or "")
-    user_completions = completions_ref.child(uid).get() or {}
-
+    me = create_user_if_missing(uid, username=username, first_name=first_name)
     # Prevent double-completion of the same task
-    if user_completions.get(tid):
-        bot.answer_callback_query(call.id, "You already completed this task.")
-        return
+    if tid in completed_tasks(uid):
+        return t, me, "You already completed this task."
+    return t, me, None
 
-    # Attempt automated verification for join_channel tasks by checking membership
-    verified = False
-    if t.get("type") == "join_channel":
-        # try to check membership if channel username provided and bot can access
-        ch = t.get("channel_username")
-        if ch:
-            try:
-                ch_id = ch.lstrip('@')
-                chat_member = bot.get_chat_member(chat_id=ch_id, user_id=int(uid))
-                # if status is not 'left' then member
-                status = getattr(chat_member, 'status', None)
-                if status and status not in ("left", "kicked"):
-                    verified = True
-            except Exception as ex:
-                # cannot verify (private channel or bot not admin). fallback to manual confirm.
-                logger.info("Could not verify membership automatically: %s", ex)
-
-    # If other types, we cannot automatically verify visits or bot starts reliably.
-    # So record as completed and award points (this is the usual approach).
-
-    # Record completion and award points
-    completions_ref.child(uid).child(tid).set({
-        "task_id": tid,
-        "title": t.get("title"),
-        "points": t.get("points"),
-        "time": int(time.time()),
-        "verified": bool(verified)
-    })
-    add_points(uid, int(t.get("points", 0) or 0))
+def membership_channel(t):
+    """Channel to check membership in for join_channel tasks, if any."""
+    if t.get("type") != "join_channel":
+        return None
+    ch = t.get("channel_username")
+    return ch.lstrip('@') if ch else None
 
-    # Increment global counters if you want (optional)
-    # Optionally, mark task unavailable if single-use: tasks_ref.child(tid).update({"available": False})
+def claim_task(uid, me, tid, t, chat_id):
+    """Record a claim checked by prepare_claim. Returns (callback answer, chat
+    message or None). join_channel claims are settled from the membership
+    cache when possible; otherwise points are paid now and the claim stays
+    pending until the background check confirms or revokes it."""
+    ch = membership_channel(t)
+    known = verifier.cached(ch, uid) if ch else UNVERIFIABLE
+    if known == NOT_MEMBER:
+        return f"Join @{ch} first, then tap the button again.", None
+    if known is None:
+        new_points = complete_task(uid, me, tid, t, pending={"channel": ch, "chat_id": chat_id})
+        verifier.submit(ch, uid, (tid, int(t.get("points", 0) or 0), chat_id))
+        return task_done_texts(t, me, new_points, pending=True)
+    # cannot verify (private channel or bot not admin) or no channel: the claim stands
+    new_points = complete_task(uid, me, tid, t, verified=known == MEMBER)
+    return task_done_texts(t, me, new_points)
 
-    # Notify user
-    bot.answer_callback_query(call.id, f"Task completed! You earned {t.get('points')} pts.")
-    bot.send_message(call.message.chat.id, f"✅ Task completed!\nYou received <b>{t.get('points')}</b> points.\n{format_points_info(get_user(uid))}")
+def task_done_texts(t, me, new_points, pending=False):
+    """(callback answer, chat message) after a successful claim."""
+    note = "\nWe are checking that you joined the channel; the points are taken back if you did not." if pending else ""
+    return (f"Task completed! You earned {t.get('points')} pts.",
+            f"✅ Task completed!\nYou received <b>{t.get('points')}</b> points.{note}\n{format_points_info(dict(me, points=new_points))}")
 
-# ---------------- Advertise flow (simple) ----------------
+def ad_cost(text):
+    # simple pricing: length-based cost (example)
+    return max(10, min(500, len(text)))  # example: min 10 pts, max 500 pts
 
-def start_ad_flow(message_or_call):
-    # accept both message and callback-like objects
-    if isinstance(message_or_call, types.Message):
-        chat_id = message_or_call.chat.id
-        user = message_or_call.from_user
-    else:
-        chat_id = message_or_call.message.chat.id
-        user = message_or_call.from_user
+def ad_confirm_text(text, cost):
+    return f"Your ad:\n\n{text}\n\nCost: <b>{cost}</b> pts\n\nSend 'confirm' to pay and publish or 'cancel'."
 
-    uid = str(user.id)
+def begin_ad_flow(uid):
+    """Start the advertise flow for uid; returns the prompt."""
     create_user_if_missing(uid)
+    conversations.set(uid, "ad_text")
+    return AD_PROMPT_TEXT
 
-    # Ask for ad text and cost (simple linear cost: 1 pt per display)
-    msg = bot.send_message(chat_id, "📣 Create an advertisement.\nSend the ad text you want to publish (plain text).")
-    bot.register_next_step_handler(msg, process_ad_text)
+def conversation_reply(uid, text):
+    """Feed a message to uid's flow; returns the reply, or None without a flow.
+    Nothing touches the database before the final confirm."""
+    state = conversations.pop(uid)
+    if state is None:
+        return None
+    step, data = state
+    text = (text or "").strip()
+    if step == "ad_text":
+        if not text:
+            return "Ad text cannot be empty. Try /advertise again."
+        cost = ad_cost(text)
+        conversations.set(uid, "ad_confirm", {"text": text, "cost": cost, "time": int(time.time())})
+        return ad_confirm_text(text, cost)
+    if step == "ad_confirm":
+        return finalize_ad(uid, text.lower(), data)
+    return None
 
-def process_ad_text(message):
-    text = message.text.strip()
-    if not text:
-        bot.reply_to(message, "Ad text cannot be empty. Try /advertise again.")
-        return
-    # simple pricing: length-based cost (example)
-    cost = max(10, min(500, len(text)))  # example: min 10 pts, max 500 pts
-    confirm = bot.send_message(message.chat.id, f"Your ad:\n\n{text}\n\nCost: <b>{cost}</b> pts\n\nSend 'confirm' to pay and publish or 'cancel'.")
-    # store temporary payload in db under ads_pending/<user_id>
-    ads_ref.child("pending").child(str(message.from_user.id)).set({
-        "text": text,
+def finalize_ad(uid, txt, pending):
+    """Settle the pending ad for uid given the user's reply; returns the reply text."""
+    if txt != "confirm":
+        return "Ad creation canceled."
+    user = get_user(uid)
+    points = user.get("points", 0) or 0
+    cost = pending.get("cost", 0)
+    # points of claims still being checked may be taken back: not spendable yet
+    held = held_points(uid)
+    if points - held < cost:
+        if held:
+            return (f"Not enough points (You have {points}, of which {held} wait for a channel "
+                    f"check; need {cost}).")
+        return f"Not enough points (You have {points}, need {cost})."
+    # Deduct and publish ad to ads list
+    ad_id = f"ad_{int(time.time())}_{uid}"
+    new_points = debit_for_ad(uid, user, ad_id, {
+        "owner": uid,
+        "text": pending.get("text"),
         "cost": cost,
-        "time": int(time.time())
+        "time": pending.get("time") or int(time.time())
     })
-    bot.register_next_step_handler(confirm, finalize_ad_payment)
+    if AD_BROADCAST_SHARE > 0:
+        broadcaster.enqueue(ad_id)
+    return f"✅ Ad published! {cost} pts deducted.\n{format_points_info(dict(user, points=new_points))}"
 
-def finalize_ad_payment(message):
-    txt = message.text.strip().lower()
-    uid = str(message.from_user.id)
-    pending = ads_ref.child("pending").child(uid).get()
-    if not pending:
-        bot.reply_to(message, "No pending ad. Start with /advertise.")
-        return
-    if txt == "confirm":
-        user = get_user(uid)
-        points = user.get("points", 0) or 0
-        cost = pending.get("cost", 0)
-        if points < cost:
-            bot.reply_to(message, f"Not enough points (You have {points}, need {cost}).")
-            ads_ref.child("pending").child(uid).delete()
-            return
-        # Deduct and publish ad to ads list
-        new_points = points - cost
-        users_ref.child(uid).update({"points": new_points})
-        ad_id = f"ad_{int(time.time())}_{uid}"
-        ads_ref.child("published").child(ad_id).set({
-            "owner": uid,
-            "text": pending.get("text"),
-            "cost": cost,
-            "time": int(time.time())
-        })
-        ads_ref.child("pending").child(uid).delete()
-        bot.reply_to(message, f"✅ Ad published! {cost} pts deducted.\n{format_points_info(get_user(uid))}")
-        # In production you would distribute ads (e.g., show to users via broadcast or attach to tasks)
-    else:
-        ads_ref.child("pending").child(uid).delete()
-        bot.reply_to(message, "Ad creation canceled.")
-
-# ---------------- Admin: add/remove tasks & misc ----------------
-
-@bot.message_handler(commands=['addtask'])
-@require_admin
-def cmd_addtask(message):
+def addtask_reply(text):
     # Expect a simple payload after command or ask step-by-step.
     # Format (single-line): /addtask <taskid>|<type>|<title>|<points>|<description>|<url_or_username>
-    parts = message.text.split(" ",1)
+    parts = text.split(" ",1)
     if len(parts) == 1:
-        bot.reply_to(message, "Usage: /addtask <taskid>|<type>|<title>|<points>|<description>|<url_or_username>\nExample: /addtask task10|visit|Visit Site|3|Open example|https://example.com")
-        return
+        return "Usage: /addtask <taskid>|<type>|<title>|<points>|<description>|<url_or_username>\nExample: /addtask task10|visit|Visit Site|3|Open example|https://example.com"
     payload = parts[1]
     try:
         tid, ttype, title, pts, desc, link = payload.split("|",5)
     except Exception:
-        bot.reply_to(message, "Invalid format. See usage.")
-        return
+        return "Invalid format. See usage."
     task_obj = {
         "type": ttype.strip(),
         "title": title.strip(),
@@ -505,49 +1371,532 @@ def cmd_addtask(message):
         task_obj["channel_username"] = link.strip()
     elif ttype.strip() == "join_bot":
         task_obj["bot_username"] = link.strip()
-    tasks_ref.child(tid.strip()).set(task_obj)
-    bot.reply_to(message, f"Task {tid} added.")
+    store.set(f"tasks/{tid.strip()}", task_obj)
+    catalog_set_task(tid.strip(), task_obj)
+    return f"Task {tid} added."
 
-@bot.message_handler(commands=['removetask'])
-@require_admin
-def cmd_removetask(message):
-    parts = message.text.split()
+IMPORT_USAGE = ("Send a JSON or CSV file of tasks with the caption /importtasks, or reply /importtasks to one.\n"
+                "CSV columns: id,type,title,points,description,link\n"
+                "JSON: {\"task_id\": {\"type\": ..., \"title\": ..., \"points\": ..., \"link\": ...}}")
+
+def importtasks_reply(data, filename):
+    """Validate a task file and apply it in one update (or not at all)."""
+    try:
+        tasks = bulk_io.parse_tasks(data, filename)
+    except (ValueError, UnicodeDecodeError) as e:
+        return f"❌ Nothing imported:\n{html.escape(str(e))}"
+    new = sum(1 for tid in tasks if get_task(tid) is None)
+    try:
+        bulk_io.import_tasks(store, tasks)
+    except Exception as e:
+        logger.exception("Task import failed")
+        return f"❌ Nothing imported, the database write failed:\n{html.escape(str(e))}"
+    catalog_set_tasks(tasks)
+    return f"✅ Imported {len(tasks)} tasks ({new} new, {len(tasks) - new} updated)."
+
+def import_document(message):
+    """The document an /importtasks message carries or replies to, or None."""
+    for m in (message, message.reply_to_message):
+        if m is not None and m.document is not None:
+            return m.document
+    return None
+
+def removetask_reply(text):
+    parts = text.split()
     if len(parts) != 2:
-        bot.reply_to(message, "Usage: /removetask <taskid>")
-        return
+        return "Usage: /removetask <taskid>"
     tid = parts[1]
-    tasks_ref.child(tid).delete()
-    bot.reply_to(message, f"Task {tid} removed.")
+    store.delete(f"tasks/{tid}")
+    catalog_set_task(tid, None)
+    return f"Task {tid} removed."
 
-@bot.message_handler(commands=['addpoints'])
-@require_admin
-def cmd_addpoints(message):
-    parts = message.text.split()
+def addpoints_reply(text):
+    parts = text.split()
     if len(parts) != 3:
-        bot.reply_to(message, "Usage: /addpoints <user_id> <amount>")
-        return
+        return "Usage: /addpoints <user_id> <amount>"
     target, amt = parts[1], parts[2]
     try:
         amt = int(amt)
     except:
-        bot.reply_to(message, "Amount must be integer.")
-        return
-    create_user_if_missing(target)
+        return "Amount must be integer."
     new = add_points(target, amt)
-    bot.reply_to(message, f"Added {amt} pts to {target}. New: {new}")
+    return f"Added {amt} pts to {target}. New: {new}"
+
+def stats_text():
+    st = stats_snapshot()
+    issued = st.get("points_issued", 0) or 0
+    spent = st.get("points_spent", 0) or 0
+    completions = st.get("task_completions") or {}
+    total_tasks = len(_catalog)
+    return (f"Users: {st.get('users', 0)}\nTotal points: {issued - spent}\n"
+            f"Points issued: {issued}\nPoints spent: {spent}\n"
+            f"Referrals: {st.get('referrals', 0)}\nAds published: {st.get('ads_published', 0)}\n"
+            f"Task completions: {sum(completions.values())}\nTasks: {total_tasks}\n"
+            f"User cache: {len(_user_cache)} cached, {user_cache_hit_rate():.0%} hit rate\n"
+            f"Dispatcher: {dispatcher.queued()} queued, {dispatcher.shed} shed\n"
+            f"Outbox: {outbox.queued()} queued, {outbox.stats['sent']} sent, "
+            f"{outbox.stats['throttled']} throttled, {outbox.stats['coalesced']} merged\n"
+            f"Admission: {admission.shed()} shed ({admission.stats['shed_user']} user, "
+            f"{admission.stats['shed_command']} command limit), {len(admission)} buckets\n"
+            f"Ads: {adserver.serving()} serving, {adserver.stats['served']} impressions "
+            f"({adserver.pending()} not yet saved)\n"
+            f"Ledger: {ledger.backlog() if ledger else 0} paths pending, "
+            f"{ledger.stats['flushes'] if ledger else 0} flushes\n"
+            f"Membership checks: {verifier.pending()} pending, {verifier.stats['checks']} calls, "
+            f"{verifier.hit_rate():.0%} cache hit rate")
+
+def broadcasts_text():
+    return broadcaster.report() or "No broadcasts yet."
+
+def broadcast_reply(text):
+    # /broadcast <ad_id>: (re)queue a published ad
+    parts = text.split()
+    if len(parts) < 2:
+        return "Usage: /broadcast <ad_id>"
+    ad_id = parts[1]
+    if not store.get_ad("published", ad_id):
+        return "Ad not found."
+    if not broadcaster.enqueue(ad_id):
+        return f"Broadcast of {ad_id} is already queued."
+    return f"Broadcast of {ad_id} queued."
+
+def profile_reply(text):
+    # /profile on | off | (no argument: report)
+    parts = text.split()
+    arg = parts[1].lower() if len(parts) > 1 else ""
+    if arg == "on":
+        return "Profiler started." if metrics.profiler.start() else "Profiler is already running."
+    if arg == "off":
+        stopped = metrics.profiler.stop()
+        return ("Profiler stopped.\n" if stopped else "Profiler is not running.\n") + metrics.profiler.top()
+    if not metrics.profiler.total:
+        return "Usage: /profile on | off | (report)"
+    state = "running" if metrics.profiler.running else "stopped"
+    return f"Profiler {state}.\n" + metrics.profiler.top()
+
+def rebuildleaderboard_reply():
+    n = rebuild_leaderboard()
+    return f"Leaderboard rebuilt ({n} users indexed)."
+
+
+# ------------------ Bot Handlers ------------------
+
+# A user in the middle of a flow (advertise) gets their next text message
+# routed to it before any other handler, commands included
+@bot.message_handler(func=lambda m: conversations.get(m.from_user.id) is not None, content_types=['text'])
+def conversation_step(message):
+    reply = conversation_reply(str(message.from_user.id), message.text)
+    if reply:
+        outbox.reply_to(message, reply)
+
+@bot.message_handler(commands=['start'])
+def handle_start(message):
+    args = message.text.split()
+    user = message.from_user
+    uid = str(user.id)
+    username = user.username or ""
+    first_name = user.first_name or ""
+    me, referrer_id = register_start(uid, username, first_name, args[1] if len(args) > 1 else None)
+    if referrer_id:
+        # notify referrer (fire-and-forget; a blocked dm only shows up in the outbox log)
+        outbox.notify(int(referrer_id), referral_notice_text(username, first_name))
+
+    outbox.send_message(message.chat.id, welcome_text(uid, first_name, me), reply_markup=MAIN_MENU_MARKUP)
+
+@bot.message_handler(commands=['help'])
+def handle_help(message):
+    outbox.reply_to(message, HELP_TEXT)
+
+@bot.message_handler(commands=['tasks'])
+def handle_tasks_cmd(message):
+    show_tasks_to_user(message.chat.id, message.from_user.id)
+
+@bot.message_handler(commands=['balance'])
+def cmd_balance(message):
+    uid = str(message.from_user.id)
+    outbox.reply_to(message, with_ad(format_points_info(create_user_if_missing(uid)), uid))
+
+@bot.message_handler(commands=['referrals'])
+def cmd_referrals(message):
+    uid = str(message.from_user.id)
+    text, markup = referrals_view(uid, create_user_if_missing(uid))
+    outbox.reply_to(message, text, reply_markup=markup)
+
+@bot.message_handler(commands=['leaderboard'])
+def cmd_leaderboard(message):
+    text = leaderboard_text()
+    if not text:
+        outbox.reply_to(message, "No users yet.")
+        return
+    outbox.reply_to(message, text)
+
+# Quick UI button handler (keyboard presses); registered last, see Startup
+_BUTTON_TASK_TYPES = {
+    "💻 visit sites": "visit", "visit sites": "visit", "visit": "visit",
+    "📣 join channels": "join_channel", "join channels": "join_channel", "channels": "join_channel",
+    "🤖 join bots": "join_bot", "join bots": "join_bot", "bots": "join_bot",
+    "😄 more": "other", "more": "other",
+}
+
+def ui_buttons(message):
+    txt = message.text.strip().lower()
+    task_type = _BUTTON_TASK_TYPES.get(txt)
+    if task_type:
+        show_tasks_filtered(message.chat.id, message.from_user.id, task_type=task_type)
+    elif txt in ("💰 balance", "balance", "/points", "/balance"):
+        cmd_balance(message)
+    elif txt in ("🙌 referrals", "referrals", "/referrals"):
+        cmd_referrals(message)
+    elif txt in ("ℹ️ info", "info"):
+        outbox.reply_to(message, with_ad(INFO_TEXT, message.from_user.id))
+    elif txt in ("📊 advertise", "advertise"):
+        start_ad_flow(message)
+    else:
+        outbox.reply_to(message, with_ad(FALLBACK_TEXT, message.from_user.id))
+
+# ---------------- Task listing & claiming ----------------
+
+def show_tasks_to_user(chat_id, user_id):
+    pages = task_pages("all", user_id)
+    if not pages:
+        outbox.send_message(chat_id, "No tasks available right now.")
+        return
+    text, markup = pages[0]
+    outbox.send_message(chat_id, with_ad(text, user_id), reply_markup=markup)
+
+def show_tasks_filtered(chat_id, user_id, task_type=None):
+    pages = task_pages(task_type or "all", user_id)
+    if not pages:
+        outbox.send_message(chat_id, "No tasks of this type are available right now.")
+        return
+    text, markup = pages[0]
+    outbox.send_message(chat_id, with_ad(text, user_id), reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("tasks_page:"))
+def callback_tasks_page(call):
+    _, view, page = call.data.split(":", 2)
+    pages = task_pages(view, call.from_user.id)
+    if not pages:
+        outbox.answer_callback_query(call.id, "No tasks available right now.")
+        return
+    text, markup = pages[min(max(int(page), 0), len(pages) - 1)]
+    # tapping the current page again fails with "message is not modified"; harmless
+    outbox.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    outbox.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("refs_page:"))
+def callback_refs_page(call):
+    _, page, start_after = call.data.split(":", 2)
+    text, markup = referral_list_view(str(call.from_user.id), int(page), start_after or None)
+    outbox.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    outbox.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("task_open:"))
+def callback_task_open(call):
+    view = task_open_view(call.data.split(":",1)[1])
+    if not view:
+        outbox.answer_callback_query(call.id, "Task not found.")
+        return
+    text, markup = view
+    outbox.send_message(call.message.chat.id, text, reply_markup=markup)
+    outbox.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("task_done:"))
+def callback_task_done(call):
+    tid = call.data.split(":",1)[1]
+    user = call.from_user
+    uid = str(user.id)
+
+    t, me, error = prepare_claim(uid, user.username or "", user.first_name or "", tid)
+    if error:
+        outbox.answer_callback_query(call.id, error)
+        return
+
+    # join_channel claims are checked against channel membership (cached, or
+    # in the background); visits and bot starts cannot be verified, so those
+    # are recorded and paid right away (this is the usual approach).
+    answer, text = claim_task(uid, me, tid, t, call.message.chat.id)
+
+    # Optionally, mark task unavailable if single-use: store.set(f"tasks/{tid}/available", False)
+
+    # Notify user
+    outbox.answer_callback_query(call.id, answer)
+    if text:
+        outbox.send_message(call.message.chat.id, text)
+
+# ---------------- Advertise flow (simple) ----------------
+
+def start_ad_flow(message_or_call):
+    # accept both message and callback-like objects
+    if isinstance(message_or_call, types.Message):
+        chat_id = message_or_call.chat.id
+        user = message_or_call.from_user
+    else:
+        chat_id = message_or_call.message.chat.id
+        user = message_or_call.from_user
+
+    # Ask for ad text and cost (simple linear cost: 1 pt per display);
+    # the replies are handled by conversation_step
+    outbox.send_message(chat_id, begin_ad_flow(str(user.id)))
+
+# ---------------- Admin: add/remove tasks & misc ----------------
+
+@bot.message_handler(commands=['addtask'])
+@require_admin
+def cmd_addtask(message):
+    outbox.reply_to(message, addtask_reply(message.text))
+
+@bot.message_handler(commands=['removetask'])
+@require_admin
+def cmd_removetask(message):
+    outbox.reply_to(message, removetask_reply(message.text))
+
+@bot.message_handler(commands=['addpoints'])
+@require_admin
+def cmd_addpoints(message):
+    outbox.reply_to(message, addpoints_reply(message.text))
 
 @bot.message_handler(commands=['stats'])
 @require_admin
 def cmd_stats(message):
-    all_users = users_ref.get() or {}
-    total_users = len(all_users)
-    total_points = sum((u.get("points",0) or 0) for u in all_users.values())
-    total_tasks = len(tasks_ref.get() or {})
-    bot.reply_to(message, f"Users: {total_users}\nTotal points: {total_points}\nTasks: {total_tasks}")
+    outbox.reply_to(message, stats_text())
+
+@bot.message_handler(commands=['rebuildleaderboard'])
+@require_admin
+def cmd_rebuildleaderboard(message):
+    outbox.reply_to(message, rebuildleaderboard_reply())
+
+@bot.message_handler(commands=['broadcasts'])
+@require_admin
+def cmd_broadcasts(message):
+    outbox.reply_to(message, broadcasts_text())
+
+@bot.message_handler(commands=['broadcast'])
+@require_admin
+def cmd_broadcast(message):
+    outbox.reply_to(message, broadcast_reply(message.text))
+
+@bot.message_handler(commands=['profile'])
+@require_admin
+def cmd_profile(message):
+    outbox.reply_to(message, profile_reply(message.text))
+
+@bot.message_handler(commands=['importtasks'])
+@bot.message_handler(content_types=['document'], func=lambda m: (m.caption or "").startswith("/importtasks"))
+@require_admin
+def cmd_importtasks(message):
+    doc = import_document(message)
+    if doc is None:
+        outbox.reply_to(message, IMPORT_USAGE)
+        return
+    if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+        outbox.reply_to(message, f"❌ File too large (max {IMPORT_MAX_BYTES // 1024} KB).")
+        return
+    try:
+        data = bot.download_file(bot.get_file(doc.file_id).file_path)
+    except Exception as e:
+        logger.warning("Could not download %s: %s", doc.file_name, e)
+        outbox.reply_to(message, "❌ Could not download the file, try again.")
+        return
+    outbox.reply_to(message, importtasks_reply(data, doc.file_name or ""))
+
+# ---------------- Admission control ----------------
+
+SLOW_DOWN_TEXT = "⏳ Slow down a little, please — try again in a few seconds."
+
+admission = Admission(ADMISSION_USER_BURST, ADMISSION_USER_RATE, ADMISSION_COMMAND_LIMITS,
+                      notice_interval=ADMISSION_NOTICE_INTERVAL, exempt=is_admin)
+
+def admission_key(update):
+    """(user id, command) a message or callback query is limited under."""
+    if isinstance(update, types.CallbackQuery):
+        return update.from_user.id, (update.data or "").split(":", 1)[0]
+    text = (update.text or "").strip()
+    if text.startswith("/") and len(text) > 1:
+        return update.from_user.id, text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower()
+    return update.from_user.id, "text"
+
+def admission_check(update):
+    """True if the update may reach the handlers; otherwise the user may get
+    a (throttled) "slow down" reply."""
+    if update.from_user is None:
+        return True
+    uid, command = admission_key(update)
+    if admission.admit(uid, command) is None:
+        return True
+    if admission.should_notify(uid):
+        if isinstance(update, types.CallbackQuery):
+            outbox.answer_callback_query(update.id, SLOW_DOWN_TEXT)
+        else:
+            outbox.send_message(update.chat.id, SLOW_DOWN_TEXT)
+    return False
+
+class AdmissionMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+
+    def pre_process(self, update, data):
+        if not admission_check(update):
+            return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+if ADMISSION_ENABLED:
+    bot.setup_middleware(AdmissionMiddleware())
+
+# ---------------- Update dispatcher ----------------
+
+# Update kinds that carry the user who sent them
+USER_UPDATE_KINDS = ("message", "callback_query", "edited_message", "inline_query",
+                     "chosen_inline_result", "pre_checkout_query", "shipping_query", "my_chat_member")
+
+def update_user_id(update):
+    """The Telegram user an update comes from (0 if it has none)."""
+    for kind in USER_UPDATE_KINDS:
+        obj = getattr(update, kind, None)
+        if obj is not None and getattr(obj, "from_user", None) is not None:
+            return obj.from_user.id
+    return 0
+
+class LaneDispatcher:
+    """Hashes updates by user id onto worker lanes: one user's updates are
+    handled in arrival order (no racing double taps), different users in
+    parallel. A full lane sheds new updates instead of queueing forever."""
+
+    def __init__(self, bot, lanes=DISPATCH_LANES, depth=DISPATCH_QUEUE_DEPTH):
+        self.bot = bot
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(max(1, lanes))]
+        self.threads = []
+        self.dispatched = 0
+        self.shed = 0
+
+    def start(self):
+        for n, q in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"lane-{n}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, update):
+        q = self.queues[update_user_id(update) % len(self.queues)]
+        try:
+            q.put_nowait(update)
+        except queue.Full:
+            self.shed += 1
+            logger.warning("Lane full, dropping update %s", update.update_id)
+            return False
+        self.dispatched += 1
+        return True
+
+    def queued(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _run(self, q):
+        while True:
+            update = q.get()
+            if update is None:
+                return
+            try:
+                self.bot.process_new_updates([update])
+            except Exception:
+                logger.exception("Handler failed for update %s", update.update_id)
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+dispatcher = LaneDispatcher(bot)
+
+def run_polling(timeout=60):
+    """Long-poll getUpdates and hand every update to the dispatcher."""
+    dispatcher.start()
+    offset = None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=timeout, long_polling_timeout=timeout)
+        except Exception as e:
+            logger.warning("getUpdates failed: %s", e)
+            time.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            dispatcher.submit(update)
 
 # ---------------- Startup ----------------
 
-if __name__ == "__main__":
+# The keyboard catch-all must be registered after every command handler,
+# otherwise it swallows commands defined further down the file.
+bot.register_message_handler(ui_buttons, func=lambda m: True, content_types=['text'])
+
+# Metrics: handlers, storage and Bot API calls are timed; caches and queues
+# are read when /metrics is scraped
+STORAGE_OPS = ("get", "set", "update", "page", "transaction", "count", "get_user", "top_users", "get_ad")
+metrics.instrument_handlers(bot)
+metrics.instrument_methods(store, STORAGE_OPS, "bot_storage_seconds", "Storage call latency")
+metrics.instrument_telegram()
+for _name, _fn in {
+    "user_cache_hit_ratio": user_cache_hit_rate,
+    "user_cache_entries": lambda: len(_user_cache),
+    "done_cache_entries": lambda: len(_done_cache),
+    "membership_cache_hit_ratio": lambda: verifier.hit_rate(),
+    "membership_checks_pending": lambda: verifier.pending(),
+    "outbox_queued": lambda: outbox.queued(),
+    "outbox_sent": lambda: outbox.stats["sent"],
+    "outbox_throttled": lambda: outbox.stats["throttled"],
+    "dispatcher_queued": lambda: dispatcher.queued(),
+    "dispatcher_shed": lambda: dispatcher.shed,
+    "conversations_active": lambda: len(conversations),
+    "admission_shed_user": lambda: admission.stats["shed_user"],
+    "admission_shed_command": lambda: admission.stats["shed_command"],
+    "admission_buckets": lambda: len(admission),
+    "ad_impressions_served": lambda: adserver.stats["served"],
+    "ads_serving": adserver.serving,
+    "ledger_pending_paths": lambda: ledger.backlog() if ledger else 0,
+    "catalog_version": lambda: catalog_version,
+}.items():
+    metrics.gauge(_name, _fn)
+
+def startup(primary=True, owns=None):
+    """Warm caches and start background jobs; shared by every entry point.
+    With several processes on one database, only the primary one runs the
+    jobs that walk every user (stats reconcile, index backfill, broadcast
+    resume) and persists leaderboard evictions, and owns(uid) tells which
+    users' pending claims this process re-checks."""
+    global _lb_evicts
+    _lb_evicts = primary
+    if ledger is not None:
+        ledger.open()
+        ledger.flush()
+        ledger.start()
+        atexit.register(ledger.close)
     seed_sample_tasks()
+    load_task_catalog()
+    load_leaderboard()
+    load_stats()
+    if SHARED_STATE_REFRESH:
+        run_every(SHARED_STATE_REFRESH, refresh_shared_state, "shared-state-refresh")
+    if primary:
+        run_every(STATS_RECONCILE_INTERVAL, reconcile_stats, "stats-reconcile")
+        threading.Thread(target=backfill_done_index, name="done-backfill", daemon=True).start()
+        threading.Thread(target=backfill_referral_index, name="referral-backfill", daemon=True).start()
+        threading.Thread(target=backfill_referral_levels, name="referral-levels-backfill", daemon=True).start()
+    else:
+        threading.Thread(target=wait_for_done_index, name="done-index-wait", daemon=True).start()
+    resubmit_pending_claims(owns)
+    verifier.start()
+    outbox.start()
+    if primary:
+        broadcaster.resume()
+    broadcaster.start()
+    adserver.start()
+    atexit.register(adserver.flush)
+
+if __name__ == "__main__":
+    startup()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
     print("Referral & Tasks bot starting...")
-    bot.infinity_polling(timeout=60, long_polling_timeout=60)
\ No newline at end of file
+    run_polling(timeout=60)
\ No newline at end of file
@@ -0,0 +1,490 @@
+"""
+sharded_worker.py
+Multi-process mode: one ingress process receives updates (long polling, or a
+webhook when WEBHOOK_URL is set) and hands each one to one of
+WORKER_PROCESSES worker processes, chosen by the sender's user id, so one
+user's updates always land on the same worker and keep their order.
+
+Every worker is a full copy of referral_tasks_bot.py with its own storage
+client, caches, point ledger (with LEDGER_JOURNAL set: journal file
+<LEDGER_JOURNAL>.<n>, writer worker-<n>) and conversation file. Workers do not talk to Telegram for
+sends: their outbox forwards every call to the ingress, whose single Outbox
+keeps the whole bot under Telegram's rate limits. When a worker writes to a
+user another worker owns (a referrer, say), that worker is told to drop the
+user from its cache.
+
+A worker that dies is restarted after a short backoff; if one dies more than
+RESTART_LIMIT times within RESTART_WINDOW seconds the ingress shuts down and
+exits non-zero. SIGTERM / SIGINT stop the ingress gracefully: it stops
+taking updates, lets the workers finish what they have queued and flush
+their ledgers, then drains the outbox.
+
+    python sharded_worker.py
+
+Workers share the database, so this needs the firebase or sqlite backend.
+
+Each worker keeps its own leaderboard index and /stats counters, and
+reloads both from the database every SHARED_STATE_REFRESH seconds (default
+5 here) so /leaderboard and /stats answer the same whichever worker the
+asking user hashes to. Only worker 0 deletes rows evicted from the
+persisted leaderboard (and trims the surplus the others add), and only it
+runs the stats reconcile.
+
+Sharded mode is opt-in (the Procfile runs the single-process bot) because
+ad impressions are budgeted per worker until their counts are flushed, so
+up to WORKER_PROCESSES x AD_FLUSH_INTERVAL of serving can overspend an ad.
+
+getChatMember calls to one channel are spaced WORKER_PROCESSES times
+further apart in each worker, so together they keep MEMBER_CHECK_INTERVAL.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import logging
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+from outbox import Outbox, REPLY
+
+# ------------------ CONFIG ------------------
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "2"))
+WORKER_QUEUE_DEPTH = 10000        # updates waiting per worker before new ones are dropped
+POLL_TIMEOUT = 20                 # long-poll seconds (short enough to stop within Heroku's 30 s)
+SHUTDOWN_TIMEOUT = 20             # seconds workers get to drain their queues
+
+# Restart policy: delay before the 1st, 2nd, ... restart of a worker, and the
+# number of restarts within RESTART_WINDOW seconds after which we give up
+RESTART_BACKOFF = (1, 2, 5, 10, 30)
+RESTART_LIMIT = 5
+RESTART_WINDOW = 300
+
+# Webhook ingress (same variables as webhook_bot.py)
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# --------------------------------------------
+
+logger = logging.getLogger(__name__)
+
+# referral_tasks_bot is imported inside functions only: worker processes are
+# spawned fresh and must set their per-worker environment before it loads.
+
+
+def raw_user_id(update):
+    """The user a raw update dict comes from (0 if it has none)."""
+    from referral_tasks_bot import USER_UPDATE_KINDS
+    for kind in USER_UPDATE_KINDS:
+        sender = (update.get(kind) or {}).get("from")
+        if sender:
+            return sender["id"]
+    return 0
+
+def shard_of(uid, count):
+    return int(uid) % count
+
+
+# ------------------ Worker side ------------------
+
+def _error_info(ex):
+    """A picklable description of a send failure."""
+    if ex is None:
+        return None
+    if isinstance(ex, ApiTelegramException):
+        return "api", ex.function_name, ex.result_json
+    return "other", type(ex).__name__, str(ex)
+
+def _error_from_info(info):
+    if info is None:
+        return None
+    if info[0] == "api":
+        return ApiTelegramException(info[1], None, info[2])
+    return RuntimeError(f"{info[1]}: {info[2]}")
+
+
+class RemoteOutbox(Outbox):
+    """Outbox of a worker process: every call is forwarded to the ingress's
+    outbox. Callbacks still fire, with (None, exception): the API result
+    stays in the ingress."""
+
+    def __init__(self, worker, outbound):
+        super().__init__(transport=None)
+        self.worker = worker
+        self.outbound = outbound
+        self._ids = itertools.count(1)
+        self._callbacks = {}        # request id -> callback waiting for the ingress
+
+    def submit(self, method, chat, params, priority=REPLY, coalesce=False, callback=None):
+        req = None
+        if callback is not None:
+            req = next(self._ids)
+            with self._cond:
+                self._callbacks[req] = callback
+        self.outbound.put(("send", self.worker, req, method, chat, params, priority, coalesce))
+        self.stats["sent"] += 1
+        return True
+
+    def resolve(self, req, error):
+        with self._cond:
+            callback = self._callbacks.pop(req, None)
+            self._cond.notify_all()
+        if callback:
+            try:
+                callback(None, _error_from_info(error))
+            except Exception:
+                logger.exception("Outbox callback failed")
+
+    def queued(self):
+        with self._cond:
+            return len(self._callbacks)
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._callbacks:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+            return True
+
+    def start(self):
+        return self
+
+    def stop(self, timeout=10):
+        self.flush(timeout)
+
+
+def _share_writes(core, n, count, outbound):
+    """Have the owners of users this worker writes to (but does not own)
+    drop them from their caches, right away and again once the ledger has
+    flushed the point deltas."""
+    def drop(uids):
+        for uid in uids:
+            if str(uid).isdigit() and shard_of(uid, count) != n:
+                outbound.put(("drop", str(uid)))
+
+    write = core.ledger_write
+
+    def ledger_write(changes, stats_deltas=None, touched=()):
+        after = write(changes, stats_deltas, touched)
+        drop(after)
+        return after
+
+    core.ledger_write = ledger_write
+    on_blocked = core.broadcaster.on_blocked
+
+    def users_blocked(uids):
+        on_blocked(uids)
+        drop(uids)
+
+    core.broadcaster.on_blocked = users_blocked
+    if core.ledger is not None:
+        core.ledger.on_flush = lambda paths: drop({p.split("/")[1] for p in paths if p.startswith("users/")})
+
+
+def worker_main(n, count, inbox, outbound):
+    """Entry point of worker process n."""
+    # the ingress decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    journal = os.environ.get("LEDGER_JOURNAL", "")
+    if journal:
+        os.environ["LEDGER_JOURNAL"] = f"{journal}.{n}"
+    os.environ["LEDGER_WRITER"] = f"worker-{n}"
+    os.environ.setdefault("SHARED_STATE_REFRESH", "5")
+    if os.environ.get("CONVERSATION_FILE"):
+        os.environ["CONVERSATION_FILE"] += f".{n}"
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [worker-{n}] %(levelname)s %(name)s: %(message)s")
+
+    from telebot import types
+    import referral_tasks_bot as core
+    core.outbox = core.broadcaster.outbox = RemoteOutbox(n, outbound)
+    core.verifier.per_channel_interval = core.MEMBER_CHECK_INTERVAL * count
+    _share_writes(core, n, count, outbound)
+    core.startup(primary=(n == 0), owns=lambda uid: shard_of(uid, count) == n)
+    core.dispatcher.start()
+    if core.METRICS_PORT:
+        metrics.serve(core.METRICS_PORT + 1 + n)
+    logger.info("Worker %d of %d ready", n, count)
+
+    parent = os.getppid()
+    while True:
+        try:
+            item = inbox.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent:
+                logger.warning("Ingress is gone; worker %d exits", n)
+                break
+            continue
+        if item is None:
+            break
+        kind = item[0]
+        if kind == "update":
+            core.dispatcher.submit(types.Update.de_json(item[1]))
+        elif kind == "reply":
+            core.outbox.resolve(item[1], item[2])
+        elif kind == "drop":
+            core.user_cache_drop(item[1])
+
+    # finish queued updates; their sends are forwarded before the process exits
+    core.dispatcher.stop()
+    if core.ledger is not None:
+        core.ledger.close()
+    core.adserver.flush()
+    if core.conversations.path:
+        core.conversations.flush()
+    logger.info("Worker %d stopped", n)
+
+
+# ------------------ Ingress side ------------------
+
+class Supervisor:
+    """Starts the workers, routes updates to them, relays their sends to the
+    outbox and restarts the ones that die.
+
+    Every start of a worker gets a fresh pair of queues: a process killed
+    while reading or writing one can leave its lock held for good. Updates
+    still queued for a worker when it dies are lost."""
+
+    def __init__(self, count, outbox):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.count = max(1, count)
+        self.outbox = outbox
+        self.procs = [None] * self.count
+        self.inboxes = [None] * self.count
+        self.restarts = [deque() for _ in range(self.count)]   # restart times per worker
+        self.restart_at = [None] * self.count
+        self.routed = 0
+        self.shed = 0
+        self._relays = []
+
+    def start(self):
+        for n in range(self.count):
+            self._spawn(n)
+        return self
+
+    def _spawn(self, n):
+        # unbounded, so send results never block a sender thread; updates
+        # are capped by WORKER_QUEUE_DEPTH in route()
+        inbox, outbound = self.ctx.Queue(), self.ctx.Queue()
+        p = self.ctx.Process(target=worker_main, args=(n, self.count, inbox, outbound),
+                             name=f"worker-{n}", daemon=True)
+        p.start()
+        self.procs[n], self.inboxes[n] = p, inbox
+        relay = threading.Thread(target=self._relay, args=(n, p, inbox, outbound), name=f"relay-{n}", daemon=True)
+        relay.start()
+        self._relays = [t for t in self._relays if t.is_alive()] + [relay]
+
+    def route(self, update):
+        """Queue a raw update dict on its user's worker; False if it was dropped."""
+        n = shard_of(raw_user_id(update), self.count)
+        inbox = self.inboxes[n]
+        if inbox.qsize() >= WORKER_QUEUE_DEPTH:
+            self.shed += 1
+            logger.warning("Worker %d queue full, dropping update %s", n, update.get("update_id"))
+            return False
+        inbox.put(("update", update))
+        self.routed += 1
+        return True
+
+    def queued(self):
+        return sum(q.qsize() for q in self.inboxes)
+
+    def supervise(self):
+        """Restart workers that died; False once one keeps dying."""
+        now = time.monotonic()
+        for n, p in enumerate(self.procs):
+            if p.is_alive():
+                continue
+            if self.restart_at[n] is None:
+                history = self.restarts[n]
+                while history and now - history[0] > RESTART_WINDOW:
+                    history.popleft()
+                if len(history) >= RESTART_LIMIT:
+                    logger.error("Worker %d died %d times in %ds; giving up", n, len(history) + 1, RESTART_WINDOW)
+                    return False
+                delay = RESTART_BACKOFF[min(len(history), len(RESTART_BACKOFF) - 1)]
+                logger.warning("Worker %d exited with code %s; restarting in %ss", n, p.exitcode, delay)
+                self.restart_at[n] = now + delay
+            elif now >= self.restart_at[n]:
+                self.restart_at[n] = None
+                self.restarts[n].append(now)
+                self._spawn(n)
+        return True
+
+    def restart_count(self):
+        return sum(len(h) for h in self.restarts)
+
+    def _relay(self, n, proc, inbox, outbound):
+        """Hand worker n's sends to the outbox until the worker is gone."""
+        def replier(req):
+            return lambda result, ex: inbox.put(("reply", req, _error_info(ex)))
+
+        while True:
+            try:
+                item = outbound.get(timeout=1)
+            except queue.Empty:
+                if not proc.is_alive():
+                    return
+                continue
+            try:
+                if item[0] == "drop":
+                    self.inboxes[shard_of(item[1], self.count)].put(item)
+                    continue
+                _, _, req, method, chat, params, priority, coalesce = item
+                callback = replier(req) if req is not None else None
+                if not self.outbox.submit(method, chat, params, priority, coalesce, callback) and callback:
+                    callback(None, RuntimeError("outbox full"))
+            except Exception:
+                logger.exception("Could not relay %s", item[:4])
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        """Let every worker drain its queue and exit, then finish relaying."""
+        for inbox in self.inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for n, p in enumerate(self.procs):
+            p.join(max(0, deadline - time.monotonic()))
+            if p.is_alive():
+                logger.warning("Worker %d did not stop in time; terminating it", n)
+                p.terminate()
+                p.join(1)
+        for relay in self._relays:
+            relay.join(5)
+
+
+class Poller:
+    """Long-polls getUpdates and routes what it gets; stop() confirms the
+    routed updates so a restart does not receive them again."""
+
+    def __init__(self, token, supervisor, timeout=POLL_TIMEOUT):
+        self.token = token
+        self.supervisor = supervisor
+        self.timeout = timeout
+        self.offset = None
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self):
+        threading.Thread(target=self._run, name="poller", daemon=True).start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                updates = apihelper.get_updates(self.token, offset=self.offset, timeout=self.timeout,
+                                                long_polling_timeout=self.timeout)
+            except Exception as e:
+                logger.warning("getUpdates failed: %s", e)
+                time.sleep(3)
+                continue
+            with self._lock:
+                if self._stopped:
+                    return      # not routed, not confirmed: delivered again after restart
+                for update in updates:
+                    self.offset = update["update_id"] + 1
+                    self.supervisor.route(update)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            offset = self.offset
+        if offset is not None:
+            try:
+                apihelper.get_updates(self.token, offset=offset, limit=1, timeout=0)
+            except Exception as e:
+                logger.warning("Could not confirm updates up to %s: %s", offset, e)
+
+
+def serve_webhook(bot, supervisor):
+    """Receive updates on WEBHOOK_PATH and register the webhook; returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != WEBHOOK_PATH or (
+                    WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET):
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                update = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            supervisor.route(update)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), Handler)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                    max_connections=100)
+    logger.info("Webhook registered at %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+    return server
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [ingress] %(levelname)s %(name)s: %(message)s")
+    import referral_tasks_bot as core
+    if core.STORAGE_BACKEND == "memory":
+        logger.warning("Memory storage is per process: workers will not see each other's data")
+    if WORKER_PROCESSES > 1:
+        logger.warning("Ad budgets are kept per worker in sharded mode; "
+                       "see the sharded_worker.py docstring")
+
+    supervisor = Supervisor(WORKER_PROCESSES, core.outbox).start()
+    core.outbox.start()
+    for name, fn in {
+        "ingress_routed": lambda: supervisor.routed,
+        "ingress_shed": lambda: supervisor.shed,
+        "ingress_queued": supervisor.queued,
+        "worker_restarts": supervisor.restart_count,
+    }.items():
+        metrics.gauge(name, fn)
+    if core.METRICS_PORT:
+        metrics.serve(core.METRICS_PORT)
+
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopping.set())
+    if WEBHOOK_URL:
+        server = serve_webhook(core.bot, supervisor)
+    else:
+        poller = Poller(core.BOT_TOKEN, supervisor).start()
+    logger.info("Ingress running with %d workers", supervisor.count)
+
+    healthy = True
+    while not stopping.wait(1):
+        if not supervisor.supervise():
+            healthy = False
+            break
+
+    logger.info("Shutting down")
+    if WEBHOOK_URL:
+        server.shutdown()
+    else:
+        poller.stop()
+    supervisor.stop()
+    core.outbox.stop(SHUTDOWN_TIMEOUT)
+    sys.exit(0 if healthy else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,545 @@
+"""
+storage.py
+Storage backends for the referral + tasks bot.
+
+Every backend exposes the same path-addressed JSON tree as the Firebase
+Realtime Database ("users/123/points"), including atomic multi-path updates
+with server-side increments, so the bot code does not care which one runs:
+
+  firebase - the live Realtime Database (firebase-admin)
+  sqlite   - a local SQLite file; users get real columns and indexes
+  memory   - a plain in-process dict, for tests and offline benchmarks
+"""
+
+import json
+import time
+import heapq
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Same shape as firebase_admin.db.Event, so listeners work with any backend
+Event = namedtuple("Event", "event_type path data")
+
+
+def increment(n):
+    # server-side increment, applied atomically by the backend
+    return {".sv": {"increment": n}}
+
+def _is_increment(value):
+    return isinstance(value, dict) and ".sv" in value
+
+def split_path(path):
+    return [p for p in str(path or "").split("/") if p]
+
+def _extract(node, parts):
+    for p in parts:
+        if not isinstance(node, dict) or p not in node:
+            return None
+        node = node[p]
+    return node
+
+def _put(node, parts, value):
+    """Return node with value stored at parts (None deletes), pruning empty dicts."""
+    if not parts:
+        return _clean(value)
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _put(node.get(parts[0]), parts[1:], value)
+    if child is None:
+        node.pop(parts[0], None)
+    else:
+        node[parts[0]] = child
+    return node or None
+
+def _clean(value):
+    # Firebase drops nulls and empty objects
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            v = _clean(v)
+            if v is not None:
+                out[str(k)] = v
+        return out or None
+    return value
+
+
+class Storage:
+    """Backend interface. Paths are slash-separated and root-relative."""
+
+    def get(self, path, shallow=False):
+        raise NotImplementedError
+
+    def set(self, path, value):
+        """Replace the value at path; None deletes it."""
+        raise NotImplementedError
+
+    def update(self, changes):
+        """Atomically apply {path: value}; values may be increment(n)."""
+        raise NotImplementedError
+
+    def page(self, path, start_after=None, limit=500):
+        """Children of path as [(key, value)] in key order, after start_after."""
+        raise NotImplementedError
+
+    def transaction(self, path, fn):
+        """Atomically replace the value at path with fn(current); returns it."""
+        raise NotImplementedError
+
+    def listen(self, path, callback):
+        """Call callback(Event) with the current value and on every change
+        below path. Returns an object with close()."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # ---- helpers shared by all backends ----
+
+    def delete(self, path):
+        self.set(path, None)
+
+    def count(self, path):
+        return len(self.get(path, shallow=True) or {})
+
+    def iter_children(self, path, chunk=500):
+        last = None
+        while True:
+            items = self.page(path, start_after=last, limit=chunk)
+            if not items:
+                return
+            for k, v in items:
+                yield k, v
+            last = items[-1][0]
+            if len(items) < chunk:
+                return
+
+    # ---- users, tasks, ads ----
+
+    def get_user(self, uid):
+        user = self.get(f"users/{uid}")
+        return user if isinstance(user, dict) else None
+
+    def top_users(self, n):
+        """The n users with the most referrals (then points) as [(uid, user)]."""
+        heap = []
+        for uid, u in self.iter_children("users"):
+            if not isinstance(u, dict):
+                continue
+            item = ((u.get("referrals", 0) or 0, u.get("points", 0) or 0), uid, u)
+            if len(heap) < n:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+        return [(uid, u) for _, uid, u in sorted(heap, reverse=True)]
+
+    def get_tasks(self):
+        return self.get("tasks") or {}
+
+    def get_ad(self, kind, ad_id):
+        return self.get(f"ads/{kind}/{ad_id}")
+
+
+# ------------------ Firebase ------------------
+
+class FirebaseStorage(Storage):
+
+    def __init__(self, service_account_file, database_url):
+        import firebase_admin
+        from firebase_admin import credentials, db
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(service_account_file)
+            firebase_admin.initialize_app(cred, {"databaseURL": database_url})
+        self._root = db.reference("/")
+
+    def _ref(self, path):
+        path = "/".join(split_path(path))
+        return self._root.child(path) if path else self._root
+
+    def get(self, path, shallow=False):
+        return self._ref(path).get(shallow=shallow)
+
+    def set(self, path, value):
+        if value is None:
+            self._ref(path).delete()
+        else:
+            self._ref(path).set(value)
+
+    def update(self, changes):
+        if changes:
+            self._root.update(changes)
+
+    def page(self, path, start_after=None, limit=500):
+        query = self._ref(path).order_by_key()
+        if start_after is not None:
+            # start_at is inclusive, so ask for one extra row and drop it
+            data = query.start_at(start_after).limit_to_first(limit + 1).get() or {}
+            return [(k, v) for k, v in data.items() if k != start_after][:limit]
+        data = query.limit_to_first(limit).get() or {}
+        return list(data.items())
+
+    def transaction(self, path, fn):
+        return self._ref(path).transaction(fn)
+
+    def listen(self, path, callback):
+        return self._ref(path).listen(callback)
+
+
+# ------------------ In-memory ------------------
+
+class _Listeners:
+    """In-process change notification shared by the local backends."""
+
+    class _Registration:
+        def __init__(self, owner, entry):
+            self._owner, self._entry = owner, entry
+
+        def close(self):
+            with self._owner.lock:
+                if self._entry in self._owner.entries:
+                    self._owner.entries.remove(self._entry)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []   # [(path parts, callback)]
+
+    def add(self, parts, callback):
+        entry = (parts, callback)
+        with self.lock:
+            self.entries.append(entry)
+        return self._Registration(self, entry)
+
+    def fire(self, changed, read):
+        """changed: [(parts, new value)]; read(parts) gives the current value."""
+        with self.lock:
+            entries = list(self.entries)
+        for lparts, callback in entries:
+            for parts, value in changed:
+                if parts[:len(lparts)] == lparts:
+                    event = Event("put", "/" + "/".join(parts[len(lparts):]), value)
+                elif lparts[:len(parts)] == parts:
+                    event = Event("put", "/", read(lparts))
+                else:
+                    continue
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception("Storage listener failed")
+
+
+class MemoryStorage(Storage):
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._tree = None
+        self._listeners = _Listeners()
+
+    def _read(self, parts):
+        with self._lock:
+            return json.loads(json.dumps(_extract(self._tree, parts)))
+
+    def get(self, path, shallow=False):
+        value = self._read(split_path(path))
+        if shallow and isinstance(value, dict):
+            return {k: True for k in value}
+        return value
+
+    def set(self, path, value):
+        parts = split_path(path)
+        value = json.loads(json.dumps(value))
+        with self._lock:
+            self._tree = _put(self._tree, parts, value)
+        self._listeners.fire([(parts, _clean(value))], self._read)
+
+    def update(self, changes):
+        changed = []
+        with self._lock:
+            for path, value in changes.items():
+                parts = split_path(path)
+                if _is_increment(value):
+                    value = (_extract(self._tree, parts) or 0) + value[".sv"]["increment"]
+                value = json.loads(json.dumps(value))
+                self._tree = _put(self._tree, parts, value)
+                changed.append((parts, _clean(value)))
+        self._listeners.fire(changed, self._read)
+
+    def page(self, path, start_after=None, limit=500):
+        with self._lock:
+            node = _extract(self._tree, split_path(path))
+            if not isinstance(node, dict):
+                return []
+            keys = sorted(k for k in node if start_after is None or k > start_after)[:limit]
+            return [(k, json.loads(json.dumps(node[k]))) for k in keys]
+
+    def transaction(self, path, fn):
+        parts = split_path(path)
+        with self._lock:
+            value = fn(self._read(parts))
+            self._tree = _put(self._tree, parts, value)
+        self._listeners.fire([(parts, _clean(value))], self._read)
+        return value
+
+    def listen(self, path, callback):
+        parts = split_path(path)
+        reg = self._listeners.add(parts, callback)
+        callback(Event("put", "/", self._read(parts)))
+        return reg
+
+
+# ------------------ SQLite ------------------
+
+# Each top-level node is stored as JSON records at a fixed depth:
+# "tasks/task1" is one row, "ads/published/ad_1" is one row,
+# "referrals/<referrer>/<uid>" is one row, and so on.
+# Users are the exception and get their own table with real columns.
+_RECORD_DEPTH = {"ads": 3, "referrals": 3}
+_USER_COLUMNS = ("points", "referrals", "referred_by", "username", "first_name", "created_at")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    points INTEGER NOT NULL DEFAULT 0,
+    referrals INTEGER NOT NULL DEFAULT 0,
+    referred_by TEXT,
+    username TEXT,
+    first_name TEXT,
+    created_at INTEGER,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS users_by_referrals ON users (referrals DESC, points DESC);
+CREATE INDEX IF NOT EXISTS users_by_points ON users (points DESC);
+CREATE INDEX IF NOT EXISTS users_by_referrer ON users (referred_by);
+CREATE TABLE IF NOT EXISTS nodes (
+    path TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class SQLiteStorage(Storage):
+
+    def __init__(self, path="bot.db", poll_interval=1.0):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+        self._listeners = _Listeners()
+        self._poll_interval = poll_interval
+        self._poller = None
+
+    @staticmethod
+    def _depth(top):
+        return _RECORD_DEPTH.get(top, 2)
+
+    # ---- records ----
+
+    def _load(self, rec):
+        if rec[0] == "users":
+            row = self._db.execute(
+                "SELECT uid, points, referrals, referred_by, username, first_name, created_at, extra "
+                "FROM users WHERE uid = ?", (rec[1],)).fetchone()
+            return self._user_from_row(row) if row else None
+        row = self._db.execute("SELECT value FROM nodes WHERE path = ?", ("/".join(rec),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store(self, rec, value):
+        if rec[0] == "users":
+            if not isinstance(value, dict):
+                self._db.execute("DELETE FROM users WHERE uid = ?", (rec[1],))
+                return
+            extra = {k: v for k, v in value.items() if k not in _USER_COLUMNS}
+            self._db.execute(
+                "INSERT OR REPLACE INTO users (uid, points, referrals, referred_by, username, first_name, created_at, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (rec[1], value.get("points", 0) or 0, value.get("referrals", 0) or 0, value.get("referred_by"),
+                 value.get("username"), value.get("first_name"), value.get("created_at"),
+                 json.dumps(extra) if extra else None))
+            return
+        if value is None:
+            self._db.execute("DELETE FROM nodes WHERE path = ?", ("/".join(rec),))
+        else:
+            self._db.execute("INSERT OR REPLACE INTO nodes (path, value) VALUES (?, ?)",
+                             ("/".join(rec), json.dumps(value)))
+
+    def _scan(self, prefix, start_after=None, limit=-1):
+        """Records under prefix (shorter than the record depth) in key order."""
+        if prefix and prefix[0] == "users":
+            sql = ("SELECT uid, points, referrals, referred_by, username, first_name, created_at, extra FROM users")
+            args = []
+            if start_after is not None:
+                sql += " WHERE uid > ?"
+                args.append(start_after)
+            rows = self._db.execute(sql + " ORDER BY uid LIMIT ?", args + [limit]).fetchall()
+            return [(["users", row[0]], self._user_from_row(row)) for row in rows]
+        records = []
+        if not prefix:
+            records = self._scan(["users"])
+        base = "/".join(prefix) + "/" if prefix else ""
+        # "/" sorts just below "0", so [base, base0) covers every path under prefix;
+        # start_after is only used when the children of prefix are records
+        lo = base + start_after if start_after is not None else base
+        hi = base[:-1] + "0" if base else "\uffff"
+        op = ">" if start_after is not None else ">="
+        rows = self._db.execute(
+            f"SELECT path, value FROM nodes WHERE path {op} ? AND path < ? ORDER BY path LIMIT ?",
+            (lo, hi, limit)).fetchall()
+        for path, value in rows:
+            records.append((path.split("/"), json.loads(value)))
+        return records
+
+    @staticmethod
+    def _user_from_row(row):
+        user = {k: v for k, v in zip(_USER_COLUMNS, row[1:7]) if v is not None}
+        if row[7]:
+            user.update(json.loads(row[7]))
+        return user
+
+    # ---- tree operations ----
+
+    def _get(self, parts):
+        if parts:
+            depth = self._depth(parts[0])
+            if len(parts) >= depth:
+                return _extract(self._load(parts[:depth]), parts[depth:])
+        tree = None
+        for rec, value in self._scan(parts):
+            tree = _put(tree, rec[len(parts):], value)
+        return tree
+
+    def _set(self, parts, value):
+        if parts:
+            depth = self._depth(parts[0])
+            if len(parts) >= depth:
+                rec = parts[:depth]
+                self._store(rec, _put(self._load(rec), parts[depth:], value))
+                return
+        for rec, _ in self._scan(parts):
+            self._store(rec, None)
+        value = _clean(value)
+        if isinstance(value, dict):
+            for k, v in value.items():
+                self._set(parts + [k], v)
+
+    def _write(self, fn):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def get(self, path, shallow=False):
+        with self._lock:
+            value = self._get(split_path(path))
+        if shallow and isinstance(value, dict):
+            return {k: True for k in value}
+        return value
+
+    def set(self, path, value):
+        parts = split_path(path)
+        value = _clean(json.loads(json.dumps(value)))
+        self._write(lambda: self._set(parts, value))
+        self._listeners.fire([(parts, value)], self._read)
+
+    def update(self, changes):
+        def apply():
+            changed = []
+            for path, value in changes.items():
+                parts = split_path(path)
+                if _is_increment(value):
+                    value = (self._get(parts) or 0) + value[".sv"]["increment"]
+                value = _clean(json.loads(json.dumps(value)))
+                self._set(parts, value)
+                changed.append((parts, value))
+            return changed
+        if changes:
+            self._listeners.fire(self._write(apply), self._read)
+
+    def page(self, path, start_after=None, limit=500):
+        parts = split_path(path)
+        with self._lock:
+            if parts and len(parts) + 1 == self._depth(parts[0]) or parts == ["users"]:
+                return [(rec[-1], value) for rec, value in self._scan(parts, start_after, limit)]
+            node = self._get(parts)
+        if not isinstance(node, dict):
+            return []
+        keys = sorted(k for k in node if start_after is None or k > start_after)[:limit]
+        return [(k, node[k]) for k in keys]
+
+    def transaction(self, path, fn):
+        parts = split_path(path)
+        def apply():
+            value = _clean(fn(self._get(parts)))
+            self._set(parts, value)
+            return value
+        value = self._write(apply)
+        self._listeners.fire([(parts, value)], self._read)
+        return value
+
+    def _read(self, parts):
+        with self._lock:
+            return self._get(parts)
+
+    def listen(self, path, callback):
+        parts = split_path(path)
+        reg = self._listeners.add(parts, callback)
+        callback(Event("put", "/", self._read(parts)))
+        if self._poller is None and self._poll_interval:
+            self._poller = threading.Thread(target=self._poll_other_writers, name="sqlite-listen", daemon=True)
+            self._poller.start()
+        return reg
+
+    def _poll_other_writers(self):
+        # data_version only moves when another connection (process) commits
+        with self._lock:
+            version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        while True:
+            time.sleep(self._poll_interval)
+            with self._lock:
+                current = self._db.execute("PRAGMA data_version").fetchone()[0]
+            if current == version:
+                continue
+            version = current
+            with self._listeners.lock:
+                paths = [parts for parts, _ in self._listeners.entries]
+            self._listeners.fire([(parts, self._read(parts)) for parts in paths], self._read)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # ---- indexed queries ----
+
+    def get_user(self, uid):
+        with self._lock:
+            return self._load(["users", str(uid)])
+
+    def top_users(self, n):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT uid, points, referrals, referred_by, username, first_name, created_at, extra "
+                "FROM users ORDER BY referrals DESC, points DESC LIMIT ?", (n,)).fetchall()
+        return [(row[0], self._user_from_row(row)) for row in rows]
+
+    def count(self, path):
+        if split_path(path) == ["users"]:
+            with self._lock:
+                return self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return super().count(path)
+
+
+def open_storage(backend, **options):
+    """Create the backend named by configuration (firebase, sqlite or memory)."""
+    if backend == "firebase":
+        return FirebaseStorage(options["service_account_file"], options["database_url"])
+    if backend == "sqlite":
+        return SQLiteStorage(options.get("sqlite_path") or "bot.db")
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend!r}")
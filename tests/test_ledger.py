@@ -0,0 +1,175 @@
+"""
+PointLedger keeps balances exact across crashes: journaled deltas reach the
+database exactly once, whatever happened to the process or the last flush.
+"""
+
+import pytest
+
+from ledger import PointLedger
+from storage import MemoryStorage
+
+
+class FlakyStorage(MemoryStorage):
+    """Fails the next update, either before or after applying it."""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = None        # None, "before" or "after"
+
+    def update(self, changes):
+        fail, self.fail = self.fail, None
+        if fail == "before":
+            raise ConnectionError("lost before the write")
+        super().update(changes)
+        if fail == "after":
+            raise ConnectionError("lost after the write")
+
+
+@pytest.fixture
+def store():
+    return FlakyStorage()
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / "ledger.journal")
+
+def opened(store, journal, **kwargs):
+    ledger = PointLedger(store, journal, **kwargs)
+    ledger.open()
+    return ledger
+
+def crash(ledger):
+    # the process dies: nothing is flushed, the journal stays as written
+    ledger._file.close()
+
+
+def test_flush_applies_deltas_and_the_marker(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5, "stats/points_issued": 5})
+    ledger.record({"users/1/points": -2, "users/2/points": 0})
+
+    assert store.get("users/1") is None
+    assert ledger.flush() == 2
+    assert store.get("users/1/points") == 3
+    assert store.get("stats/points_issued") == 5
+    assert store.get(ledger.marker) == 2
+    assert ledger.flush() == 0
+
+def test_read_adds_pending_deltas(store, journal):
+    store.set("users/1", {"points": 10, "referrals": 1})
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5, "users/1/referrals": 1, "users/2/points": 7})
+
+    assert ledger.read("users/1", lambda: store.get_user("1")) == {"points": 15, "referrals": 2}
+    assert ledger.pending("users/2") == {"points": 7}
+
+def test_replay_after_a_crash_applies_each_delta_once(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5})
+    ledger.flush()
+    ledger.record({"users/1/points": 3})
+    ledger.record({"users/2/points": 4})
+    crash(ledger)
+
+    restarted = opened(store, journal)
+    assert restarted.backlog() == 2
+    restarted.flush()
+    assert store.get("users/1/points") == 8
+    assert store.get("users/2/points") == 4
+    crash(restarted)
+
+    again = opened(store, journal)
+    assert again.backlog() == 0
+    again.flush()
+    assert store.get("users/1/points") == 8
+
+def test_open_reports_replayed_records(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 1})
+    ledger.record({"users/1/points": 1})
+    crash(ledger)
+
+    assert PointLedger(store, journal).open() == 2
+
+def test_torn_last_line_is_ignored(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5})
+    crash(ledger)
+    with open(journal, "a") as f:
+        f.write('{"seq": 2, "changes": {"users/1/poi')
+
+    restarted = opened(store, journal)
+    restarted.flush()
+    assert store.get("users/1/points") == 5
+
+def test_sequence_numbers_continue_after_restart(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 1})
+    ledger.flush()
+    crash(ledger)
+
+    restarted = opened(store, journal)
+    assert restarted.record({"users/1/points": 1}) == 2
+
+def test_failed_flush_that_did_not_apply_is_sent_again(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5})
+    store.fail = "before"
+    with pytest.raises(ConnectionError):
+        ledger.flush()
+
+    # unknown outcome: reads still count the deltas
+    assert ledger.pending("users/1") == {"points": 5}
+    ledger.flush()      # marker says not applied: re-queued
+    ledger.flush()
+    assert store.get("users/1/points") == 5
+    assert store.get(ledger.marker) == 1
+
+def test_failed_flush_that_did_apply_is_not_sent_twice(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5})
+    store.fail = "after"
+    with pytest.raises(ConnectionError):
+        ledger.flush()
+
+    ledger.record({"users/1/points": 1})
+    ledger.flush()      # marker says applied: only the new delta goes out
+    ledger.flush()
+    assert store.get("users/1/points") == 6
+    assert ledger.pending("users/1") == {}
+
+def test_unconfirmed_flush_survives_a_crash(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5})
+    store.fail = "after"
+    with pytest.raises(ConnectionError):
+        ledger.flush()
+    crash(ledger)
+
+    restarted = opened(store, journal)
+    restarted.flush()
+    assert store.get("users/1/points") == 5
+
+def test_compaction_keeps_only_what_is_pending(store, journal):
+    ledger = opened(store, journal, compact_bytes=1)
+    for _ in range(20):
+        ledger.record({"users/1/points": 1})
+    ledger.flush()          # compacts: everything was applied
+    ledger.record({"users/2/points": 3})
+    crash(ledger)
+
+    with open(journal) as f:
+        assert len(f.readlines()) == 1
+
+    restarted = opened(store, journal)
+    restarted.flush()
+    assert store.get("users/1/points") == 20
+    assert store.get("users/2/points") == 3
+
+def test_close_flushes(store, journal):
+    ledger = opened(store, journal)
+    ledger.record({"users/1/points": 5})
+    ledger.close()
+
+    assert store.get("users/1/points") == 5
+    assert not ledger.ready
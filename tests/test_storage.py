@@ -0,0 +1,156 @@
+"""
+The memory and SQLite backends must behave like the Firebase tree the bot
+was written against: same paths, same pruning of nulls, same increments.
+"""
+
+import pytest
+
+from storage import MemoryStorage, SQLiteStorage, increment
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        s = MemoryStorage()
+    else:
+        s = SQLiteStorage(str(tmp_path / "bot.db"), poll_interval=0)
+    yield s
+    s.close()
+
+
+# ---- record depth ----
+
+def test_records_at_every_depth_read_back_as_one_tree(store):
+    store.set("tasks/task1", {"type": "visit", "points": 3})
+    store.set("ads/published/ad_1", {"owner": "1", "cost": 10})
+    store.set("referrals/7/8", {"name": "u8", "time": 1})
+    store.set("users/7", {"points": 1, "referrals": 1, "username": "u7", "lang": "en"})
+
+    assert store.get("tasks/task1/points") == 3
+    assert store.get("ads") == {"published": {"ad_1": {"owner": "1", "cost": 10}}}
+    assert store.get("referrals/7") == {"8": {"name": "u8", "time": 1}}
+    assert store.get("users/7") == {"points": 1, "referrals": 1, "username": "u7", "lang": "en"}
+    assert store.get("users/7/lang") == "en"
+    assert store.get("ads/published", shallow=True) == {"ad_1": True}
+
+def test_writing_a_field_keeps_the_rest_of_the_record(store):
+    store.set("ads/published/ad_1", {"owner": "1", "cost": 10})
+    store.update({"ads/published/ad_1/displays": 4})
+    store.set("users/7", {"points": 1, "referrals": 0, "username": "u7"})
+    store.set("users/7/blocked", True)
+
+    assert store.get("ads/published/ad_1") == {"owner": "1", "cost": 10, "displays": 4}
+    assert store.get("users/7") == {"points": 1, "referrals": 0, "username": "u7", "blocked": True}
+
+def test_replacing_a_parent_drops_records_below_it(store):
+    store.set("referrals/7/8", {"name": "u8"})
+    store.set("referrals/7/9", {"name": "u9"})
+    store.set("referrals/7", {"10": {"name": "u10"}})
+
+    assert store.get("referrals/7") == {"10": {"name": "u10"}}
+
+
+# ---- pruning ----
+
+def test_nulls_and_empty_objects_are_dropped(store):
+    store.set("tasks/t1", {"title": "x", "url": None, "extra": {}, "nested": {"a": None}})
+
+    assert store.get("tasks/t1") == {"title": "x"}
+    assert store.get("tasks/t1/extra") is None
+
+def test_deleting_the_last_child_removes_the_parent(store):
+    store.set("done/7/t1", 1)
+    store.update({"done/7/t1": None})
+
+    assert store.get("done/7") is None
+    assert store.get("done") is None
+
+def test_update_with_none_deletes(store):
+    store.set("completions/7/t1", {"points": 3, "pending": True})
+    store.update({"completions/7/t1/pending": None, "completions/7/t1/verified": True})
+
+    assert store.get("completions/7/t1") == {"points": 3, "verified": True}
+
+
+# ---- increments ----
+
+def test_increments_on_missing_paths_start_from_zero(store):
+    store.update({"users/42/points": increment(5), "stats/task_completions/t1": increment(2)})
+    store.update({"users/42/points": increment(-2), "stats/task_completions/t1": increment(1)})
+
+    user = store.get_user("42")
+    assert user["points"] == 3
+    # the SQLite users table keeps referrals as a column that defaults to 0
+    assert user.get("referrals", 0) == 0
+    assert store.get("stats") == {"task_completions": {"t1": 3}}
+
+def test_one_update_applies_values_and_increments_together(store):
+    store.set("users/7", {"points": 10, "referrals": 0})
+    store.update({
+        "users/7/points": increment(5),
+        "users/7/referrals": increment(1),
+        "users/8/referred_by": "7",
+        "referrals/7/8": {"name": "u8"},
+    })
+
+    assert store.get_user("7") == {"points": 15, "referrals": 1}
+    assert store.get_user("8")["referred_by"] == "7"
+    assert store.get("referrals/7/8") == {"name": "u8"}
+
+
+# ---- paging ----
+
+def test_page_is_key_ordered_and_starts_after_the_cursor(store):
+    for uid in ("3", "1", "10", "2"):
+        store.set(f"users/{uid}", {"points": int(uid), "referrals": 0})
+
+    assert [k for k, _ in store.page("users", limit=2)] == ["1", "10"]
+    assert [k for k, _ in store.page("users", start_after="10", limit=10)] == ["2", "3"]
+    assert store.page("users", start_after="3") == []
+    assert [(k, u["points"]) for k, u in store.iter_children("users", chunk=3)] == [
+        ("1", 1), ("10", 10), ("2", 2), ("3", 3)]
+
+def test_page_stays_inside_its_node(store):
+    # keys that share a prefix with the node ("1" vs "10", "1-2") must not leak in
+    store.set("referrals/1/5", {"name": "a"})
+    store.set("referrals/1/6", {"name": "b"})
+    store.set("referrals/10/7", {"name": "c"})
+    store.set("referrals/1-2/8", {"name": "d"})
+
+    assert [k for k, _ in store.page("referrals/1")] == ["5", "6"]
+    assert [k for k, _ in store.page("referrals/1", start_after="5")] == ["6"]
+    assert store.page("referrals/3") == []
+
+def test_page_of_a_nested_node(store):
+    store.set("ads/published/ad_2", {"cost": 2})
+    store.set("ads/published/ad_1", {"cost": 1})
+
+    assert store.page("ads/published") == [("ad_1", {"cost": 1}), ("ad_2", {"cost": 2})]
+    assert store.count("ads/published") == 2
+
+
+# ---- indexed queries and transactions ----
+
+def test_top_users_by_referrals_then_points(store):
+    store.set("users/1", {"points": 50, "referrals": 1})
+    store.set("users/2", {"points": 10, "referrals": 3})
+    store.set("users/3", {"points": 20, "referrals": 3})
+
+    assert [uid for uid, _ in store.top_users(2)] == ["3", "2"]
+    assert store.count("users") == 3
+
+def test_transaction_replaces_the_value(store):
+    store.set("meta/counter", 1)
+
+    assert store.transaction("meta/counter", lambda v: (v or 0) + 1) == 2
+    assert store.get("meta/counter") == 2
+
+def test_listeners_see_the_snapshot_then_changes(store):
+    events = []
+    reg = store.listen("tasks", events.append)
+    store.set("tasks/t1", {"title": "x"})
+    reg.close()
+    store.set("tasks/t2", {"title": "y"})
+
+    assert [(e.event_type, e.path, e.data) for e in events] == [
+        ("put", "/", None), ("put", "/t1", {"title": "x"})]
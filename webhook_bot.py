@@ -0,0 +1,341 @@
+"""
+webhook_bot.py
+Async entry point: Telegram delivers updates to a webhook served by aiohttp and
+AsyncTeleBot handles them as coroutines, so slow storage or Bot API calls of
+one update overlap with everyone else's instead of stalling them.
+
+Storage, caches and views are shared with referral_tasks_bot.py; blocking
+storage calls run in a bounded thread pool. Replies go through the same
+rate-limited core.outbox as in polling mode (and as broadcasts), so they
+share its token buckets, 429 retries and priorities. Polling mode is unchanged:
+    python referral_tasks_bot.py     # polling
+    python webhook_bot.py            # webhook (set WEBHOOK_URL to register it)
+"""
+
+import os
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate
+
+import metrics
+import referral_tasks_bot as core
+
+# ------------------ CONFIG ------------------
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")        # public base URL, e.g. https://myapp.herokuapp.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+# Threads available to blocking storage calls, and updates handled at once
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "16"))
+MAX_INFLIGHT_UPDATES = int(os.environ.get("MAX_INFLIGHT_UPDATES", "2000"))
+# Updates accepted but not finished (running or waiting their turn); past
+# this the webhook answers 503 and Telegram delivers the update again later
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", "10000"))
+WEBHOOK_RETRY_AFTER = 5
+# One user's updates are handled in order: they share one of these locks
+USER_LOCK_STRIPES = int(os.environ.get("USER_LOCK_STRIPES", "1024"))
+# --------------------------------------------
+
+logger = logging.getLogger(__name__)
+
+if core.TELEGRAM_API_URL:
+    asyncio_helper.API_URL = core.TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+
+abot = AsyncTeleBot(core.BOT_TOKEN, parse_mode="HTML")
+_db_pool = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+_inflight = None       # asyncio.Semaphore, created once the loop runs
+_user_locks = []       # asyncio.Lock stripes, created once the loop runs
+_pending = set()       # running update tasks (keeps references alive)
+webhook_stats = {"accepted": 0, "shed": 0}
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking storage call in the bounded executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_pool, functools.partial(fn, *args, **kwargs))
+
+def require_admin(func):
+    @functools.wraps(func)
+    async def wrapper(message, *args, **kwargs):
+        if not core.is_admin(message.from_user.id):
+            core.outbox.reply_to(message, "❌ You are not an admin.")
+            return
+        return await func(message, *args, **kwargs)
+    return wrapper
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """core.admission_check in front of every message and callback handler."""
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+
+    async def pre_process(self, update, data):
+        if not core.admission_check(update):
+            return CancelUpdate()
+
+    async def post_process(self, update, data, exception):
+        pass
+
+if core.ADMISSION_ENABLED:
+    abot.setup_middleware(AdmissionMiddleware())
+
+
+# ------------------ Bot Handlers ------------------
+
+# Multi-step flows (advertise) take the next text message from that user;
+# state lives in core.conversations
+@abot.message_handler(func=lambda m: core.conversations.get(m.from_user.id) is not None, content_types=['text'])
+async def conversation_step(message):
+    reply = await run_db(core.conversation_reply, str(message.from_user.id), message.text)
+    if reply:
+        core.outbox.reply_to(message, reply)
+
+@abot.message_handler(commands=['start'])
+async def handle_start(message):
+    args = message.text.split()
+    user = message.from_user
+    uid = str(user.id)
+    username = user.username or ""
+    first_name = user.first_name or ""
+    me, referrer_id = await run_db(core.register_start, uid, username, first_name,
+                                   args[1] if len(args) > 1 else None)
+    if referrer_id:
+        # notify referrer (fire-and-forget)
+        core.outbox.notify(int(referrer_id), core.referral_notice_text(username, first_name))
+    core.outbox.send_message(message.chat.id, core.welcome_text(uid, first_name, me),
+                             reply_markup=core.MAIN_MENU_MARKUP)
+
+@abot.message_handler(commands=['help'])
+async def handle_help(message):
+    core.outbox.reply_to(message, core.HELP_TEXT)
+
+@abot.message_handler(commands=['tasks'])
+async def handle_tasks_cmd(message):
+    await show_tasks(message.chat.id, message.from_user.id, "all", "No tasks available right now.")
+
+@abot.message_handler(commands=['balance'])
+async def cmd_balance(message):
+    u = await run_db(core.create_user_if_missing, str(message.from_user.id))
+    core.outbox.reply_to(message, core.with_ad(core.format_points_info(u), message.from_user.id))
+
+@abot.message_handler(commands=['referrals'])
+async def cmd_referrals(message):
+    uid = str(message.from_user.id)
+    u = await run_db(core.create_user_if_missing, uid)
+    text, markup = await run_db(core.referrals_view, uid, u)
+    core.outbox.reply_to(message, text, reply_markup=markup)
+
+@abot.message_handler(commands=['leaderboard'])
+async def cmd_leaderboard(message):
+    core.outbox.reply_to(message, core.leaderboard_text() or "No users yet.")
+
+async def show_tasks(chat_id, uid, view, empty_text):
+    pages = await run_db(core.task_pages, view, uid)
+    if not pages:
+        core.outbox.send_message(chat_id, empty_text)
+        return
+    text, markup = pages[0]
+    core.outbox.send_message(chat_id, core.with_ad(text, uid), reply_markup=markup)
+
+@abot.callback_query_handler(func=lambda call: call.data and call.data.startswith("tasks_page:"))
+async def callback_tasks_page(call):
+    _, view, page = call.data.split(":", 2)
+    pages = await run_db(core.task_pages, view, call.from_user.id)
+    if not pages:
+        core.outbox.answer_callback_query(call.id, "No tasks available right now.")
+        return
+    text, markup = pages[min(max(int(page), 0), len(pages) - 1)]
+    core.outbox.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    core.outbox.answer_callback_query(call.id)
+
+@abot.callback_query_handler(func=lambda call: call.data and call.data.startswith("refs_page:"))
+async def callback_refs_page(call):
+    _, page, start_after = call.data.split(":", 2)
+    text, markup = await run_db(core.referral_list_view, str(call.from_user.id), int(page), start_after or None)
+    core.outbox.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    core.outbox.answer_callback_query(call.id)
+
+@abot.callback_query_handler(func=lambda call: call.data and call.data.startswith("task_open:"))
+async def callback_task_open(call):
+    view = core.task_open_view(call.data.split(":", 1)[1])
+    if not view:
+        core.outbox.answer_callback_query(call.id, "Task not found.")
+        return
+    text, markup = view
+    core.outbox.send_message(call.message.chat.id, text, reply_markup=markup)
+    core.outbox.answer_callback_query(call.id)
+
+@abot.callback_query_handler(func=lambda call: call.data and call.data.startswith("task_done:"))
+async def callback_task_done(call):
+    tid = call.data.split(":", 1)[1]
+    user = call.from_user
+    uid = str(user.id)
+    t, me, error = await run_db(core.prepare_claim, uid, user.username or "", user.first_name or "", tid)
+    if error:
+        core.outbox.answer_callback_query(call.id, error)
+        return
+    # membership checks run on core.verifier's thread, never in the handler
+    answer, text = await run_db(core.claim_task, uid, me, tid, t, call.message.chat.id)
+    core.outbox.answer_callback_query(call.id, answer)
+    if text:
+        core.outbox.send_message(call.message.chat.id, text)
+
+# ---------------- Advertise flow ----------------
+
+async def start_ad_flow(message):
+    core.outbox.send_message(message.chat.id, await run_db(core.begin_ad_flow, str(message.from_user.id)))
+
+# ---------------- Admin ----------------
+
+@abot.message_handler(commands=['addtask'])
+@require_admin
+async def cmd_addtask(message):
+    core.outbox.reply_to(message, await run_db(core.addtask_reply, message.text))
+
+@abot.message_handler(commands=['removetask'])
+@require_admin
+async def cmd_removetask(message):
+    core.outbox.reply_to(message, await run_db(core.removetask_reply, message.text))
+
+@abot.message_handler(commands=['addpoints'])
+@require_admin
+async def cmd_addpoints(message):
+    core.outbox.reply_to(message, await run_db(core.addpoints_reply, message.text))
+
+@abot.message_handler(commands=['stats'])
+@require_admin
+async def cmd_stats(message):
+    core.outbox.reply_to(message, core.stats_text())
+
+@abot.message_handler(commands=['rebuildleaderboard'])
+@require_admin
+async def cmd_rebuildleaderboard(message):
+    core.outbox.reply_to(message, await run_db(core.rebuildleaderboard_reply))
+
+@abot.message_handler(commands=['broadcasts'])
+@require_admin
+async def cmd_broadcasts(message):
+    core.outbox.reply_to(message, await run_db(core.broadcasts_text))
+
+@abot.message_handler(commands=['broadcast'])
+@require_admin
+async def cmd_broadcast(message):
+    core.outbox.reply_to(message, await run_db(core.broadcast_reply, message.text))
+
+@abot.message_handler(commands=['profile'])
+@require_admin
+async def cmd_profile(message):
+    core.outbox.reply_to(message, await run_db(core.profile_reply, message.text))
+
+@abot.message_handler(commands=['importtasks'])
+@abot.message_handler(content_types=['document'], func=lambda m: (m.caption or "").startswith("/importtasks"))
+@require_admin
+async def cmd_importtasks(message):
+    doc = core.import_document(message)
+    if doc is None:
+        core.outbox.reply_to(message, core.IMPORT_USAGE)
+        return
+    if (doc.file_size or 0) > core.IMPORT_MAX_BYTES:
+        core.outbox.reply_to(message, f"❌ File too large (max {core.IMPORT_MAX_BYTES // 1024} KB).")
+        return
+    try:
+        data = await abot.download_file((await abot.get_file(doc.file_id)).file_path)
+    except Exception as e:
+        logger.warning("Could not download %s: %s", doc.file_name, e)
+        core.outbox.reply_to(message, "❌ Could not download the file, try again.")
+        return
+    core.outbox.reply_to(message, await run_db(core.importtasks_reply, data, doc.file_name or ""))
+
+# Keyboard presses; registered after every command handler
+@abot.message_handler(func=lambda m: True, content_types=['text'])
+async def ui_buttons(message):
+    txt = message.text.strip().lower()
+    task_type = core._BUTTON_TASK_TYPES.get(txt)
+    if task_type:
+        await show_tasks(message.chat.id, message.from_user.id, task_type, "No tasks of this type are available right now.")
+    elif txt in ("💰 balance", "balance", "/points", "/balance"):
+        await cmd_balance(message)
+    elif txt in ("🙌 referrals", "referrals", "/referrals"):
+        await cmd_referrals(message)
+    elif txt in ("ℹ️ info", "info"):
+        core.outbox.reply_to(message, core.with_ad(core.INFO_TEXT, message.from_user.id))
+    elif txt in ("📊 advertise", "advertise"):
+        await start_ad_flow(message)
+    else:
+        core.outbox.reply_to(message, core.with_ad(core.FALLBACK_TEXT, message.from_user.id))
+
+# after the last handler above, so every one of them is timed
+metrics.instrument_handlers(abot)
+metrics.gauge("webhook_pending", lambda: len(_pending))
+metrics.gauge("webhook_shed", lambda: webhook_stats["shed"])
+
+
+# ------------------ Webhook server ------------------
+
+async def _process(update):
+    # asyncio locks wake waiters first-come first-served, so a user's
+    # updates run in the order they arrived
+    async with _user_locks[core.update_user_id(update) % len(_user_locks)]:
+        async with _inflight:
+            await abot.process_new_updates([update])
+
+async def handle_webhook(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    if len(_pending) >= MAX_PENDING_UPDATES:
+        webhook_stats["shed"] += 1
+        return web.Response(status=503, headers={"Retry-After": str(WEBHOOK_RETRY_AFTER)})
+    update = types.Update.de_json(await request.json())
+    webhook_stats["accepted"] += 1
+    # answer Telegram right away; the update is handled in the background
+    task = asyncio.create_task(_process(update))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+    return web.Response()
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def on_startup(app):
+    global _inflight, _user_locks
+    _inflight = asyncio.Semaphore(MAX_INFLIGHT_UPDATES)
+    _user_locks = [asyncio.Lock() for _ in range(max(1, USER_LOCK_STRIPES))]
+    await run_db(core.startup)
+    core._bot_username = (await abot.get_me()).username
+    if WEBHOOK_URL:
+        await abot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                               secret_token=WEBHOOK_SECRET or None,
+                               max_connections=100)
+        logger.info("Webhook registered at %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+async def on_cleanup(app):
+    if _pending:
+        await asyncio.gather(*_pending, return_exceptions=True)
+    await abot.close_session()
+    await run_db(core.outbox.stop)
+    await run_db(core.adserver.flush)
+    if core.ledger is not None:
+        await run_db(core.ledger.close)
+    _db_pool.shutdown(wait=False)
+
+def make_app():
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    app.router.add_get("/metrics", handle_metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+if __name__ == "__main__":
+    print("Referral & Tasks bot starting (webhook mode)...")
+    web.run_app(make_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)